@@ -4,89 +4,152 @@
 # www.frightideas.com
 #
 # Redesign to replace Indigo with Fibaro Home Center 2 by Ove Nystås
+#
+# The Indigo plugin. The panel protocol and alarm logic live in
+# dscCore.py, this maps Indigo devices, triggers and variables onto it.
 #######################################################################
 
-from datetime import datetime
+import dscCore
+import dscHost
+import dscHttp
+import dscProfiler
 import re
-import serial  # installed with sudo apt-get install python3-serial
 import time
 
-ZONE_STATE_OPEN = 'open'
-ZONE_STATE_CLOSED = 'closed'
-ZONE_STATE_TRIPPED = 'tripped'
-ZONE_GROUP_STATE_OPEN = 'zoneOpen'
-ZONE_GROUP_STATE_CLOSED = 'allZonesClosed'
-ZONE_GROUP_STATE_TRIPPED = 'zoneTripped'
-ALARM_STATE_DISARMED = 'disarmed'
-ALARM_STATE_EXIT_DELAY = 'exitDelay'
-ALARM_STATE_FAILED_TO_ARM = 'FailedToArm'
-ALARM_STATE_ARMED = 'armed'
-ALARM_STATE_ENTRY_DELAY = 'entryDelay'
-ALARM_STATE_TRIPPED = 'tripped'
-KEYPAD_STATE_CHIME_ENABLED = 'enabled'
-KEYPAD_STATE_CHIME_DISABLED = 'disabled'
-ALARM_ARMED_STATE_DISARMED = 'disarmed'
-ALARM_ARMED_STATE_STAY = 'stay'
-ALARM_ARMED_STATE_AWAY = 'away'
-
-LED_INDEX_LIST = ['None', 'Ready', 'Armed', 'Memory', 'Bypass', 'Trouble',
-                  'Program', 'Fire', 'Backlight', 'AC']
-LED_STATE_LIST = ['off', 'on', 'flashing']
-ARMED_MODE_LIST = ['Away', 'Stay', 'Away, No Delay', 'Stay, No Delay']
-PANIC_TYPE_LIST = ['None', 'Fire', 'Ambulance', 'Panic']
-MONTH_LIST = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
-              'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
-
-CMD_NORMAL = 0
-CMD_THERMO_SET = 1
-PING_INTERVAL = 301
-HOLD_RETRY_TIME_MINUTES = 3
-
 # Note the "indigo" module is automatically imported and made available inside
 # our global name space by the host process.
 ###############################################################################
 
 
+class IndigoHost(dscHost.HostAdapter):
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.createVariables = False
+        self.configSpeakVariable = None
+
+    ###########################################################################
+    # Logging
+    ###########################################################################
+    def log(self, level, msg):
+        self.plugin.logger.log(level, msg)
+
+    def logError(self, msg):
+        self.plugin.logger.logError(msg)
+
+    ###########################################################################
+    # Configuration
+    ###########################################################################
+    def readConfiguration(self, prefs):
+
+        # Tell our logging class to reread the config for level changes
+        self.plugin.logger.readConfig()
+
+        # Get setting of Create Variables checkbox
+        if prefs['createVariables'] is True:
+            self.createVariables = True
+        else:
+            self.createVariables = False
+
+        # If the variable folder doesn't exist disable variables,
+        # we're done!
+        if prefs['variableFolder'] not in indigo.variables.folders:
+            self.createVariables = False
+
+        self.configSpeakVariable = None
+        if 'speakToVariableEnabled' in prefs:
+            if prefs['speakToVariableEnabled'] is True:
+                self.configSpeakVariable = int(prefs['speakToVariableId'])
+                if self.configSpeakVariable not in indigo.variables:
+                    self.logError('Speak variable not found in '
+                                  'variable list')
+                    self.configSpeakVariable = None
+
+        self.plugin.setHttpPort(int(prefs.get('metricsPort', 0)))
+        return True
+
+    ###########################################################################
+    # Indigo Device State Updating
+    ###########################################################################
+    # All states in one call, so the server updates the device once
+    def updateStates(self, devId, states):
+        indigo.devices[devId].updateStatesOnServer(
+            [{'key': key, 'value': value} for (key, value) in states.items()])
+
+    def zoneChanged(self, zone, states):
+        self.updateStates(zone.hostRef, states)
+
+    def zoneGroupChanged(self, group, states):
+        self.updateStates(group.hostRef, states)
+
+    def keypadChanged(self, keypad, states):
+        self.updateStates(keypad.hostRef, states)
+
+    def tempSensorChanged(self, sensor, states):
+        self.updateStates(sensor.hostRef, states)
+
+    # Updates indigo variable instance var with new value varValue
+    def updateVariable(self, varID, varValue):
+        if self.createVariables is False:
+            return
+        if varID in indigo.variables:
+            indigo.variable.updateValue(varID, value=varValue)
+
+    ###########################################################################
+    # Indigo Trigger Firing
+    ###########################################################################
+    def fireEvent(self, eventId):
+        self.plugin.logger.log(4, "<<-- entering triggerEvent: %s " % eventId)
+        for trigId in self.plugin.triggerList:
+            trigger = indigo.triggers[trigId]
+            if trigger.pluginTypeId == eventId:
+                indigo.trigger.execute(trigger)
+
+    def fireUserEvent(self, eventId, userCode):
+        for trigId in self.plugin.triggerList:
+            trigger = indigo.triggers[trigId]
+            if trigger.pluginTypeId == eventId:
+                if trigger.pluginProps['userCode'] == userCode:
+                    indigo.trigger.execute(trigger.id)
+
+    def sendEmail(self, address, subject, body):
+        indigo.server.sendEmailTo(address, subject=subject, body=body)
+
+    def speak(self, text):
+        if self.configSpeakVariable is not None:
+            if self.configSpeakVariable in indigo.variables:
+                indigo.variable.updateValue(self.configSpeakVariable,
+                                            value=text)
+        else:
+            indigo.server.speak(text)
+
+    def runScene(self, sceneId):
+        indigo.actionGroup.execute(int(sceneId))
+
+    ###########################################################################
+    # Run Loop
+    ###########################################################################
+    def minuteElapsed(self):
+        # Do we need to check for a new version?
+        self.plugin.updater.checkVersionPoll()
+
+    def sleep(self, seconds):
+        self.plugin.sleep(seconds)
+
+
 class Plugin(indigo.PluginBase):
 
     ########################################
 
     def __init__(self, pluginId, pluginDisplayName,
                  pluginVersion, pluginPrefs):
-        self.States = self.enum(STARTUP=1, HOLD=2, HOLD_RETRY=3,
-                                HOLD_RETRY_LOOP=4, BOTH_INIT=5,
-                                ENABLE_TIME_BROADCAST=7,
-                                BOTH_PING=8, BOTH_POLL=9)
-        self.state = self.States.STARTUP
-        self.logLevel = 1
-        self.shutdown = False
-        self.configRead = False
-        self.interfaceState = 0
-        self.zoneList = {}
-        self.tempList = {}
-        self.zoneGroupList = {}
-        self.trippedZoneList = []
+        indigo.PluginBase.__init__(self, pluginId, pluginDisplayName,
+                                   pluginVersion, pluginPrefs)
         self.triggerList = []
-        self.keypadList = {}
-        self.createVariables = False
-        self.port = None
-        self.repeatAlarmTripped = False
-        self.isPortOpen = False
-        self.txCmdList = []
-        self.closeTheseZonesList = []
-        self.currentHoldRetryTime = HOLD_RETRY_TIME_MINUTES
-        self.ourVariableFolder = None
-        self.configEmailUrgent = ""
-        self.configEmailNotice = ""
-        self.configEmailUrgentSubject = ""
-        self.configEmailNoticeSubject = ""
-        self.configSpeakVariable = None
-        self.configKeepTimeSynced = True
-        self.troubleCode = 0
-        self.troubleClearedTimer = 0
-
-    def enum(self, **enums):
-        return type('Enum', (), enums)
+        self.registeredDevices = set()
+        self.httpServer = None
+        self.host = IndigoHost(self)
+        self.engine = dscCore.DscEngine(self.host, pluginPrefs)
 
     def __del__(self):
         indigo.PluginBase.__del__(self)
@@ -94,8 +157,16 @@ class Plugin(indigo.PluginBase):
     ########################################
     def startup(self):
         self.logger.log(4, "startup called")
-        self.configRead = self.getConfiguration(self.pluginPrefs)
+        started = time.time()
+        self.engine.configRead = \
+            self.engine.readConfiguration(self.pluginPrefs)
+        self.engine.startupPhase('config', started)
+        self.registerDevices()
         self.updater.checkVersionPoll()
+        if dscProfiler.installSignalHandler(
+                self.engine.profiler, self.engine.profiledThreads) is False:
+            self.logger.log(3, "Profiling on signal not available, "
+                            "use the HTTP endpoint instead.")
 
     def shutdown(self):
         self.logger.log(4, "shutdown called")
@@ -103,44 +174,92 @@ class Plugin(indigo.PluginBase):
     ###########################################################################
     # Indigo Device Start/Stop
     ###########################################################################
+
+    # Registers all of the plugin's enabled devices with the engine in one
+    # pass, before Indigo starts them one by one. Zone groups find their
+    # zones' numbers without fetching every member device, and the state
+    # and property changes of each device go to the server as one batch.
+    def registerDevices(self):
+        started = time.time()
+        devices = list(indigo.devices.iter('self'))
+        zoneNumbers = dict(
+            (dev.id, int(dev.pluginProps['zoneNumber'])) for dev in devices
+            if dev.deviceTypeId == 'alarmZone' and
+            'zoneNumber' in dev.pluginProps)
+        devices = [dev for dev in devices if dev.enabled]
+        changes = [self.registerDevice(dev, zoneNumbers) for dev in devices]
+        self.engine.startupPhase('registration', started)
+
+        started = time.time()
+        for (dev, change) in zip(devices, changes):
+            self.applyDeviceChanges(dev, *change)
+        self.engine.startupPhase('deviceUpdates', started)
+        self.logger.log(3, "Registered %u devices." % len(devices))
+        self.registeredDevices = set(dev.id for dev in devices)
+
     def deviceStartComm(self, dev):
         self.logger.log(4, "<<-- entering deviceStartComm: %s (%d - %s)" %
                         (dev.name, dev.id, dev.deviceTypeId))
 
+        if dev.id in self.registeredDevices:
+            # Done by registerDevices, but only once: if the device is
+            # started again it may have been edited
+            self.registeredDevices.discard(dev.id)
+        else:
+            self.applyDeviceChanges(dev, *self.registerDevice(dev, {}))
+
+        self.logger.log(4, "exiting deviceStartComm -->>")
+
+    # Registers dev with the engine. Returns the changes dev needs, as
+    # (whether its state list has to be reloaded, props to replace its
+    # props with or None, {state: value}), for applyDeviceChanges.
+    # zoneNumbers maps zone device ids to zone numbers, zone devices not
+    # in it are looked up.
+    def registerDevice(self, dev, zoneNumbers):
         props = dev.pluginProps
+        (reloadStates, newProps, states) = (False, None, {})
 
         if dev.deviceTypeId == 'alarmZoneGroup':
-            if dev.id not in self.zoneGroupList:
-                self.zoneGroupList[dev.id] = props['devList']
-
-            if dev.states['state'] == 0:
-                dev.updateStateOnServer(key="state",
-                                        value=ZONE_GROUP_STATE_CLOSED)
+            state = dev.states['state']
+            if state == 0:
+                state = dscCore.ZONE_GROUP_STATE_CLOSED
+                states['state'] = state
+
+            # The engine groups zones by number, devList holds device ids
+            zones = []
+            for zoneId in props['devList']:
+                zoneNum = zoneNumbers.get(int(zoneId))
+                if zoneNum is None:
+                    zoneNum = self.zoneNumber(int(zoneId))
+                if zoneNum is not None:
+                    zones.append(zoneNum)
+
+            self.engine.addZoneGroup(
+                dev.name, dev.id, zones, state,
+                dev.states.get('AnyMemberLastChangedTimer', 0),
+                dev.states.get('EntireGroupLastChangedTimer', 0))
 
         elif dev.deviceTypeId == 'alarmZone':
             if 'zoneNumber' not in props:
-                return
+                return (reloadStates, newProps, states)
             zone = int(props['zoneNumber'])
-            if zone not in list(self.zoneList.keys()):
-                self.zoneList[zone] = dev.id
-            else:
+            if zone in self.engine.zoneList:
                 self.logger.logError("Zone %s is already assigned "
                                      "to another device." % zone)
 
             # Check for new version zone states.
             # If they're not present tell Indigo to reread the Devices.xml file
             if 'LastChangedShort' not in dev.states:
-                dev.stateListOrDisplayStateIdChanged()
+                reloadStates = True
 
             # If state is invalid or not there, set to closed
-            if dev.states['state'] == 0:
-                dev.updateStateOnServer(key='state',
-                                        value=ZONE_STATE_CLOSED)
+            state = dev.states['state']
+            if state == 0:
+                state = dscCore.ZONE_STATE_CLOSED
+                states['state'] = state
 
-            dev.updateStateOnServer(key="LastChangedShort",
-                                    value=self.
-                                    getShortTime(dev.
-                                                 states["LastChangedTimer"]))
+            timer = dev.states.get("LastChangedTimer", 0)
+            states['LastChangedShort'] = dscCore.getShortTime(timer)
 
             # Check for new version properties to see if we need to refresh
             # the device
@@ -148,72 +267,84 @@ class Plugin(indigo.PluginBase):
                 self.logger.log(3, "Adding occupancyGroup to "
                                 "device %s properties." % dev.name)
                 props.update({"occupancyGroup": 0})
-                dev.replacePluginPropsOnServer(props)
+                newProps = props
 
             # If the variable we used no longer exists then remove the varID
-            if "var" in props:
-                if props["var"] not in indigo.variables:
+            if props.get("var") not in indigo.variables:
+                if "var" not in props or props["var"] is not None:
                     props["var"] = None
-                    dev.replacePluginPropsOnServer(props)
-            else:
-                props["var"] = None
-                dev.replacePluginPropsOnServer(props)
+                    newProps = props
 
-        elif dev.deviceTypeId == 'alarmKeypad':
-            self.keypadList[int(dev.pluginProps['partitionNumber'])] = dev.id
+            self.engine.addZone(zone, dev.name, dev.id, state, timer,
+                                props.get('zoneLogChanges') == 1,
+                                int(props['occupancyGroup']), props['var'],
+                                int(props.get('partitionNumber', 1)))
 
-            # self.logger.log(3, u"Adding keypad: %s" % self.keypadList)
-            dev.updateStateOnServer(key='state',
-                                    value=ALARM_STATE_DISARMED)
+        elif dev.deviceTypeId == 'alarmKeypad':
+            states['state'] = dscCore.ALARM_STATE_DISARMED
+            self.engine.addKeypad(int(props['partitionNumber']), dev.name,
+                                  dev.id,
+                                  {'state': dscCore.ALARM_STATE_DISARMED})
 
             # Check for new keypad states.
             # If they're not present tell Indigo to reread the Devices.xml file
             if 'ArmedState' not in dev.states:
-                dev.stateListOrDisplayStateIdChanged()
+                reloadStates = True
 
         elif dev.deviceTypeId == 'alarmTemp':
-            sensor = int(dev.pluginProps['sensorNumber'])
-            if sensor not in list(self.tempList.keys()):
-                self.tempList[sensor] = dev
-
-        self.logger.log(4, "exiting deviceStartComm -->>")
+            self.engine.addTempSensor(int(props['sensorNumber']), dev.name,
+                                      dev.id,
+                                      props.get('zoneLogChanges') == 1)
+
+        return (reloadStates, newProps, states)
+
+    # Applies what registerDevice found, the state list first so new
+    # states exist before they are set
+    def applyDeviceChanges(self, dev, reloadStates, props, states):
+        if reloadStates is True:
+            dev.stateListOrDisplayStateIdChanged()
+        if props is not None:
+            dev.replacePluginPropsOnServer(props)
+        if len(states) > 0:
+            dev.updateStatesOnServer([{'key': key, 'value': value}
+                                      for (key, value) in states.items()])
+
+    # The zone number of the zone device devId, None if there's no such
+    # device
+    def zoneNumber(self, devId):
+        if devId not in indigo.devices:
+            return None
+        zoneProps = indigo.devices[devId].pluginProps
+        if 'zoneNumber' not in zoneProps:
+            return None
+        return int(zoneProps['zoneNumber'])
 
     def deviceStopComm(self, dev):
         self.logger.log(4, "<<-- entering deviceStopComm: %s (%d - %s)" %
                         (dev.name, dev.id, dev.deviceTypeId))
 
+        props = dev.pluginProps
+
         if dev.deviceTypeId == 'alarmZoneGroup':
-            if dev.id in self.zoneGroupList:
-                del self.zoneGroupList[dev.id]
+            self.engine.removeZoneGroup(dev.id)
 
         elif dev.deviceTypeId == 'alarmZone':
-            if 'zoneNumber' in dev.pluginProps:
-                zone = int(dev.pluginProps['zoneNumber'])
-                if zone in list(self.zoneList.keys()):
-                    del self.zoneList[zone]
-                # self.logger.log(3, "ZoneList is now: %s" % self.zoneList)
+            if 'zoneNumber' in props:
+                zone = int(props['zoneNumber'])
+                if zone in self.engine.zoneList and \
+                        self.engine.zoneList[zone].hostRef == dev.id:
+                    self.engine.removeZone(zone)
 
         elif dev.deviceTypeId == 'alarmKeypad':
-            if 'partitionNumber' in dev.pluginProps:
-                keyp = int(dev.pluginProps['partitionNumber'])
-                if keyp in self.keypadList:
-                    del self.keypadList[keyp]
+            if 'partitionNumber' in props:
+                self.engine.removeKeypad(int(props['partitionNumber']))
 
         elif dev.deviceTypeId == 'alarmTemp':
-            if 'sensorNumber' in dev.pluginProps:
-                tmp = int(dev.pluginProps['sensorNumber'])
-                if tmp in self.tempList:
-                    del self.tempList[int(dev.pluginProps['sensorNumber'])]
+            if 'sensorNumber' in props:
+                self.engine.removeTempSensor(int(props['sensorNumber']))
 
         self.logger.log(4, "exiting deviceStopComm -->>")
 
-    # def deviceUpdated(self, origDev, newDev):
-    #     self.logger.log(4, "<<-- entering deviceUpdated: %s" % origDev.name)
-    #     origDev.name = newDev.name
-    #     self.logger.log(4, "OrigDev now: %s" % origDev.name)
-    #     self.DigiTemp.deviceStop(origDev)
-    #     self.DigiTemp.deviceStart(newDev)
-
     ###########################################################################
     # Indigo Trigger Start/Stop
     ###########################################################################
@@ -231,22 +362,6 @@ class Plugin(indigo.PluginBase):
             self.triggerList.remove(trigger.id)
         self.logger.log(4, "exiting triggerStopProcessing -->>")
 
-    # def triggerUpdated(self, origDev, newDev):
-    #     self.logger.log(4, "<<-- entering triggerUpdated: %s" % origDev.name)
-    #     self.triggerStopProcessing(origDev)
-    #     self.triggerStartProcessing(newDev)
-
-    ###########################################################################
-    # Indigo Trigger Firing
-    ###########################################################################
-    def triggerEvent(self, eventId):
-        self.logger.log(4, "<<-- entering triggerEvent: %s " % eventId)
-        for trigId in self.triggerList:
-            trigger = indigo.triggers[trigId]
-            if trigger.pluginTypeId == eventId:
-                indigo.trigger.execute(trigger)
-        return
-
     ###########################################################################
     # Indigo Menu Action Methods
     ###########################################################################
@@ -258,110 +373,38 @@ class Plugin(indigo.PluginBase):
     # Indigo Action Methods
     ###########################################################################
     def methodDisarmAlarm(self, action):
-        self.logger.log(1, "Disarming alarm")
-        tx = "".join(["0401", self.pluginPrefs['code'],
-                      "0" * (6 - len(self.pluginPrefs['code']))])
-        self.txCmdList.append((CMD_NORMAL, tx))
+        self.engine.disarm()
 
     def methodArmStay(self, action):
-        self.logger.log(1, "Arming alarm in stay mode.")
-        self.txCmdList.append((CMD_NORMAL, '0311'))
+        self.engine.armStay()
 
     def methodArmAway(self, action):
-        self.logger.log(1, "Arming alarm in away mode.")
-        self.txCmdList.append((CMD_NORMAL, '0301'))
+        self.engine.armAway()
 
     def methodPanicAlarm(self, action):
-        panicType = action.props['panicAlarmType']
-        self.logger.log(1, "Activating Panic Alarm! (%s)" %
-                        PANIC_TYPE_LIST[int(panicType)])
-        self.txCmdList.append((CMD_NORMAL, '060' + panicType))
+        self.engine.panic(action.props['panicAlarmType'])
 
     def methodSendKeypress(self, action):
         self.logger.log(3, "Received Send Keypress Action")
-        keys = action.props['keys']
-        firstChar = True
-        sendBreak = False
-        for char in keys:
-            if char == 'L':
-                time.sleep(2)
-                sendBreak = False
-
-            if (firstChar is False):
-                self.txCmdList.append((CMD_NORMAL, '070^'))
-
-            if char != 'L':
-                self.txCmdList.append((CMD_NORMAL, '070' + char))
-                sendBreak = True
-
-            firstChar = False
-        if (sendBreak is True):
-            self.txCmdList.append((CMD_NORMAL, '070^'))
+        self.engine.sendKeypress(action.props['keys'])
 
     # Queue a command to set DSC Thermostat Setpoints
     def methodAdjustThermostat(self, action):
         self.logger.log(3, "Device %s:" % action)
-        self.txCmdList.append((CMD_THERMO_SET, action))
-
-    # The command queued above calls this routine to create the packet
-    def setThermostat(self, action):
-        # find this thermostat in our list to get the number
-        for sensorNum in list(self.tempList.keys()):
-            if self.tempList[sensorNum].id == action.deviceId:
-                break
-
-        self.logger.log(3, "SensorNum = %s" % sensorNum)
-
-        # send 095 for thermostat in question, wait for 563 response
-        # self.logger.log(3, '095' + str(sensorNum))
-        rx = self.sendPacket('095' + str(sensorNum), waitFor='563')
-        if len(rx) == 0:
-            self.logger.logError('Error getting current thermostat setpoints, '
-                                 'aborting adjustment.')
-            return
-
-        if action.props['thermoAdjustmentType'] == '+' or \
-                action.props['thermoAdjustmentType'] == '-':
-            sp = 0
-        else:
-            sp = int(action.props['thermoSetPoint'])
-
-        # then 096TC+000 to inc cool,
-        #      096Th-000 to dec heat
-        # 096Th=### to set setpoint
-        # wait for 563 response
-        # self.logger.log(3, '096%u%c%c%03u' %
-        #                 (sensorNum, action.props['thermoAdjustWhich'],
-        #                 action.props['thermoAdjustmentType'], sp))
-        rx = self.sendPacket('096%u%c%c%03u' %
-                             (sensorNum, action.props['thermoAdjustWhich'],
-                              action.props['thermoAdjustmentType'], sp),
-                             waitFor='563')
-        if len(rx) == 0:
-            self.logger.logError('Error changing thermostat setpoints, '
-                                 'aborting adjustment.')
-            return
-
-        # send 097T
-        # send 097 for thermostat in question to save setting,
-        # wait for 563 response
-        rx = self.sendPacket('097' + str(sensorNum), waitFor='563')
-        if len(rx) == 0:
-            self.logger.logError('Error saving thermostat setpoints, '
-                                 'aborting adjustment.')
-            return
+        for sensor in self.engine.tempList.values():
+            if sensor.hostRef == action.deviceId:
+                self.engine.adjustThermostat(
+                    sensor.number, action.props['thermoAdjustWhich'],
+                    action.props['thermoAdjustmentType'],
+                    action.props.get('thermoSetPoint', 0))
+                return
+        self.logger.logError('Thermostat device %s is not a started '
+                             'temperature sensor.' % action.deviceId)
 
     # Reset an Alarm Zone Group's timers to 0
     #
     def methodResetZoneGroupTimer(self, action):
-        if action.deviceId in indigo.devices:
-            zoneGrp = indigo.devices[action.deviceId]
-            self.logger.log(3, "Manual timer reset for "
-                               "alarm zone group \"%s\"" % zoneGrp.name)
-            zoneGrp.updateStateOnServer(key="AnyMemberLastChangedTimer",
-                                        value=0)
-            zoneGrp.updateStateOnServer(key="EntireGroupLastChangedTimer",
-                                        value=0)
+        self.engine.resetZoneGroupTimer(action.deviceId)
 
     ###########################################################################
     # Indigo Pref UI Methods
@@ -396,8 +439,9 @@ class Plugin(indigo.PluginBase):
         if wasError is True:
             return (False, valuesDict, errorMsgDict)
 
-        # Tell DSC module to reread it's config
-        self.configRead = False
+        # Have the engine switch to the new config, it only reconnects if
+        # the port settings changed
+        self.engine.reloadConfiguration(valuesDict)
 
         # User choices look good, so return True
         # (client will then close the dialog window).
@@ -441,10 +485,9 @@ class Plugin(indigo.PluginBase):
         #                 (typeId, devId, valuesDict))
         if typeId == 'alarmZone':
             zoneNum = int(valuesDict['zoneNumber'])
-            if zoneNum in list(self.zoneList.keys()) and \
-                    devId != indigo.devices[self.zoneList[zoneNum]].id:
-                self.logger.log(3, "ZONEID: %s" %
-                                self.DSC.zoneList[zoneNum].id)
+            zoneList = self.engine.zoneList
+            if zoneNum in zoneList and devId != zoneList[zoneNum].hostRef:
+                self.logger.log(3, "ZONEID: %s" % zoneList[zoneNum].hostRef)
                 errorMsgDict = indigo.Dict()
                 errorMsgDict['zoneNumber'] = "This zone has already been " \
                     "assigned to a different device."
@@ -454,11 +497,12 @@ class Plugin(indigo.PluginBase):
     def getZoneList(self, filter_="", valuesDict=None,
                     typeId="", targetId=0):
         myArray = []
+        zoneList = self.engine.zoneList
         for i in range(1, 65):
             zoneName = str(i)
-            if i in list(self.zoneList.keys()):
-                zoneDev = indigo.devices[self.zoneList[i]]
-                zoneName = ''.join([str(i), ' - ', zoneDev.name])
+            if i in zoneList:
+                # The device's name as registered, no need to fetch it
+                zoneName = ''.join([str(i), ' - ', zoneList[i].name])
             myArray.append((str(i), zoneName))
         return myArray
 
@@ -474,1126 +518,38 @@ class Plugin(indigo.PluginBase):
         return myArray
 
     ###########################################################################
-    # Configuration Routines
+    # Local HTTP Server
     ###########################################################################
 
-    # Reads the plugins config file into our own variables
-    def getConfiguration(self, valuesDict):
-
-        # Tell our logging class to reread the config for level changes
-        self.logger.readConfig()
-
-        self.logger.log(3, "getConfiguration start")
-
-        try:
-            # Get setting of Create Variables checkbox
-            if valuesDict['createVariables'] is True:
-                self.createVariables = True
-            else:
-                self.createVariables = False
-
-            # If the variable folder doesn't exist disable variables,
-            # we're done!
-            if valuesDict['variableFolder'] not in indigo.variables.folders:
-                self.createVariables = False
-
-            self.configKeepTimeSynced = valuesDict.get('syncTime', True)
-
-            self.configSpeakVariable = None
-            if 'speakToVariableEnabled' in valuesDict:
-                if valuesDict['speakToVariableEnabled'] is True:
-                    self.configSpeakVariable = \
-                        int(valuesDict['speakToVariableId'])
-                    if self.configSpeakVariable not in indigo.variables:
-                        self.logger.logError('Speak variable not found in '
-                                             'variable list')
-                        self.configSpeakVariable = None
-
-            self.configEmailUrgent = valuesDict.get('emailUrgent', '')
-            self.configEmailNotice = valuesDict.get('updaterEmail', '')
-            self.configEmailUrgentSubject = \
-                valuesDict.get('emailUrgentSubject', 'Alarm Tripped')
-            self.configEmailNoticeSubject = \
-                valuesDict.get('updaterEmailSubject', 'Alarm Trouble')
-
-            self.logger.log(3, "Configuration read successfully")
-            return True
-
-        except:
-            self.logger.log(2, "Error reading plugin configuration. "
-                            "(happens on very first launch)")
-            return False
-
-    ###########################################################################
-    # Communication Routines
-    ###########################################################################
-    def calcChecksum(self, s):
-        calcSum = 0
-        for c in s:
-            calcSum += ord(c)
-        calcSum %= 256
-        return calcSum
-
-    def closePort(self):
-        if self.port is None:
-            return
-        if self.port.isOpen() is True:
-            self.port.close()
-            self.port = None
-
-    def openPort(self):
-        self.closePort()
-        self.logger.log(1, "Initializing communication on port %s" %
-                        self.pluginPrefs['serialPort'])
-        try:
-            self.port = serial.Serial(self.pluginPrefs['serialPort'],
-                                      9600,
-                                      writeTimeout=1)
-        except Exception as err:
-            self.logger.logError('Error opening serial port: %s' %
-                                 (str(err)))
-            return False
-
-        if self.port.isOpen() is True:
-            self.port.flushInput()
-            self.port.timeout = 1
-            return True
-
-        return False
-
-    def readPort(self):
-        if self.port.isOpen() is False:
-            self.state = self.States.BOTH_INIT
-            return ""
-        data = ""
-        try:
-            data = self.port.readline()
-        except Exception as err:
-            self.logger.logError('Connection RX Error: %s' % (str(err)))
-            # Return with '-' signaling calling subs to abort
-            # so we can re-init.
-            data = '-'
-            # exit()
-        except:
-            self.logger.logError('Connection RX Problem, plugin quitting')
-            exit()
-        return data
-
-    def writePort(self, data):
-        self.port.write(data)
-
-    def sendPacketOnly(self, data):
-        pkt = "%s%02X\r\n" % (data, self.calcChecksum(data))
-        self.logger.log(4, "TX: %s" % pkt)
-        try:
-            self.writePort(pkt)
-        except Exception as err:
-            self.logger.logError('Connection TX Error: %s' % (str(err)))
-            exit()
-        except:
-            self.logger.logError('Connection TX Problem, plugin quitting')
-            exit()
-
-    def sendPacket(self, tx, waitFor='500', rxTimeout=3, txRetries=3):
-        retries = txRetries
-        txCmd = tx[:3]
-
-        while txRetries > 0:
-            self.sendPacketOnly(tx)
-            ourTimeout = time.time() + rxTimeout
-            txRetries -= 1
-            while time.time() < ourTimeout:
-                if self.shutdown is True:
-                    return ''
-                (rxCmd, rxData) = self.readPacket()
-
-                # If rxCmd == - then the socket closed, return for re-init
-                if rxCmd == '-':
-                    return '-'
-
-                if rxCmd == '502':
-                    self.logger.logError('Received system error after '
-                                         'sending command, aborting.')
-                    return ''
-
-                # If rxCmd is not 0 length then we received a response
-                if len(rxCmd) > 0:
-                    if waitFor == '500':
-                        if (rxCmd == '500') and (rxData == txCmd):
-                            return rxData
-                    elif (rxCmd == waitFor):
-                        return rxData
-            if txCmd != '000':
-                self.logger.logError('Timed out after waiting for response to '
-                                     'command %s for %u seconds, retrying.' %
-                                     (tx, rxTimeout))
-        self.logger.logError('Resent command %s %u times with no success, '
-                             'aborting.' % (tx, retries))
-        return ''
-
-    def readPacket(self):
-        data = self.readPort()
-        if len(data) == 0:
-            return ('', '')
-        elif data == '-':
-            # socket has closed, return with signal to re-initialize
-            return ('-', '')
-
-        data = data.strip()
-
-        m = re.search(r'^(...)(.*)(..)$', data)
-        if not m:
-            return ('', '')
-
-        # Put this try in to try to catch exceptions when non-ascii characters
-        # were received, not sure why they are being received.
-        try:
-            self.logger.log(4, "RX: %s" % data)
-            (cmd, dat, sum_) = (m.group(1), m.group(2), int(m.group(3), 16))
-        except:
-            self.logger.logError('IT-100 Error: '
-                                 'Received a response with invalid characters')
-            return ('', '')
-
-        if sum_ != self.calcChecksum("".join([cmd, dat])):
-            self.logger.logError("Checksum did not match "
-                                 "on a received packet.")
-            return ('', '')
-
-        # Parse responses based on cmd value
-        if cmd == '500':  # Command Acknowledge
-            self.logger.log(3, "ACK for cmd %s." % dat)
-            self.cmdAck = dat
-
-        elif cmd == '501':  # Command Error
-            self.logger.logError('IT-100: '
-                                 'Received a command with a bad checksum')
-
-        elif cmd == '502':  # System Error
-            errText = 'Unknown'
-            if dat == '017':
-                errText = 'Keybus Busy – Installer Mode'
-            elif dat == '021':
-                errText = 'Requested Partition is out of Range'
-            elif dat == '023':
-                errText = 'Partition is Not Armed'
-            elif dat == '024':
-                errText = 'Partition is Not Ready to Arm'
-                self.triggerEvent('eventFailToArm')
-                self.speak('speakTextFailedToArm')
-            elif dat == '026':
-                errText = 'User Code Not Required'
-            elif dat == '027':
-                errText = 'Virtual Keypad is Disabled'
-            elif dat == '029':
-                errText = 'Not Valid Parameter'
-            elif dat == '030':
-                errText = 'Keypad Does Not Come Out of Blank Mode'
-            elif dat == '031':
-                errText = 'IT-100 is already in Thermostat menu'
-            elif dat == '032':
-                errText = 'IT-100 is Not in Thermostat menu'
-            elif dat == '033':
-                errText = 'No Response from Thermostat (or Escort Module)'
-            self.logger.logError("IT-100 Error (%s): %s" % (dat, errText))
-
-        elif cmd == '550':  # Time/Date Broadcast
-            m = re.search(r'^(\d\d)(\d\d)(\d\d)(\d\d)(\d\d)$', dat)
-            if m:
-                tHour = int(m.group(1))
-                tMinute = int(m.group(2))
-                tMonth = int(m.group(3)) - 1
-                tDay = int(m.group(4))
-                tYear = int(m.group(5))
-
-                # Check if we should sync time
-                if self.configKeepTimeSynced is True:
-                    d = datetime.now()
-                    if (d.year != tYear) or (d.month != tMonth) or \
-                            (d.day != tDay) or (d.hour != tHour) or \
-                            (d.minute != tMinute):
-                        self.logger.log(1, "Setting alarm panel time and "
-                                        "date.")
-                        self.txCmdList.append((CMD_NORMAL, "010%s" %
-                                               d.strftime("%H%M%m%d%y")))
-                    else:
-                        self.logger.log(3, "Alarm time is within 1 minute of "
-                                        "actual time, no update necessary.")
-
-        elif cmd == '560':  # Ring Detected
-            # NOTE: ESCORTTM5580TC module is required to receive this command.
-            # Not implemented
-            self.logger.log(1, "Ring Detected. Not implemented!")
-
-        elif cmd == '561':  # Indoor Temperature Broadcast
-            m = re.search(r'^(.)(...)$', dat)
-            if m:
-                (sensor, temp) = (int(m.group(1)), int(m.group(2)))
-                self.updateSensorTemp(sensor, 'inside', temp)
-
-        elif cmd == '562':  # Outdoor Temperature Broadcast
-            m = re.search(r'^(.)(...)$', dat)
-            if m:
-                (sensor, temp) = (int(m.group(1)), int(m.group(2)))
-                self.updateSensorTemp(sensor, 'outside', temp)
-
-        elif cmd == '563':  # Thermostat Set Points
-            m = re.search(r'^(.)(...)(...)$', dat)
-            if m:
-                (sensor, cool, heat) = (int(m.group(1)),
-                                        int(m.group(2)),
-                                        int(m.group(3)))
-                self.updateSensorTemp(sensor, 'cool', cool)
-                self.updateSensorTemp(sensor, 'heat', heat)
-
-        elif cmd == '570':  # Broadcast Labels
-            # NOTE: This function is only available with the
-            #       PowerSeries PC1616/1832/1864 Panels
-            # Not implemented
-            self.logger.log(1, "Broadcast Labels. Not implemented!")
-
-        elif cmd == '580':  # Baud Rate Set
-            # The IT-100 sends the command in response to
-            # the following command sent by the application.
-            # Baud Change Rate ........................................ (080)
-            # Val:
-            # 0 (30h) = 9600
-            # 1 (31h) = 19200
-            # 2 (32h) = 38400
-            # 3 (33h) = 57600
-            # 4 (34h) = 115200
-            # Not implemented
-            self.logger.log(1, "Baud Rate Set. Not implemented!")
-
-        elif cmd == '601':  # Zone Alarm
-            m = re.search(r'^(.)(...)$', dat)
-            if m:
-                (partition, zone) = (int(m.group(1)), int(m.group(2)))
-                self.updateZoneState(zone, ZONE_STATE_TRIPPED)
-                if zone not in self.trippedZoneList:
-                    self.trippedZoneList.append(zone)
-                    self.sendZoneTrippedEmail()
-
-        elif cmd == '602':  # Zone Alarm Restore
-            m = re.search(r'^(.)(...)$', dat)
-            if m:
-                (partition, zone) = (int(m.group(1)), int(m.group(2)))
-                self.logger.log(1, "Zone %d Restored. (Partition %d)" %
-                                (zone, partition))
-
-        elif cmd == '603':  # Zone Tamper
-            # Zone Tamper | 603 (36, 30, 33h) | 4 (Part. 1-8, Zn 1-64)
-            # This IT-100 command indicates that a zone and associated
-            # partition has a tamper condition.
-            # Partition 1(31h)-8(38h), Zn 1(30, 30, 31h)-Zone 64(30, 36, 34h)
-            # Not implemented
-            self.logger.log(1, "Zone Tamper. Not implemented!")
-
-        elif cmd == '604':  # Zone Tamper Restore
-            # Not implemented
-            self.logger.log(1, "Zone Tamper Restore. Not implemented!")
-
-        elif cmd == '605':  # Zone Fault
-            # Not implemented
-            self.logger.log(1, "Zone Fault. Not implemented!")
-
-        elif cmd == '606':  # Zone Fault Restore
-            # Not implemented
-            self.logger.log(1, "Zone Fault Restore. Not implemented!")
-
-        elif cmd == '609':  # Zone Open
-            zone = int(dat)
-            self.logger.log(3, "Zone number %d Open." % zone)
-            self.updateZoneState(zone, ZONE_STATE_OPEN)
-            if self.repeatAlarmTripped is True:
-                if zone in self.closeTheseZonesList:
-                    self.closeTheseZonesList.remove(zone)
-
-        elif cmd == '610':  # Zone Restored
-            zone = int(dat)
-            self.logger.log(3, "Zone number %d Closed." % zone)
-            # Update the zone to closed ONLY if the alarm is not tripped
-            # We want the tripped states to be preserved so someone looking
-            # at their control page will see all the zones that have been
-            # opened since the break in.
-            if self.repeatAlarmTripped is False:
-                self.updateZoneState(zone, ZONE_STATE_CLOSED)
-            else:
-                self.closeTheseZonesList.append(zone)
-
-        elif cmd == '620':  # Duress Alarm
-            self.logger.log(1, "Duress Alarm Detected")
-
-        elif cmd == '621':  # [F] Key Alarm
-            self.logger.log(1, "Fire Key Alarm Detected")
-
-        elif cmd == '622':  # [F] Key Restoral
-            self.logger.log(1, "Fire Key Alarm Restored")
-
-        elif cmd == '623':  # [A] Key Alarm
-            self.logger.log(1, "Auxiliary Key Alarm Detected")
-
-        elif cmd == '624':  # [A] Key Restoral
-            self.logger.log(1, "Auxiliary Key Alarm Restored")
-
-        elif cmd == '625':  # [P] Key Alarm
-            self.logger.log(1, "Panic Key Alarm Detected")
-
-        elif cmd == '626':  # [P] Key Restoral
-            self.logger.log(1, "Panic Key Alarm Restored")
-
-        elif cmd == '631':  # Auxiliary Input Alarm
-            self.logger.log(1, "Auxiliary Input Alarm Detected")
-
-        elif cmd == '632':  # Auxiliary Input Alarm Restored
-            self.logger.log(1, "Auxiliary Input Alarm Restored")
-
-        elif cmd == '650':  # Partition Ready
-            self.logger.log(3, "Partition %d Ready" % int(dat))
-
-        elif cmd == '651':  # Partition Not Ready
-            self.logger.log(3, "Partition %d Not Ready" % int(dat))
-
-        elif cmd == '652':  # Partition Armed - Descriptive Mode
-            if len(dat) == 1:
-                partition = int(dat)
-                self.logger.log(3, "Alarm Armed. (Partition %d)" % partition)
-                self.updateKeypad(partition, 'state', ALARM_STATE_ARMED)
-                # TODO: This response does not tell us armed type trigger.
-                #       Stay, Away, etc.  :(
-            elif len(dat) == 2:
-                m = re.search(r'^(.)(.)$', dat)
-                if m:
-                    (partition, mode) = (int(m.group(1)), int(m.group(2)))
-                    self.logger.log(1,
-                                    "Alarm Armed in %s mode. (Partition %d)" %
-                                    (ARMED_MODE_LIST[mode], partition))
-                    if (mode == 0) or (mode == 2):
-                        armedEvent = 'armedAway'
-                        self.updateKeypad(partition,
-                                          'ArmedState',
-                                          ALARM_ARMED_STATE_AWAY)
-                    else:
-                        armedEvent = 'armedStay'
-                        self.updateKeypad(partition,
-                                          'ArmedState',
-                                          ALARM_ARMED_STATE_STAY)
-
-                    self.triggerEvent(armedEvent)
-                    self.updateKeypad(partition,
-                                      'state',
-                                      ALARM_STATE_ARMED)
-
-        elif cmd == '653':  # Partition in Ready to Force Arm
-            # Partition Ready - Forced Arming Enabled
-            # We don't do anything with this now.
-            # Not implemented
-            self.logger.log(1, "Partition in Ready to Force Arm. "
-                            "Not implemented!")
-
-        elif cmd == '654':  # Partition In Alarm
-            self.logger.log(1, "Alarm TRIPPED! (Partition %d)" % int(dat))
-            self.updateKeypad(int(dat),
-                              'state',
-                              ALARM_STATE_TRIPPED)
-            self.triggerEvent('eventAlarmTripped')
-            self.repeatAlarmTrippedNext = time.time()
-            self.repeatAlarmTripped = True
-
-        elif cmd == '655':  # Partition Disarmed
-            # If the alarm has been disarmed while it was tripped,
-            # update any zone state that were closed during the break in.
-            # We don't update them during the event so that Indigo's zone
-            # states will represent a zone as tripped during the entire event.
-            if self.repeatAlarmTripped is True:
-                self.repeatAlarmTripped = False
-                for zone in self.closeTheseZonesList:
-                    self.updateZoneState(zone, ZONE_STATE_CLOSED)
-                self.closeTheseZonesList = []
-
-            partition = int(dat)
-            self.logger.log(1, "Alarm Disarmed. (Partition %d)" % partition)
-            self.trippedZoneList = []
-            self.updateKeypad(partition,
-                              'state',
-                              ALARM_STATE_DISARMED)
-            self.updateKeypad(partition,
-                              'ArmedState', ALARM_ARMED_STATE_DISARMED)
-            self.triggerEvent('eventAlarmDisarmed')
-            self.speak('speakTextDisarmed')
-
-        elif cmd == '656':  # Exit Delay in Progress
-            self.logger.log(1, "Exit Delay. (Partition %d)" % int(dat))
-            self.updateKeypad(int(dat), 'state', ALARM_STATE_EXIT_DELAY)
-            self.speak('speakTextArming')
-
-        elif cmd == '657':  # Entry Delay in Progress
-            self.logger.log(1, "Entry Delay. (Partition %d)" % int(dat))
-            self.updateKeypad(int(dat), 'state', ALARM_STATE_ENTRY_DELAY)
-            self.speak('speakTextEntryDelay')
-
-        elif cmd == '658':  # Keypad Lock-out
-            # Not implemented
-            self.logger.log(1, "Keypad Lock-out. Not implemented!")
-
-        elif cmd == '659':  # Keypad Blanking
-            # Not implemented
-            self.logger.log(1, "Keypad Blanking. Not implemented!")
-
-        elif cmd == '660':  # Command Output In Progress
-            # Not implemented
-            self.logger.log(1, "Command Output In Progress. Not implemented!")
-
-        elif cmd == '670':  # Invalid Access Code
-            # Not implemented
-            self.logger.log(1, "Invalid Access Code. Not implemented!")
-
-        elif cmd == '671':  # Function Not Available
-            # Not implemented
-            self.logger.log(1, "Function Not Available. Not implemented!")
-
-        elif cmd == '672':  # Fail to Arm
-            self.logger.log(1, "Alarm Failed to Arm. (Partition %d)" %
-                            int(dat))
-            self.triggerEvent('eventFailToArm')
-            self.speak('speakTextFailedToArm')
-
-        elif cmd == '673':  # Partition Busy
-            self.logger.log(3, "Partition %d Busy." % int(dat))
-
-        elif cmd == '700':  # User Closing
-            m = re.search(r'^(.)(....)$', dat)
-            if m:
-                (partition, user) = (int(m.group(1)), m.group(2))
-                self.logger.log(1, "Alarm armed by user %s. (Partition %d)" %
-                                (user, partition))
-                for trig in self.triggerList:
-                    trigger = indigo.triggers[trig]
-                    if trigger.pluginTypeId == 'userArmed':
-                        if trigger.pluginProps['userCode'] == user:
-                            indigo.trigger.execute(trigger.id)
-
-        elif cmd == '701':  # Special Closing
-            partition = int(dat)
-            self.logger.log(1, "Alarm armed by one of the following methods: "
-                            "Quick Arm, Auto Arm, Keyswitch, DLS software, "
-                            "Wireless Key. (Partition %d)" % partition)
-
-        elif cmd == '702':  # Partial Closing
-            partition = int(dat)
-            self.logger.log(1, "Alarm armed but one or more zones have been "
-                            "bypassed. (Partition %d)" % partition)
-
-        elif cmd == '750':  # User Opening
-            m = re.search(r'^(.)(....)$', dat)
-            if m:
-                (partition, user) = (int(m.group(1)), m.group(2))
-                self.logger.log(1,
-                                "Alarm disarmed by user %s. (Partition %d)" %
-                                (user, partition))
-                for trig in self.triggerList:
-                    trigger = indigo.triggers[trig]
-                    if trigger.pluginTypeId == 'userDisarmed':
-                        if trigger.pluginProps['userCode'] == user:
-                            indigo.trigger.execute(trigger.id)
-
-        elif cmd == '751':  # Special Opening
-            partition = int(dat)
-            self.logger.log(1, "Alarm disarmed by one of the following "
-                            "methods: Quick Arm, Auto Arm, Keyswitch, "
-                            "DLS software, Wireless Key. (Partition %d)" %
-                            partition)
-
-        elif cmd == '800':  # Panel Battery Trouble
-            self.logger.log(1, "Alarm panel battery is low.")
-            self.sendTroubleEmail("Alarm panel battery is low.")
-
-        elif cmd == '801':  # Panel Battery Trouble Restore
-            self.logger.log(1, "Alarm panel battery is now ok.")
-            self.sendTroubleEmail("Alarm panel battery is now ok.")
-
-        elif cmd == '802':  # Panel AC Trouble
-            self.logger.log(1, "AC Power Lost.")
-            self.sendTroubleEmail("AC Power Lost.")
-            self.triggerEvent('eventNoticeAC_Trouble')
-
-        elif cmd == '803':  # Panel AC Restore
-            self.logger.log(1, "AC Power Restored.")
-            self.sendTroubleEmail("AC Power Restored.")
-            self.triggerEvent('eventNoticeAC_Restore')
-
-        elif cmd == '806':  # System Bell Trouble
-            self.logger.log(1, "An open circuit has been detected across "
-                               "the bell terminals.")
-            self.sendTroubleEmail("An open circuit has been detected across "
-                                  "the bell terminals.")
-
-        elif cmd == '807':  # System Bell Trouble Restoral
-            self.logger.log(1, "The bell circuit has been restored.")
-            self.sendTroubleEmail("The bell circuit has been restored.")
-
-        elif cmd == '810':  # TLM Line 1 Trouble
-            self.logger.log(1, "The phone line is in an open or "
-                            "shorted condition.")
-            self.sendTroubleEmail("The phone line is in an open or "
-                                  "shorted condition.")
-
-        elif cmd == '811':  # TLM Line 1 Trouble Restored
-            self.logger.log(1, "The phone line trouble condition has been "
-                            "restored.")
-            self.sendTroubleEmail("The phone line trouble condition has been "
-                                  "restored.")
-
-        elif cmd == '812':  # TLM Line 2 Trouble
-            self.logger.log(1, "The secondary phone line is in an open or "
-                            "shorted condition.")
-            self.sendTroubleEmail("The secondary phone line is in an open or "
-                                  "shorted condition.")
-
-        elif cmd == '813':  # TLM Line 2 Trouble Restored
-            self.logger.log(1, "The secondary phone line trouble condition "
-                            "has been restored.")
-            self.sendTroubleEmail("The secondary phone line trouble condition "
-                                  "has been restored.")
-
-        elif cmd == '814':  # FTC Trouble
-            # Not implemented
-            self.logger.log(1, "FTC Trouble. Not implemented!")
-
-        elif cmd == '816':  # Buffer Near Full
-            # Not implemented
-            self.logger.log(1, "Buffer Near Full. Not implemented!")
-
-        elif cmd == '821':  # General Device Low Battery
-            # Not implemented
-            self.logger.log(1, "General Device Low Battery. Not implemented!")
-
-        elif cmd == '822':  # General Device Low Battery Restore
-            # Not implemented
-            self.logger.log(1, "General Device Low Battery Restore. "
-                            "Not implemented!")
-
-        elif cmd == '825':  # Wireless Key Low Battery Trouble
-            # Not implemented
-            self.logger.log(1, "Wireless Key Low Battery Trouble. "
-                            "Not implemented!")
-
-        elif cmd == '826':  # Wireless Key Low Battery Trouble Restore
-            # Not implemented
-            self.logger.log(1, "Wireless Key Low Battery Trouble Restore. "
-                            "Not implemented!")
-
-        elif cmd == '827':  # Handheld Keypad Low Battery Trouble
-            # Not implemented
-            self.logger.log(1, "Handheld Keypad Low Battery Trouble. "
-                            "Not implemented!")
-
-        elif cmd == '828':  # Handheld Keypad Low Battery Trouble Restore
-            # Not implemented
-            self.logger.log(1, "Handheld Keypad Low Battery Trouble Restore. "
-                            "Not implemented!")
-
-        elif cmd == '829':  # General System Tamper
-            # Not implemented
-            self.logger.log(1, "General System Tamper. "
-                            "Not implemented!")
-
-        elif cmd == '830':  # General System Tamper Restore
-            # Not implemented
-            self.logger.log(1, "General System Tamper Restore. "
-                            "Not implemented!")
-
-        elif cmd == '831':  # Home Automation Trouble
-            # Not implemented
-            self.logger.log(1, "Home Automation Trouble. "
-                            "Not implemented!")
-
-        elif cmd == '832':  # Home Automation Trouble Restore
-            # Not implemented
-            self.logger.log(1, "Home Automation Trouble Restore. "
-                            "Not implemented!")
-
-        elif cmd == '840':  # Trouble Status (LED ON)
-            self.logger.log(1, "Trouble Status (LED ON). (Partition %d)" %
-                            int(dat))
-            self.troubleClearedTimer = 0
-
-        elif cmd == '841':  # Trouble Status Restore (LED OFF)
-            self.logger.log(2, "Trouble Status Restore (LED OFF). "
-                            "(Partition %d)" % int(dat))
-            if self.troubleCode > 0:
-                # If the trouble light goes off, set a 10 second timer.
-                # If the light is still off after 10 seconds we'll clear our
-                # status- This is required because the panel turns the light
-                # off/on quickly when the light is actually on.
-                self.troubleClearedTimer = 10
-
-        elif cmd == '842':  # Fire Trouble Alarm
-            # Not implemented
-            self.logger.log(1, "Fire Trouble Alarm. "
-                            "Not implemented!")
-
-        elif cmd == '843':  # Fire Trouble Alarm Restore
-            # Not implemented
-            self.logger.log(1, "Fire Trouble Alarm Restore. "
-                            "Not implemented!")
-
-        elif cmd == '900':  # Code Required
-            self.logger.logError("Code Required")
-
-        elif cmd == '901':  # LCD Update
-            # for char in dat:
-            #     self.logger.log(3, u"LCD DEBUG: %d" % ord(char))
-            m = re.search(r'^...(..)(.*)$', dat)
-            if m:
-                lcdText = re.sub(r'[^ a-zA-Z0-9_/\:-]+', ' ', m.group(2))
-                half = len(lcdText) / 2
-                half1 = lcdText[:half]
-                half2 = lcdText[half:]
-                self.logger.log(3, "LCD Update, Line 1:'%s' Line 2:'%s'" %
-                                (half1, half2))
-                self.updateKeypad(0, 'LCDLine1', half1)
-                self.updateKeypad(0, 'LCDLine2', half2)
-
-        elif cmd == '902':  # LCD Cursor
-            # Not implemented
-            self.logger.log(1, "LCD Cursor. "
-                            "Not implemented!")
-
-        elif cmd == '903':  # LED Status
-            m = re.search(r'^(.)(.)$', dat)
-            if m:
-                (ledName, ledState) = (LED_INDEX_LIST[int(m.group(1))],
-                                       LED_STATE_LIST[int(m.group(2))])
-                self.logger.log(3, "LED '%s' is '%s'." % (ledName, ledState))
-
-                if ledState == 'flashing':
-                    ledState = 'on'
-                if ledName == 'Ready':
-                    self.updateKeypad(0, 'LEDReady', ledState)
-                elif ledName == 'Armed':
-                    self.updateKeypad(0, 'LEDArmed', ledState)
-                elif ledName == 'Trouble':
-                    self.updateKeypad(0, 'LEDTrouble', ledState)
-
-        else:  # Unrecognized command
-            # self.logger.log(3, "RX: %s" % data)
-            self.logger.log(2, "Unrecognized command received "
-                            "(Cmd:%s Dat:%s Sum:%d)" % (cmd, dat, sum_))
-
-        return (cmd, dat)
-
-    ###########################################################################
-    # Indigo Device State Updating
-    ###########################################################################
-
-    # Updates temperature of DSC temperature sensor
-    def updateSensorTemp(self, sensorNum, key, temp):
-        if temp > 127:
-            temp = 127 - temp
-        self.logger.log(3, "Temp sensor %d %s temp now %d degrees." %
-                        (sensorNum, key, temp))
-        if sensorNum in list(self.tempList.keys()):
-            if key == 'inside':
-                self.tempList[sensorNum]. \
-                    updateStateOnServer(key="temperatureInside", value=temp)
-            elif key == 'outside':
-                self.tempList[sensorNum]. \
-                    updateStateOnServer(key="temperatureOutside", value=temp)
-            elif key == 'cool':
-                self.tempList[sensorNum]. \
-                    updateStateOnServer(key="setPointCool", value=temp)
-            elif key == 'heat':
-                self.tempList[sensorNum]. \
-                    updateStateOnServer(key="setPointHeat", value=temp)
-
-            if self.tempList[sensorNum].pluginProps['zoneLogChanges'] == 1:
-                self.logger.log(1, "Temp sensor %d %s temp now %d degrees." %
-                                (sensorNum, key, temp))
-
-    # Updates zone group
-    def updateZoneGroup(self, zoneGroupDevId):
-        zoneGrp = indigo.devices[zoneGroupDevId]
-        zoneGrp.updateStateOnServer(key="AnyMemberLastChangedTimer", value=0)
-        newState = ZONE_GROUP_STATE_CLOSED
-        for zoneId in self.zoneGroupList[zoneGroupDevId]:
-            zoneState = indigo.devices[int(zoneId)].states['state']
-            if zoneState != ZONE_STATE_CLOSED and \
-                    newState != ZONE_GROUP_STATE_TRIPPED:
-                if zoneState == ZONE_STATE_OPEN:
-                    newState = ZONE_GROUP_STATE_OPEN
-                elif zoneState == ZONE_STATE_TRIPPED:
-                    newState = ZONE_GROUP_STATE_TRIPPED
-
-        if zoneGrp.states['state'] != newState:
-            zoneGrp.updateStateOnServer(key="EntireGroupLastChangedTimer",
-                                        value=0)
-            zoneGrp.updateStateOnServer(key="state",
-                                        value=newState)
-
-    # Updates indigo variable instance var with new value varValue
-    def updateZoneState(self, zoneKey, newState):
-
-        if zoneKey in list(self.zoneList.keys()):
-            zone = indigo.devices[self.zoneList[zoneKey]]
-            # zoneType = zone.pluginProps['zoneType']
-
-            # If the new state is different from the old state
-            # then lets update timers and set the new state
-            if zone.states['state'] != newState:
-                # This is a new state, update all states and timers
-                zone.updateStateOnServer(key="LastChangedShort", value="0m")
-                zone.updateStateOnServer(key="LastChangedTimer", value=0)
-                zone.updateStateOnServer(key="state", value=newState)
-
-                # Check if this zone is assigned to a zone group
-                # so we can update it
-                for devId in self.zoneGroupList:
-                    # self.logger.log(3, "Zone Group id: %s contains %s" %
-                    #                 (zone.id,self.zoneGroupList[devId]))
-                    if str(zone.id) in self.zoneGroupList[devId]:
-                        self.updateZoneGroup(devId)
-
-                if 'var' in list(zone.pluginProps.keys()):
-                    self.updateVariable(zone.pluginProps['var'], newState)
-
-                if newState == ZONE_STATE_TRIPPED:
-                    self.logger.log(1, "Alarm Zone '%s' TRIPPED!" % zone.name)
-
-                if zone.pluginProps['zoneLogChanges'] == 1:
-                    if newState == ZONE_STATE_OPEN:
-                        self.logger.log(1, "Alarm Zone '%s' Opened." %
-                                        zone.name)
-                    elif newState == ZONE_STATE_CLOSED:
-                        self.logger.log(1, "Alarm Zone '%s' Closed." %
-                                        zone.name)
-
-    def updateKeypad(self, partition, stateName, newState):
-
-        self.logger.log(4, "Updating state %s for keypad "
-                        "on partition %u to %s." %
-                        (stateName, partition, newState))
-
-        # If we're updating the main keypad state, update the variable too
-        if stateName == 'state':
-            self.updateVariable(self.pluginPrefs['variableState'], newState)
-
-        if partition == 0:
-            for keyk in list(self.keypadList.keys()):
-                keyp = indigo.devices[self.keypadList[keyk]]
-                keyp.updateStateOnServer(key=stateName, value=newState)
-            return
-
-        if partition in list(self.keypadList.keys()):
-            keyp = indigo.devices[self.keypadList[partition]]
-            keyp.updateStateOnServer(key=stateName, value=newState)
-
-    ###########################################################################
-    # Misc
-    ###########################################################################
-    def sendZoneTrippedEmail(self):
-
-        if len(self.configEmailUrgent) == 0 or len(self.trippedZoneList == 0):
-            return
-
-        theBody = "The following zone(s) have been tripped:\n\n"
-
-        for zoneNum in self.trippedZoneList:
-
-            if zoneNum in self.closeTheseZonesList:
-                stateNow = "closed"
-            else:
-                stateNow = "open"
-
-            zone = indigo.devices[self.zoneList[zoneNum]]
-
-            theBody += "%s (currently %s)\n" % (zone.name, stateNow)
-
-        theBody += "\n--\nDSC Alarm Plugin\n\n"
-
-        self.logger.log(1, "Sending zone tripped email to %s." %
-                        self.configEmailUrgent)
-
-        contentPrefix = self.pluginPrefs.get('emailUrgentContent', '')
-        if len(contentPrefix) > 0:
-            theBody = contentPrefix + "\n\n" + theBody
-
-        indigo.server.sendEmailTo(self.configEmailUrgent,
-                                  subject=self.configEmailUrgentSubject,
-                                  body=theBody)
-
-    def sendTroubleEmail(self, bodyText):
-        if len(self.configEmailNotice) == 0:
-            return
-
-        self.logger.log(1, "Sending trouble email to %s." %
-                        self.configEmailNotice)
-
-        contentPrefix = self.pluginPrefs.get('updaterEmailContent', '')
-        if len(contentPrefix) > 0:
-            bodyText = contentPrefix + "\n\n" + bodyText
-
-        indigo.server.sendEmailTo(self.configEmailNotice,
-                                  subject=self.configEmailNoticeSubject,
-                                  body=bodyText)
-
-    def sayThis(self, text):
-        self.logger.log(3, "SAY: %s" % text)
-        if self.configSpeakVariable is not None:
-            if self.configSpeakVariable in indigo.variables:
-                indigo.variable.updateValue(self.configSpeakVariable,
-                                            value=text)
-        else:
-            indigo.server.speak(text)
-
-    def speak(self, textId):
-        self.logger.log(3, "ID: %s" % textId)
-        if self.pluginPrefs['speakingEnabled'] is False:
-            return
-
-        if len(self.pluginPrefs[textId]) == 0:
-            return
-
-        if textId == 'speakTextFailedToArm':
-            zones = 0
-            zoneText = ''
-            for zoneNum in list(self.zoneList.keys()):
-                zone = indigo.devices[self.zoneList[zoneNum]]
-                if zone.states['state.open'] is True:
-                    if zones > 0:
-                        zoneText += ', '
-                    zoneText += zone.name.replace("Alarm_", "")
-                    zones += 1
-
-            if zones == 0:
-                say = self.pluginPrefs[textId]
-            if zones == 1:
-                say = self.pluginPrefs[textId] + \
-                    '  The ' + zoneText + ' is open.'
-            else:
-                say = self.pluginPrefs[textId] + \
-                    '  The following zones are open: ' + zoneText + '.'
-
-            self.sayThis(say)
-
-        elif textId == 'speakTextTripped':
-            zones = 0
-            zoneText = ''
-            for zoneNum in self.trippedZoneList:
-                zone = indigo.devices[self.zoneList[zoneNum]]
-                if zones > 0:
-                    zoneText += ', '
-                zoneText += zone.name.replace("Alarm_", "")
-                zones += 1
-            if zones == 1:
-                say = self.pluginPrefs[textId] + \
-                    '  The ' + zoneText + ' has been tripped.'
-            else:
-                say = self.pluginPrefs[textId] + \
-                    '  The following zones have been tripped: ' + \
-                    zoneText + '.'
-            self.sayThis(say)
-        else:
-            self.sayThis(self.pluginPrefs[textId])
-
-    # Updates indigo variable instance var with new value varValue
-    def updateVariable(self, varID, varValue):
-        if self.createVariables is False:
-            return
-        self.logger.log(3, "Variable: %s" % varID)
-        if varID is None:
-            return
-        if varID in indigo.variables:
-            indigo.variable.updateValue(varID, value=varValue)
-
-    # Converts given time in minutes to a human format
-    # 3m, 5h, 2d, etc.
-    def getShortTime(self, minutes):
-        # If time is less than an hour then show XXm
-        if minutes < 60:
-            return str(minutes) + 'm'
-        # If it's less than one day then show XXh
-        elif minutes < 1440:
-            return str(int(minutes / 60)) + 'h'
-        # If it's less than one hundred days then show XXd
-        elif minutes < 43200:
-            return str(int(minutes / 1440)) + 'd'
-        # If it's anything more than one hundred days then show nothing
-        else:
-            return ''
+    # Serves metrics on http://localhost:port/metrics, port 0 turns it off
+    def setHttpPort(self, port):
+        if self.httpServer is not None:
+            if self.httpServer.port == port:
+                return
+            self.httpServer.stop()
+            self.httpServer = None
+        if port > 0:
+            server = dscHttp.HttpServer(port)
+            self.engine.addHttpRoutes(server)
+            try:
+                server.start()
+            except (IOError, OSError) as err:
+                self.logger.logError('Error starting metrics server: %s' %
+                                     (str(err)))
+                return
+            self.httpServer = server
+            self.logger.log(1, "Serving metrics on port %u" % port)
 
     ###########################################################################
     # Concurrent Thread
     ###########################################################################
     def runConcurrentThread(self):
         self.logger.log(3, "runConcurrentThread called")
-        self.minuteTracker = time.time() + 60
-        self.nextUpdateCheckTime = 0
-
-        # While Indigo hasn't told us to shutdown
-        while self.shutdown is False:
-
-            self.timeNow = time.time()
-
-            if self.state == self.States.STARTUP:
-                self.logger.log(3, "STATE: Startup")
-
-                if self.configRead is False:
-                    if self.getConfiguration(self.pluginPrefs) is True:
-                        self.configRead = True
-
-                if self.configRead is True:
-                    self.state = self.States.BOTH_INIT
-
-                self.sleep(1)
-
-            elif self.state == self.States.HOLD:
-                if self.configRead is False:
-                    self.state = self.States.STARTUP
-                self.sleep(1)
-
-            elif self.state == self.States.HOLD_RETRY:
-                self.logger.log(1, "Plugin will attempt to re-initialize "
-                                "again in %u minutes." %
-                                self.currentHoldRetryTime)
-                self.nextRetryTime = self.timeNow + \
-                    (HOLD_RETRY_TIME_MINUTES * 60)
-                self.state = self.States.HOLD_RETRY_LOOP
-
-            elif self.state == self.States.HOLD_RETRY_LOOP:
-                if self.configRead is False:
-                    self.state = self.States.STARTUP
-                if self.timeNow >= self.nextRetryTime:
-                    self.state = self.States.BOTH_INIT
-                self.sleep(1)
-
-            elif self.state == self.States.BOTH_INIT:
-                if self.openPort() is True:
-                    self.state = self.States.ENABLE_TIME_BROADCAST
-                else:
-                    self.logger.logError('Error opening port, will retry in '
-                                         '%u minutes.' %
-                                         self.currentHoldRetryTime)
-                    self.state = self.States.HOLD_RETRY
-
-            elif self.state == self.States.ENABLE_TIME_BROADCAST:
-                # Enable time broadcast
-                self.logger.log(2, "Enabling Time Broadcast")
-                rx = self.sendPacket('0561')
-                if len(rx) > 0:
-                    self.logger.log(2, "Time Broadcast enabled.")
-                    self.state = self.States.BOTH_PING
-                else:
-                    self.logger.logError('Error enabling Time Broadcast.')
-                    self.state = self.States.HOLD_RETRY
-
-            elif self.state == self.States.BOTH_PING:
-                # Ping the panel to confirm we are in communication
-                err = True
-                self.logger.log(2, "Pinging the panel to test "
-                                "communication...")
-                rx = self.sendPacket('000')
-                if len(rx) > 0:
-                    self.logger.log(2, "Ping was successful.")
-                    err = False
-                else:
-                    self.logger.logError('Error pinging panel, aborting.')
-
-                if err is True:
-                    self.state = self.States.HOLD_RETRY
-                else:
-                    # Request a full state update
-                    self.logger.log(2, "Requesting a full state update.")
-                    rx = self.sendPacket('001')
-                    if len(rx) == 0:
-                        self.logger.logError('Error getting state update.')
-                        self.state = self.States.HOLD_RETRY
-                    else:
-                        self.logger.log(2, "State update request successful, "
-                                        "initialization complete, "
-                                        "starting normal operation.")
-                        self.state = self.States.BOTH_POLL
-
-            elif self.state == self.States.BOTH_POLL:
-                if self.configRead is False:
-                    self.state = self.States.STARTUP
-                else:
-                    if len(self.txCmdList) > 0:
-                        (cmdType, data) = self.txCmdList[0]
-                        if cmdType == CMD_NORMAL:
-                            txRsp = self.sendPacket(data)
-                            if txRsp == '-':
-                                # If we receive - socket has closed,
-                                # lets re-init
-                                self.logger.logError('Tried to send data but '
-                                                     'socket seems to have '
-                                                     'closed.  Trying to '
-                                                     're-initialize.')
-                                self.state = self.States.BOTH_INIT
-                            else:
-                                # send was a success, remove command from queue
-                                del self.txCmdList[0]
-
-                        elif cmdType == CMD_THERMO_SET:
-                            self.setThermostat(data)
-                    else:
-                        (rxRsp, rxData) = self.readPacket()
-                        if rxRsp == '-':
-                            # If we receive - socket has closed, lets re-init
-                            self.logger.logError('Tried to read data but '
-                                                 'socket seems to have '
-                                                 'closed. Trying to '
-                                                 're-initialize.')
-                            self.state = self.States.BOTH_INIT
-
-            # Check if the trouble timer counter is timing
-            # We need to know if the trouble light has remained off
-            # for a few seconds before we assume the trouble is cleared
-            if self.troubleClearedTimer > 0:
-                self.troubleClearedTimer -= 1
-                if self.troubleClearedTimer == 0:
-                    self.troubleCode = 0
-                    self.sendTroubleEmail("Trouble Code Cleared")
-
-            if self.repeatAlarmTripped is True:
-                # timeNow = time.time()
-                if self.timeNow >= self.repeatAlarmTrippedNext:
-                    self.repeatAlarmTrippedNext = self.timeNow + 12
-                    self.speak('speakTextTripped')
-
-            # If a minute has elapsed
-            if self.timeNow >= self.minuteTracker:
-
-                # Do we need to check for a new version?
-                self.updater.checkVersionPoll()
-
-                # Increment all zone changed timers
-                self.minuteTracker += 60
-                for zoneKey in list(self.zoneList.keys()):
-                    zone = indigo.devices[self.zoneList[zoneKey]]
-                    tmr = zone.states["LastChangedTimer"] + 1
-                    zone.updateStateOnServer(key="LastChangedTimer",
-                                             value=tmr)
-                    zone.updateStateOnServer(key="LastChangedShort",
-                                             value=self.getShortTime(tmr))
-
-                for zoneGroupDeviceId in self.zoneGroupList:
-                    zoneGroupDevice = indigo.devices[zoneGroupDeviceId]
-                    tmr = zoneGroupDevice. \
-                        states["AnyMemberLastChangedTimer"] + 1
-                    zoneGroupDevice. \
-                        updateStateOnServer(key="AnyMemberLastChangedTimer",
-                                            value=tmr)
-                    tmr = zoneGroupDevice. \
-                        states["EntireGroupLastChangedTimer"] + 1
-                    zoneGroupDevice. \
-                        updateStateOnServer(key="EntireGroupLastChangedTimer",
-                                            value=tmr)
-
-        self.closePort()
+        self.engine.run()
+        self.setHttpPort(0)
         self.logger.log(3, "Exiting Concurrent Thread")
 
     def stopConcurrentThread(self):
         self.logger.log(3, "stopConcurrentThread called")
-        self.shutdown = True
+        self.engine.stop()
         self.logger.log(3, "Exiting stopConcurrentThread")
@@ -0,0 +1,131 @@
+#######################################################################
+# DSC Alarm command batches
+#
+# Lets a client such as an HC2 scene send several actions in one
+# request instead of paying a round trip for each:
+#
+#   POST /commands
+#   {"timeout": 20,
+#    "commands": [{"action": "armStay", "partitions": [1, 2, 3]},
+#                 {"action": "thermostat", "sensor": 1, "which": "heat",
+#                  "adjust": "=", "setPoint": 21}]}
+#
+# action is armStay, armAway, disarm (partition or partitions, 1 by
+# default), panic (type fire, ambulance or panic), keypress (keys) or
+# thermostat (sensor, which cool or heat, adjust +, - or = and setPoint).
+# An action for several partitions becomes one command per partition.
+#
+# All commands are checked before any is queued, so a batch with a
+# mistake in it is rejected as a whole. Otherwise they go on the
+# transmit queue back to back and the reply comes once the panel has
+# answered each of them:
+#
+#   {"ok": true, "results": [{"action": "armStay", "partition": 1,
+#                             "result": "acked"}, ...]}
+#
+# result is acked, failed, or timeout for a command still unsent when
+# the batch timed out. Those are dropped from the queue, so a batch that
+# was held up never arms the house minutes after it was asked to.
+#######################################################################
+
+import threading
+import time
+
+BATCH_TIMEOUT = 30  # Default seconds for a whole batch
+BATCH_MAX_TIMEOUT = 120
+BATCH_MAX_COMMANDS = 32
+# Extra seconds to wait for the panel to answer a command sent just
+# before the deadline
+BATCH_GRACE = 10
+
+RESULT_ACKED = 'acked'
+RESULT_FAILED = 'failed'
+RESULT_TIMEOUT = 'timeout'
+RESULT_PENDING = 'pending'
+
+
+# Checks the decoded body of a batch request, {"commands": [...],
+# "timeout": N} as above, against the limits every way in to the panel
+# keeps to. Returns (commands, timeout in seconds), raises ValueError if
+# it isn't a batch.
+def parseBatch(body):
+    if not isinstance(body, dict) or not isinstance(body.get('commands'),
+                                                    list):
+        raise ValueError('expected an object with a list of commands')
+    specs = body['commands']
+    if not 0 < len(specs) <= BATCH_MAX_COMMANDS:
+        raise ValueError('a batch takes 1 to %u commands' %
+                         BATCH_MAX_COMMANDS)
+    try:
+        timeout = float(body.get('timeout', BATCH_TIMEOUT))
+    except (TypeError, ValueError):
+        raise ValueError('timeout must be a number of seconds')
+    return (specs, max(0, min(timeout, BATCH_MAX_TIMEOUT)))
+
+
+class BatchCommand(object):
+
+    # frames are (cmdType, data) to queue for the engine, all have to be
+    # acknowledged for the command to be
+    def __init__(self, action, frames, partition=None, sensor=None):
+        self.action = action
+        self.frames = frames
+        self.partition = partition
+        self.sensor = sensor
+        self.waiting = len(frames)
+        self.result = None
+
+    def report(self):
+        d = {'action': self.action, 'result': self.result or RESULT_PENDING}
+        if self.partition is not None:
+            d['partition'] = self.partition
+        if self.sensor is not None:
+            d['sensor'] = self.sensor
+        return d
+
+
+class CommandBatch(object):
+
+    def __init__(self, commands, timeout=BATCH_TIMEOUT):
+        self.commands = commands
+        self.deadline = time.time() + timeout
+        self.waiting = len(commands)
+        self.done = threading.Event()
+        if self.waiting == 0:
+            self.done.set()
+
+    # Called from the engine thread before a frame of command is sent.
+    # Returns False if it shouldn't be, because an earlier frame of the
+    # command failed or the batch has timed out.
+    def shouldSend(self, command, now):
+        if command.result is None and now >= self.deadline:
+            self.resolve(command, RESULT_TIMEOUT)
+        return command.result is None
+
+    # Called from the engine thread once the panel has answered a frame
+    def frameSent(self, command, acked):
+        if command.result is not None:
+            return
+        if acked is False:
+            self.resolve(command, RESULT_FAILED)
+            return
+        command.waiting -= 1
+        if command.waiting == 0:
+            self.resolve(command, RESULT_ACKED)
+
+    def resolve(self, command, result):
+        command.result = result
+        self.waiting -= 1
+        if self.waiting == 0:
+            self.done.set()
+
+    # Waits until every command has been answered or dropped, returns
+    # False if that didn't happen in time
+    def wait(self):
+        remaining = self.deadline - time.time()
+        return self.done.wait(max(0, remaining) + BATCH_GRACE)
+
+    def report(self):
+        results = [command.report() for command in self.commands]
+        return {'ok': all(r['result'] == RESULT_ACKED for r in results),
+                'results': results}
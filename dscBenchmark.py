@@ -0,0 +1,205 @@
+#!/usr/bin/python3
+#######################################################################
+# DSC Alarm hot path benchmarks
+#
+# Measures the decode -> dispatch -> state update path against the
+# stand-in devices from dscStubHost.py and prints the results as JSON.
+# Pass --baseline with an earlier result to fail on regressions:
+#
+#   ./dscBenchmark.py --output before.json
+#   ...change something...
+#   ./dscBenchmark.py --baseline before.json --tolerance 0.15
+#######################################################################
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+import dscCodec
+import dscCore
+import dscReplay
+import dscSimulator
+import dscStubHost
+
+GROUP_COUNTS = [0, 4, 16]
+
+# One representative frame per command class, without checksum
+DISPATCH_FRAMES = {'500': '500070',
+                   '550': '5501230010119',
+                   '561': '5611025',
+                   '563': '5631024020',
+                   '652': '65211',
+                   '655': '6551',
+                   '673': '6731',
+                   '841': '8411',
+                   '901': '90110032System is Ready to Arm          ',
+                   '903': '90310'}
+
+
+def frame(data):
+    return '%s%02X' % (data, dscCodec.calcChecksum(data))
+
+
+# Runs func(i) number times per repeat and returns seconds per call,
+# taking the minimum and median over the repeats
+def measure(func, number, repeat):
+    runs = []
+    for r in range(repeat):
+        start = time.perf_counter()
+        for i in range(number):
+            func(i)
+        runs.append((time.perf_counter() - start) / number)
+    runs.sort()
+    return {'nsPerOp': runs[len(runs) // 2] * 1e9,
+            'minNsPerOp': runs[0] * 1e9,
+            'ops': number,
+            'repeat': repeat}
+
+
+def newSite(groups=4):
+    (host, engine) = dscStubHost.newEngine()
+    dscStubHost.buildSite(engine, zones=64, groups=groups,
+                          keypads=1, sensors=4)
+    return (host, engine)
+
+
+def benchChecksum(results, number, repeat):
+    (host, engine) = newSite()
+    data = [f[:-2] for f in (frame('609001'),
+                             frame(DISPATCH_FRAMES['901']))]
+    results['checksum'] = measure(
+        lambda i: dscCodec.calcChecksum(data[i & 1]), number, repeat)
+
+
+def benchDecode(results, number, repeat):
+    (host, engine) = newSite()
+    lines = [frame(d) + '\r\n' for d in ['609001', '610001'] +
+             list(DISPATCH_FRAMES.values())]
+    count = len(lines)
+    results['decode'] = measure(
+        lambda i: engine.decodePacket(lines[i % count]), number, repeat)
+
+
+def benchDispatch(results, number, repeat):
+    (host, engine) = newSite()
+    for (cmd, data) in sorted(DISPATCH_FRAMES.items()):
+        dat = data[3:]
+        results['dispatch.%s' % cmd] = measure(
+            lambda i: engine.processPacket(cmd, dat), number, repeat)
+
+    # Zone changes are only processed when the state actually changes,
+    # so alternate between open and closed
+    def zoneToggle(i):
+        zone = '%03d' % (i % 64 + 1)
+        engine.processPacket('609', zone)
+        engine.processPacket('610', zone)
+    result = measure(zoneToggle, number, repeat)
+    result['nsPerOp'] /= 2
+    result['minNsPerOp'] /= 2
+    result['ops'] *= 2
+    results['dispatch.609/610'] = result
+
+
+def benchFanOut(results, number, repeat):
+    for groups in GROUP_COUNTS:
+        (host, engine) = newSite(groups)
+        states = [dscCore.ZONE_STATE_OPEN, dscCore.ZONE_STATE_CLOSED]
+
+        def zoneChange(i):
+            engine.updateZoneState(i % 64 + 1, states[(i // 64) & 1])
+        results['fanOut.64zones.%dgroups' % groups] = measure(
+            zoneChange, number, repeat)
+
+
+def benchMinuteSweep(results, number, repeat):
+    for groups in GROUP_COUNTS:
+        (host, engine) = newSite(groups)
+        results['minuteSweep.64zones.%dgroups' % groups] = measure(
+            lambda i: engine.updateTimers(), max(1, number // 100), repeat)
+
+
+def benchStatusDump(results, number, repeat):
+    (host, engine) = newSite()
+    sim = dscSimulator.PanelSimulator(zones=64)
+    sim.openZones = set(range(1, 65, 3))
+    records = [(0, frame(d).encode('ascii')) for d in
+               ['500001'] + sim.statusDump()]
+
+    def statusDump(i):
+        engine.port = dscReplay.ReplayPort(records, 0)
+        while not engine.port.done():
+            engine.readPacket()
+    results['statusDump.64zones'] = measure(
+        statusDump, max(1, number // 100), repeat)
+    results['statusDump.64zones']['framesPerOp'] = len(records)
+
+
+BENCHMARKS = [('checksum', benchChecksum),
+              ('decode', benchDecode),
+              ('dispatch', benchDispatch),
+              ('fanOut', benchFanOut),
+              ('minuteSweep', benchMinuteSweep),
+              ('statusDump', benchStatusDump)]
+
+
+def runBenchmarks(only=None, number=2000, repeat=5):
+    results = {}
+    for (name, func) in BENCHMARKS:
+        if only is None or name in only:
+            func(results, number, repeat)
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.time(),
+            'results': results}
+
+
+# Returns a list of (name, baseline ns, current ns) that got slower
+# than tolerance allows
+def findRegressions(baseline, current, tolerance):
+    regressions = []
+    for (name, result) in current['results'].items():
+        if name not in baseline['results']:
+            continue
+        before = baseline['results'][name]['nsPerOp']
+        if result['nsPerOp'] > before * (1 + tolerance):
+            regressions.append((name, before, result['nsPerOp']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DSC hot path benchmarks')
+    parser.add_argument('--only', action='append',
+                        choices=[name for (name, func) in BENCHMARKS])
+    parser.add_argument('--number', type=int, default=2000,
+                        help='operations per repeat')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--baseline', help='results JSON to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.10,
+                        help='allowed slowdown before failing, 0.10 = 10%%')
+    args = parser.parse_args()
+
+    current = runBenchmarks(args.only, args.number, args.repeat)
+    text = json.dumps(current, indent=2, sort_keys=True)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = findRegressions(baseline, current, args.tolerance)
+        for (name, before, after) in regressions:
+            sys.stderr.write("REGRESSION %s: %.0f ns -> %.0f ns (+%.0f%%)\n" %
+                             (name, before, after,
+                              (after / before - 1) * 100))
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+#######################################################################
+# DSC Alarm wire traffic capture
+#
+# Records every raw frame sent to and received from the IT-100 with a
+# monotonic timestamp, so production traffic can be replayed later
+# with dscReplay.py.
+#
+# File layout:
+#   header  b'DSCCAP1\n' followed by the wall clock start time as a
+#           little endian double
+#   record  varint(microseconds since previous record)
+#           varint(frame length << 1 | direction)
+#           frame bytes as they were on the wire, without CR/LF
+#
+# Varints are unsigned LEB128, so a typical record costs 3-4 bytes on
+# top of the frame itself.
+#######################################################################
+
+import struct
+import time
+
+CAPTURE_MAGIC = b'DSCCAP1\n'
+CAPTURE_RX = 0
+CAPTURE_TX = 1
+
+
+def encodeVarint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def decodeVarint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise EOFError()
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return (value, pos)
+        shift += 7
+
+
+class CaptureWriter(object):
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.file = open(fileName, 'wb', 65536)
+        self.file.write(CAPTURE_MAGIC)
+        self.file.write(struct.pack('<d', time.time()))
+        self.last = time.monotonic()
+        self.frames = 0
+
+    # Records one frame. Called from the serial thread, so this only
+    # appends to the file buffer and never flushes on its own.
+    def write(self, direction, frame):
+        now = time.monotonic()
+        delta = int((now - self.last) * 1000000)
+        self.last += delta / 1000000.0
+        frame = frame.rstrip(b'\r\n')
+        self.file.write(encodeVarint(delta) +
+                        encodeVarint(len(frame) << 1 | direction) + frame)
+        self.frames += 1
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class CaptureReader(object):
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, 'rb') as f:
+            self.data = f.read()
+        if self.data[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+            raise ValueError("%s is not a DSC capture file" % fileName)
+        (self.startTime,) = struct.unpack_from('<d', self.data,
+                                               len(CAPTURE_MAGIC))
+
+    # Yields (seconds since start of capture, direction, frame bytes).
+    # A record cut short by a crash ends the iteration quietly.
+    def __iter__(self):
+        pos = len(CAPTURE_MAGIC) + 8
+        timestamp = 0
+        try:
+            while pos < len(self.data):
+                (delta, pos) = decodeVarint(self.data, pos)
+                (header, pos) = decodeVarint(self.data, pos)
+                length = header >> 1
+                if pos + length > len(self.data):
+                    return
+                timestamp += delta
+                yield (timestamp / 1000000.0, header & 1,
+                       self.data[pos:pos + length])
+                pos += length
+        except EOFError:
+            return
@@ -0,0 +1,46 @@
+#######################################################################
+# DSC Alarm IT-100 frame codec
+#
+# A frame is a 3 digit command, its data, the checksum of both as 2 hex
+# digits and CR/LF. Envisalink's TPI uses the same frames over TCP, so
+# this is shared by the engine, every transport and the simulator.
+#######################################################################
+
+import re
+
+FRAME_RE = re.compile(r'^(...)(.*)(..)$')
+
+
+class FrameError(ValueError):
+    pass
+
+
+class ChecksumError(FrameError):
+    pass
+
+
+# The sum of the characters of s, modulo 256
+def calcChecksum(s):
+    return sum(map(ord, s)) % 256
+
+
+# Returns the frame for data (command and data), ready to be sent
+def encodeFrame(data):
+    return "%s%02X\r\n" % (data, calcChecksum(data))
+
+
+# Returns (cmd, data) of a received line, None if it's too short to be a
+# frame. Raises FrameError if the checksum isn't hex, ChecksumError if
+# it doesn't match.
+def decodeFrame(line):
+    m = FRAME_RE.search(line.strip())
+    if not m:
+        return None
+    (cmd, dat) = (m.group(1), m.group(2))
+    try:
+        checksum = int(m.group(3), 16)
+    except ValueError:
+        raise FrameError('invalid characters in frame')
+    if checksum != calcChecksum(cmd + dat):
+        raise ChecksumError('checksum did not match')
+    return (cmd, dat)
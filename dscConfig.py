@@ -0,0 +1,74 @@
+#######################################################################
+# DSC Alarm engine configuration
+#
+# The prefs are checked and converted once, into a Config that is never
+# changed afterwards. The engine keeps the current one in self.config
+# and replaces it as a whole when the prefs change, so code reading it
+# never sees half an update and never looks up or converts pref keys
+# while handling frames.
+#
+# Only a change of the settings in RECONNECT_FIELDS, those that say how
+# to reach the panel, makes the engine reopen the link. Everything else
+# takes effect from the next frame on.
+#######################################################################
+
+import collections
+import types
+
+import dscOccupancy
+import dscZoneStats
+
+SPEAK_TEXT_IDS = ('speakTextArming', 'speakTextDisarmed',
+                  'speakTextEntryDelay', 'speakTextFailedToArm',
+                  'speakTextTripped')
+RECONNECT_FIELDS = ('serialPort', 'tpiPassword')
+
+Config = collections.namedtuple('Config', [
+    'serialPort', 'tpiPassword', 'code', 'logLevel', 'syncTime',
+    'keypadPartition', 'variableState',
+    'occupancyVacant', 'occupancyWindow', 'zoneStatsWindows',
+    'emailUrgent', 'emailUrgentSubject', 'emailUrgentContent',
+    'emailNotice', 'emailNoticeSubject', 'emailNoticeContent',
+    'speakingEnabled', 'speakTexts',
+    'captureFile', 'traceFile', 'tempHistoryFile', 'labelCacheFile',
+    'snapshotFile', 'profileDir'])
+
+
+# Returns the Config of prefs. Raises ValueError (or TypeError) if a
+# setting can't be converted.
+def compileConfig(prefs):
+    return Config(
+        serialPort=prefs.get('serialPort', ''),
+        tpiPassword=prefs.get('tpiPassword', ''),
+        code=prefs.get('code', ''),
+        logLevel=int(prefs.get('logLevel', 1)),
+        syncTime=prefs.get('syncTime', True),
+        keypadPartition=int(prefs.get('keypadPartition', 1)),
+        variableState=prefs.get('variableState'),
+        occupancyVacant=60 * float(prefs.get(
+            'occupancyMinutes', dscOccupancy.OCCUPANCY_VACANT_MINUTES)),
+        occupancyWindow=60 * float(prefs.get(
+            'occupancyWindowMinutes', dscOccupancy.OCCUPANCY_WINDOW_MINUTES)),
+        zoneStatsWindows=dscZoneStats.parseWindows(
+            prefs.get('zoneStatsWindows', '')),
+        emailUrgent=prefs.get('emailUrgent', ''),
+        emailUrgentSubject=prefs.get('emailUrgentSubject', 'Alarm Tripped'),
+        emailUrgentContent=prefs.get('emailUrgentContent', ''),
+        emailNotice=prefs.get('updaterEmail', ''),
+        emailNoticeSubject=prefs.get('updaterEmailSubject', 'Alarm Trouble'),
+        emailNoticeContent=prefs.get('updaterEmailContent', ''),
+        speakingEnabled=prefs.get('speakingEnabled', False) is True,
+        speakTexts=types.MappingProxyType(dict(
+            (textId, prefs.get(textId, '')) for textId in SPEAK_TEXT_IDS)),
+        captureFile=prefs.get('captureFile', ''),
+        traceFile=prefs.get('traceFile', ''),
+        tempHistoryFile=prefs.get('tempHistoryFile', ''),
+        labelCacheFile=prefs.get('labelCacheFile', ''),
+        snapshotFile=prefs.get('snapshotFile', ''),
+        profileDir=prefs.get('profileDir', ''))
+
+
+# Tells whether going from config old to new needs the link reopened
+def needsReconnect(old, new):
+    return any(getattr(old, field) != getattr(new, field)
+               for field in RECONNECT_FIELDS)
@@ -0,0 +1,2115 @@
+#######################################################################
+# DSC Alarm engine
+# Originally developed by Travis Cook
+# www.frightideas.com
+#
+# Redesign to replace Indigo with Fibaro Home Center 2 by Ove Nystås
+#
+# The IT-100 protocol, alarm state and event logic, independent of the
+# home automation system it runs under. Everything host specific goes
+# through the HostAdapter in dscHost.py, so this module imports
+# without Indigo and without pyserial until the port is opened.
+#######################################################################
+
+from datetime import datetime
+import collections
+import dscBatch
+import dscCapture
+import dscCodec
+import dscConfig
+import dscLabels
+import dscMetrics
+import dscOccupancy
+import dscProfiler
+import dscRules
+import dscSnapshot
+import dscTempHistory
+import dscTrace
+import dscTransport
+import dscZoneStats
+import json
+import re
+import tempfile
+import threading
+import time
+
+ZONE_STATE_OPEN = 'open'
+ZONE_STATE_CLOSED = 'closed'
+ZONE_STATE_TRIPPED = 'tripped'
+ZONE_GROUP_STATE_OPEN = 'zoneOpen'
+ZONE_GROUP_STATE_CLOSED = 'allZonesClosed'
+ZONE_GROUP_STATE_TRIPPED = 'zoneTripped'
+ALARM_STATE_DISARMED = 'disarmed'
+ALARM_STATE_EXIT_DELAY = 'exitDelay'
+ALARM_STATE_FAILED_TO_ARM = 'FailedToArm'
+ALARM_STATE_ARMED = 'armed'
+ALARM_STATE_ENTRY_DELAY = 'entryDelay'
+ALARM_STATE_TRIPPED = 'tripped'
+KEYPAD_STATE_CHIME_ENABLED = 'enabled'
+KEYPAD_STATE_CHIME_DISABLED = 'disabled'
+ALARM_ARMED_STATE_DISARMED = 'disarmed'
+ALARM_ARMED_STATE_STAY = 'stay'
+ALARM_ARMED_STATE_AWAY = 'away'
+
+LED_INDEX_LIST = ['None', 'Ready', 'Armed', 'Memory', 'Bypass', 'Trouble',
+                  'Program', 'Fire', 'Backlight', 'AC']
+LED_STATE_LIST = ['off', 'on', 'flashing']
+ARMED_MODE_LIST = ['Away', 'Stay', 'Away, No Delay', 'Stay, No Delay']
+PANIC_TYPE_LIST = ['None', 'Fire', 'Ambulance', 'Panic']
+MONTH_LIST = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN',
+              'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+TEMP_STATE_KEYS = {'inside': 'temperatureInside',
+                   'outside': 'temperatureOutside',
+                   'cool': 'setPointCool',
+                   'heat': 'setPointHeat'}
+
+CMD_NORMAL = 0
+CMD_THERMO_SET = 1
+PARTITION_COUNT = 8
+THERMOSTAT_COUNT = 4
+KEYPRESS_KEYS = 'abcde0123456789FAP<>=*#'
+PANIC_TYPES = {'fire': '1', 'ambulance': '2', 'panic': '3'}
+ZONE_EVENT_CMDS = ('601', '609', '610')
+PING_INTERVAL = 301
+HOLD_RETRY_TIME_MINUTES = 3
+TRACE_LOG_LEVEL = 4
+
+# Transmit flow control, all times in seconds
+TX_PACE_MIN = 0.1  # Slowest pacing step, below this we send at full speed
+TX_PACE_MAX = 2.0  # Longest gap between frames while the panel is congested
+TX_HOLD_BUFFER_FULL = 2.0  # Pause after 816 Buffer Near Full
+TX_HOLD_BUSY = 1.0  # Pause after 673 Partition Busy or 502-017 Keybus Busy
+TX_HOLD_CMD_ERROR = 0.2  # Pause after 501 Command Error before resending
+TX_BUSY_TIMEOUT = 30  # Give up on a command the panel keeps reporting busy
+
+
+# Converts given time in minutes to a human format
+# 3m, 5h, 2d, etc.
+def getShortTime(minutes):
+    # If time is less than an hour then show XXm
+    if minutes < 60:
+        return str(minutes) + 'm'
+    # If it's less than one day then show XXh
+    elif minutes < 1440:
+        return str(int(minutes / 60)) + 'h'
+    # If it's less than one hundred days then show XXd
+    elif minutes < 43200:
+        return str(int(minutes / 1440)) + 'd'
+    # If it's anything more than one hundred days then show nothing
+    else:
+        return ''
+
+
+###############################################################################
+# What the engine knows about each device. hostRef is whatever the host
+# registered it with, the engine never looks inside it.
+###############################################################################
+class Zone(object):
+
+    def __init__(self, number, name, hostRef, state=ZONE_STATE_CLOSED,
+                 timer=0, logChanges=False, occupancyGroup=0, var=None,
+                 partition=1):
+        self.number = number
+        self.name = name
+        self.hostRef = hostRef
+        self.state = state
+        self.timer = timer
+        self.logChanges = logChanges
+        self.occupancyGroup = occupancyGroup
+        self.var = var
+        self.partition = partition
+
+
+class ZoneGroup(object):
+
+    def __init__(self, name, hostRef, zones, state=ZONE_GROUP_STATE_CLOSED,
+                 anyMemberTimer=0, entireGroupTimer=0):
+        self.name = name
+        self.hostRef = hostRef
+        self.zones = zones
+        self.state = state
+        self.anyMemberTimer = anyMemberTimer
+        self.entireGroupTimer = entireGroupTimer
+
+
+class Keypad(object):
+
+    def __init__(self, partition, name, hostRef, states=None):
+        self.partition = partition
+        self.name = name
+        self.hostRef = hostRef
+        self.states = dict(states or {})
+
+
+# Alarm state the panel keeps per partition. Zones tripped during an alarm
+# stay tripped until the partition is disarmed, closes seen meanwhile are
+# held in closeTheseZonesList.
+class Partition(object):
+
+    def __init__(self, number):
+        self.number = number
+        self.alarmTripped = False
+        self.trippedZoneList = []
+        self.closeTheseZonesList = []
+
+
+class TempSensor(object):
+
+    def __init__(self, number, name, hostRef, logChanges=False, states=None):
+        self.number = number
+        self.name = name
+        self.hostRef = hostRef
+        self.logChanges = logChanges
+        self.states = dict(states or {})
+
+
+###############################################################################
+
+
+class DscEngine(object):
+
+    ########################################
+
+    def __init__(self, host, prefs):
+        self.host = host
+        self.prefs = prefs
+        self.States = self.enum(STARTUP=1, HOLD=2, HOLD_RETRY=3,
+                                HOLD_RETRY_LOOP=4, BOTH_INIT=5,
+                                ENABLE_TIME_BROADCAST=7,
+                                BOTH_PING=8, BOTH_POLL=9)
+        self.state = self.States.STARTUP
+        self.config = dscConfig.compileConfig({})
+        # Prefs handed to reloadConfiguration, for the engine thread to take
+        self.pendingPrefs = None
+        self.shutdown = False
+        self.configRead = False
+        self.interfaceState = 0
+        self.zoneList = {}
+        self.tempList = {}
+        self.zoneGroupList = {}
+        self.zoneGroupIndex = {}
+        self.partitionList = dict((number, Partition(number)) for number in
+                                  range(1, PARTITION_COUNT + 1))
+        self.zonePartitionIndex = {}
+        self.keypadList = {}
+        self.port = None
+        self.repeatAlarmTrippedNext = 0
+        self.isPortOpen = False
+        self.txCmdList = []
+        self.txHoldUntil = 0
+        self.txPace = 0
+        self.currentHoldRetryTime = HOLD_RETRY_TIME_MINUTES
+        self.troubleCode = 0
+        self.troubleClearedTimer = 0
+        self.capture = None
+        self.trace = None
+        self.occupancy = dscOccupancy.OccupancyTracker()
+        self.zoneStats = dscZoneStats.ZoneStatsTracker()
+        self.tempHistory = dscTempHistory.TempHistory()
+        self.tempHistoryFile = ''
+        self.labels = dscLabels.LabelTable()
+        self.labelCache = ('', '')  # (file name, panel key)
+        # Set when the labels have to be asked for once the link is up
+        self.labelsWanted = True
+        self.installerMode = False
+        self.snapshot = None  # dscSnapshot.SnapshotWriter if configured
+        self.rules = dscRules.RuleEngine()
+        self.metrics = dscMetrics.GatewayMetrics()
+        self.metrics.queueDepth.function = lambda: len(self.txCmdList)
+        self.portOpened = False
+        self.profiler = dscProfiler.SamplingProfiler(tempfile.gettempdir())
+        self.threadId = None
+        self.createdAt = time.time()
+        self.startupTimes = collections.OrderedDict()  # phase: seconds
+        self.startupReported = False
+
+    def enum(self, **enums):
+        return type('Enum', (), enums)
+
+    # Logs msg % args only if level is enabled, so disabled debug output
+    # costs a comparison instead of a string format
+    def logDebug(self, level, msg, *args):
+        if level <= self.config.logLevel:
+            if len(args) > 0:
+                msg = msg % args
+            self.host.log(level, msg)
+
+    ###########################################################################
+    # Device Registration
+    ###########################################################################
+
+    # Returns the new Zone, or None if the zone number is already taken
+    def addZone(self, number, name, hostRef, state=ZONE_STATE_CLOSED,
+                timer=0, logChanges=False, occupancyGroup=0, var=None,
+                partition=1):
+        if number in self.zoneList:
+            return None
+        zone = Zone(number, name, hostRef, state, timer, logChanges,
+                    occupancyGroup, var, partition)
+        self.zoneList[number] = zone
+        if partition in self.partitionList:
+            self.zonePartitionIndex[number] = partition
+        return zone
+
+    def removeZone(self, number):
+        if number in self.zoneList:
+            del self.zoneList[number]
+
+    # zones are the zone numbers in the group, they don't have to be
+    # registered yet
+    def addZoneGroup(self, name, hostRef, zones,
+                     state=ZONE_GROUP_STATE_CLOSED, anyMemberTimer=0,
+                     entireGroupTimer=0):
+        self.removeZoneGroup(hostRef)
+        group = ZoneGroup(name, hostRef, list(zones), state, anyMemberTimer,
+                          entireGroupTimer)
+        self.zoneGroupList[hostRef] = group
+        for zoneNum in group.zones:
+            self.zoneGroupIndex.setdefault(zoneNum, []).append(group)
+        return group
+
+    def removeZoneGroup(self, hostRef):
+        group = self.zoneGroupList.pop(hostRef, None)
+        if group is None:
+            return
+        for zoneNum in group.zones:
+            groups = self.zoneGroupIndex.get(zoneNum, [])
+            if group in groups:
+                groups.remove(group)
+            if len(groups) == 0:
+                self.zoneGroupIndex.pop(zoneNum, None)
+
+    # The partition a zone belongs to. Zone open and close frames don't say,
+    # so it's the one the zone was registered with or the panel last
+    # reported it in, partition 1 if neither.
+    def zonePartition(self, zoneNum):
+        return self.partitionList[self.zonePartitionIndex.get(zoneNum, 1)]
+
+    # Moves zoneNum to the partition the panel reported it in
+    def learnZonePartition(self, zoneNum, partition):
+        if self.zonePartitionIndex.get(zoneNum, 1) == partition or \
+                partition not in self.partitionList:
+            return
+        self.host.log(2, "Zone %d is in partition %d." % (zoneNum, partition))
+        self.zonePartitionIndex[zoneNum] = partition
+        if zoneNum in self.zoneList:
+            self.zoneList[zoneNum].partition = partition
+
+    # The state of partition, None if the panel named one that doesn't
+    # exist, in a corrupt or unexpected frame
+    def partitionState(self, partition):
+        state = self.partitionList.get(partition)
+        if state is None:
+            self.host.log(1, "Ignoring unknown partition %d." % partition)
+        return state
+
+    # Partitions with an alarm in progress
+    def trippedPartitions(self):
+        return [partition for partition in self.partitionList.values()
+                if partition.alarmTripped is True]
+
+    def addKeypad(self, partition, name, hostRef, states=None):
+        keypad = Keypad(partition, name, hostRef, states)
+        self.keypadList[partition] = keypad
+        return keypad
+
+    def removeKeypad(self, partition):
+        if partition in self.keypadList:
+            del self.keypadList[partition]
+
+    # Returns the new TempSensor, or None if the number is already taken
+    def addTempSensor(self, number, name, hostRef, logChanges=False,
+                      states=None):
+        if number in self.tempList:
+            return None
+        sensor = TempSensor(number, name, hostRef, logChanges, states)
+        self.tempList[number] = sensor
+        return sensor
+
+    def removeTempSensor(self, number):
+        if number in self.tempList:
+            del self.tempList[number]
+
+    ###########################################################################
+    # Actions
+    ###########################################################################
+    def disarm(self, partition=1):
+        self.host.log(1, "Disarming alarm")
+        self.queueCommand(CMD_NORMAL, self.disarmFrame(partition))
+
+    def armStay(self, partition=1):
+        self.host.log(1, "Arming alarm in stay mode.")
+        self.queueCommand(CMD_NORMAL, '031%u' % partition)
+
+    def armAway(self, partition=1):
+        self.host.log(1, "Arming alarm in away mode.")
+        self.queueCommand(CMD_NORMAL, '030%u' % partition)
+
+    def disarmFrame(self, partition):
+        return "".join(["040%u" % partition, self.config.code,
+                        "0" * (6 - len(self.config.code))])
+
+    # panicType is '1' Fire, '2' Ambulance or '3' Panic
+    def panic(self, panicType):
+        self.host.log(1, "Activating Panic Alarm! (%s)" %
+                      PANIC_TYPE_LIST[int(panicType)])
+        self.queueCommand(CMD_NORMAL, '060' + panicType)
+
+    def sendKeypress(self, keys):
+        firstChar = True
+        sendBreak = False
+        for char in keys:
+            if char == 'L':
+                time.sleep(2)
+                sendBreak = False
+
+            if (firstChar is False):
+                self.queueCommand(CMD_NORMAL, '070^')
+
+            if char != 'L':
+                self.queueCommand(CMD_NORMAL, '070' + char)
+                sendBreak = True
+
+            firstChar = False
+        if (sendBreak is True):
+            self.queueCommand(CMD_NORMAL, '070^')
+
+    # Queue a command to set DSC Thermostat Setpoints
+    # which is 'C' or 'H', adjustmentType '+', '-' or '='
+    def adjustThermostat(self, sensorNum, which, adjustmentType, setPoint=0):
+        self.logDebug(3, "Thermostat %s: %s%s%s", sensorNum, which,
+                      adjustmentType, setPoint)
+        self.queueCommand(CMD_THERMO_SET,
+                          (sensorNum, which, adjustmentType, setPoint))
+
+    # The command queued above calls this routine to create the packet.
+    # Returns False if the panel didn't take the adjustment.
+    def setThermostat(self, data):
+        (sensorNum, which, adjustmentType, setPoint) = data
+
+        # send 095 for thermostat in question, wait for 563 response
+        rx = self.sendPacket('095' + str(sensorNum), waitFor='563')
+        if len(rx) == 0:
+            self.host.logError('Error getting current thermostat setpoints, '
+                               'aborting adjustment.')
+            return False
+
+        if adjustmentType == '+' or adjustmentType == '-':
+            sp = 0
+        else:
+            sp = int(setPoint)
+
+        # then 096TC+000 to inc cool,
+        #      096Th-000 to dec heat
+        # 096Th=### to set setpoint
+        # wait for 563 response
+        rx = self.sendPacket('096%u%c%c%03u' %
+                             (sensorNum, which, adjustmentType, sp),
+                             waitFor='563')
+        if len(rx) == 0:
+            self.host.logError('Error changing thermostat setpoints, '
+                               'aborting adjustment.')
+            return False
+
+        # send 097T
+        # send 097 for thermostat in question to save setting,
+        # wait for 563 response
+        rx = self.sendPacket('097' + str(sensorNum), waitFor='563')
+        if len(rx) == 0:
+            self.host.logError('Error saving thermostat setpoints, '
+                               'aborting adjustment.')
+            return False
+        return True
+
+    # Adds a command to the transmit queue, remembering when it was queued.
+    # batchRef is (batch, command) for a frame of a dscBatch command.
+    def queueCommand(self, cmdType, data, batchRef=None):
+        self.txCmdList.append((cmdType, data, time.time(), batchRef))
+
+    # Reset an Alarm Zone Group's timers to 0
+    def resetZoneGroupTimer(self, hostRef):
+        group = self.zoneGroupList.get(hostRef)
+        if group is None:
+            return
+        self.host.log(3, "Manual timer reset for "
+                      "alarm zone group \"%s\"" % group.name)
+        group.anyMemberTimer = 0
+        group.entireGroupTimer = 0
+        self.host.zoneGroupChanged(group, {'AnyMemberLastChangedTimer': 0,
+                                           'EntireGroupLastChangedTimer': 0})
+
+    ###########################################################################
+    # Command Batches
+    ###########################################################################
+
+    # Returns the partitions a batch entry is for, 1 if none are given
+    def batchPartitions(self, spec):
+        partitions = spec.get('partitions', [spec.get('partition', 1)])
+        if not isinstance(partitions, list) or len(partitions) == 0:
+            raise ValueError('partitions must be a list of partitions')
+        for partition in partitions:
+            if type(partition) is not int or \
+                    not 1 <= partition <= PARTITION_COUNT:
+                raise ValueError('invalid partition %r' % (partition,))
+        return partitions
+
+    # Turns one entry of a batch into dscBatch.BatchCommands, raises
+    # ValueError if it isn't valid
+    def batchCommands(self, spec):
+        if not isinstance(spec, dict):
+            raise ValueError('a command must be an object')
+        action = spec.get('action')
+        if action == 'armStay' or action == 'armAway':
+            mode = '031' if action == 'armStay' else '030'
+            return [dscBatch.BatchCommand(action, [(CMD_NORMAL, mode +
+                                                    str(partition))],
+                                          partition=partition)
+                    for partition in self.batchPartitions(spec)]
+
+        elif action == 'disarm':
+            if not self.config.code.isdigit():
+                raise ValueError('no valid user code is configured')
+            return [dscBatch.BatchCommand(
+                action, [(CMD_NORMAL, self.disarmFrame(partition))],
+                partition=partition)
+                for partition in self.batchPartitions(spec)]
+
+        elif action == 'panic':
+            panicType = PANIC_TYPES.get(str(spec.get('type')).lower())
+            if panicType is None:
+                raise ValueError('type must be fire, ambulance or panic')
+            return [dscBatch.BatchCommand(action,
+                                          [(CMD_NORMAL, '060' + panicType)])]
+
+        elif action == 'keypress':
+            keys = spec.get('keys')
+            if not isinstance(keys, str) or len(keys) == 0 or \
+                    any(char not in KEYPRESS_KEYS for char in keys):
+                raise ValueError('keys must be one or more of %s' %
+                                 KEYPRESS_KEYS)
+            # Same frames as sendKeypress, a break after every key
+            frames = []
+            for char in keys:
+                frames.append((CMD_NORMAL, '070' + char))
+                frames.append((CMD_NORMAL, '070^'))
+            return [dscBatch.BatchCommand(action, frames)]
+
+        elif action == 'thermostat':
+            sensor = spec.get('sensor')
+            if type(sensor) is not int or \
+                    not 1 <= sensor <= THERMOSTAT_COUNT:
+                raise ValueError('invalid thermostat %r' % (sensor,))
+            which = {'cool': 'C', 'heat': 'H'}.get(
+                str(spec.get('which')).lower())
+            if which is None:
+                raise ValueError('which must be cool or heat')
+            adjust = spec.get('adjust')
+            if adjust not in ('+', '-', '='):
+                raise ValueError('adjust must be +, - or =')
+            setPoint = spec.get('setPoint', 0)
+            if type(setPoint) is not int or not 0 <= setPoint <= 99:
+                raise ValueError('invalid setPoint %r' % (setPoint,))
+            return [dscBatch.BatchCommand(
+                action, [(CMD_THERMO_SET, (sensor, which, adjust, setPoint))],
+                sensor=sensor)]
+
+        raise ValueError('unknown action %r' % (action,))
+
+    # Checks every entry of specs and queues the lot back to back if they
+    # are all valid. Returns (batch, None) or (None, list of errors).
+    def queueBatch(self, specs, timeout=dscBatch.BATCH_TIMEOUT):
+        commands = []
+        errors = []
+        for (index, spec) in enumerate(specs):
+            try:
+                commands.extend(self.batchCommands(spec))
+            except ValueError as err:
+                errors.append({'index': index, 'error': str(err)})
+        if len(errors) > 0:
+            return (None, errors)
+
+        batch = dscBatch.CommandBatch(commands, timeout)
+        now = time.time()
+        self.host.log(2, "Queueing a batch of %u commands" % len(commands))
+        # One extend so the engine thread sees the whole batch at once
+        self.txCmdList.extend((cmdType, data, now, (batch, command))
+                              for command in commands
+                              for (cmdType, data) in command.frames)
+        return (batch, None)
+
+    ###########################################################################
+    # Local Rules
+    ###########################################################################
+
+    # Replaces the rules with specs, see dscRules.py. Zone groups are named
+    # by name or hostRef, so they have to be added first. Returns False and
+    # keeps the old rules if one isn't valid.
+    def setRules(self, specs):
+        groups = {}
+        for group in list(self.zoneGroupList.values()):
+            groups[group.name] = group.zones
+            groups[group.hostRef] = group.zones
+        now = time.time()
+        for zone in list(self.zoneList.values()):
+            if zone.number not in self.rules.tracks:
+                self.rules.initialState(zone.number, zone.state, now)
+        try:
+            self.rules.setRules(specs, groups, self.batchCommands, now)
+        except dscRules.RuleError as err:
+            self.host.logError('Invalid rules: %s' % str(err))
+            return False
+        self.host.log(2, "Loaded %u rules" % len(specs))
+        return True
+
+    def runRules(self, rules):
+        for rule in rules:
+            self.host.log(2, "Rule '%s' fired" % rule.name)
+            for (kind, value) in rule.actions:
+                if kind == 'command':
+                    (batch, errors) = self.queueBatch(value)
+                    if batch is None:
+                        self.host.logError("Rule '%s' could not queue its "
+                                           "commands: %s" % (rule.name,
+                                                             errors))
+                elif kind == 'scene':
+                    self.host.runScene(value)
+                elif kind == 'event':
+                    self.host.fireEvent(value)
+                else:
+                    self.host.log(1, value)
+
+    ###########################################################################
+    # Configuration Routines
+    ###########################################################################
+
+    # Compiles prefs into a new config and, once the host accepted its
+    # own settings in them too, puts it in place. Returns False, keeping
+    # the config it had, if prefs aren't usable.
+    def readConfiguration(self, prefs):
+        self.host.log(3, "readConfiguration start")
+
+        try:
+            config = dscConfig.compileConfig(prefs)
+            if self.host.readConfiguration(prefs) is False:
+                return False
+        except (AttributeError, KeyError, TypeError, ValueError) as err:
+            self.host.log(2, "Error reading plugin configuration: %s "
+                          "(happens on very first launch)" % err)
+            return False
+
+        self.prefs = prefs
+        self.applyConfiguration(config)
+        self.host.log(3, "Configuration read successfully")
+        return True
+
+    def applyConfiguration(self, config):
+        self.occupancy.vacantAfter = config.occupancyVacant
+        self.occupancy.setWindow(config.occupancyWindow)
+        self.zoneStats.setWindows(config.zoneStatsWindows)
+        self.profiler.outputDir = config.profileDir or tempfile.gettempdir()
+        # One assignment, so every reader sees either the old or the new
+        self.config = config
+
+        self.setCapture(config.captureFile)
+        self.setTrace(config.traceFile)
+        self.setTempHistoryFile(config.tempHistoryFile)
+        self.setLabelCache(config.labelCacheFile, config.serialPort)
+        self.setSnapshotFile(config.snapshotFile)
+
+    # Has the engine thread switch to prefs, from any thread. Unlike
+    # setting configRead to False, the link to the panel is only reopened
+    # if the way to reach it changed.
+    def reloadConfiguration(self, prefs):
+        self.pendingPrefs = prefs
+
+    # Called from the run loop for prefs given to reloadConfiguration
+    def reload(self, prefs):
+        oldConfig = self.config
+        if self.readConfiguration(prefs) is False:
+            self.host.logError('New configuration not usable, keeping the '
+                               'current one.')
+            return
+        if self.configRead is False:
+            # Never got as far as a working configuration, start up now
+            self.configRead = True
+        elif dscConfig.needsReconnect(oldConfig, self.config):
+            self.host.log(1, "Port settings changed, reconnecting.")
+            self.state = self.States.BOTH_INIT
+        elif self.state in (self.States.HOLD, self.States.HOLD_RETRY_LOOP):
+            # Not connected anyway, so try again straight away
+            self.host.log(2, "Configuration reloaded, reconnecting.")
+            self.state = self.States.BOTH_INIT
+        else:
+            self.host.log(2, "Configuration reloaded.")
+
+    ###########################################################################
+    # Communication Routines
+    ###########################################################################
+    # Starts or stops recording of raw wire traffic to fileName
+    def setCapture(self, fileName):
+        if self.capture is not None:
+            if self.capture.fileName == fileName:
+                return
+            self.capture.close()
+            self.capture = None
+        if len(fileName) > 0:
+            try:
+                self.capture = dscCapture.CaptureWriter(fileName)
+                self.host.log(1, "Capturing wire traffic to %s" % fileName)
+            except IOError as err:
+                self.host.logError('Error opening capture file: %s' %
+                                   (str(err)))
+
+    # Keeps the temperature history in fileName, loading what is there.
+    # The history so far is saved to the old file first.
+    def setTempHistoryFile(self, fileName):
+        if fileName == self.tempHistoryFile:
+            return
+        self.saveTempHistory()
+        self.tempHistoryFile = fileName
+        if len(fileName) == 0:
+            return
+        try:
+            count = self.tempHistory.load(fileName)
+            self.host.log(1, "Loaded the history of %u temperatures from "
+                          "%s" % (count, fileName))
+        except (IOError, OSError, ValueError, KeyError) as err:
+            self.host.logError('Error reading temperature history %s: %s' %
+                               (fileName, str(err)))
+
+    def saveTempHistory(self):
+        if len(self.tempHistoryFile) == 0:
+            return
+        try:
+            self.tempHistory.save(self.tempHistoryFile)
+        except (IOError, OSError) as err:
+            self.host.logError('Error saving temperature history %s: %s' %
+                               (self.tempHistoryFile, str(err)))
+
+    # Takes the labels of the panel known by key from the cache in
+    # fileName. They are asked from the panel only if none are cached.
+    def setLabelCache(self, fileName, key):
+        if (fileName, key) == self.labelCache:
+            return
+        self.saveLabels()
+        self.labelCache = (fileName, key)
+        self.labels.clear()
+        self.labelsWanted = True
+        if len(fileName) == 0:
+            return
+        try:
+            count = self.labels.load(fileName, key)
+        except (IOError, OSError, ValueError, KeyError) as err:
+            self.host.logError('Error reading label cache %s: %s' %
+                               (fileName, str(err)))
+            return
+        if count > 0:
+            self.host.log(2, "Loaded %u panel labels from %s" %
+                          (count, fileName))
+            self.labelsWanted = False
+
+    def saveLabels(self):
+        (fileName, key) = self.labelCache
+        if len(fileName) == 0 or self.labels.dirty is False:
+            return
+        try:
+            self.labels.save(fileName, key)
+        except (IOError, OSError, ValueError) as err:
+            self.host.logError('Error saving label cache %s: %s' %
+                               (fileName, str(err)))
+
+    # Keeps the state snapshot for local readers in fileName, none if it's
+    # empty
+    def setSnapshotFile(self, fileName):
+        if self.snapshot is not None:
+            if self.snapshot.fileName == fileName:
+                return
+            self.snapshot.close()
+            self.snapshot = None
+        if len(fileName) == 0:
+            return
+        try:
+            self.snapshot = dscSnapshot.SnapshotWriter(fileName)
+            self.host.log(1, "Keeping a state snapshot in %s" % fileName)
+        except (IOError, OSError, ValueError) as err:
+            self.host.logError('Error opening state snapshot %s: %s' %
+                               (fileName, str(err)))
+
+    # Starts tracing of all frames if debug logging is on. Records go to
+    # fileName, or to the log when no file is given.
+    def setTrace(self, fileName):
+        self.stopTrace()
+        if self.config.logLevel < TRACE_LOG_LEVEL:
+            return
+        if len(fileName) > 0:
+            try:
+                self.trace = dscTrace.openTraceFile(fileName)
+                return
+            except IOError as err:
+                self.host.logError('Error opening trace file: %s' %
+                                   (str(err)))
+        self.trace = dscTrace.TraceSink(
+            lambda text: self.host.log(TRACE_LOG_LEVEL, text))
+
+    def stopTrace(self):
+        if self.trace is not None:
+            self.trace.close()
+            self.trace = None
+
+    # Adds the engine's endpoints to a dscHttp.HttpServer
+    def addHttpRoutes(self, server):
+        server.addRoute('GET', '/metrics', self.httpMetrics)
+        server.addRoute('GET', '/debug/profile', self.httpProfile)
+        server.addRoute('GET', '/occupancy', self.httpOccupancy)
+        server.addRoute('GET', '/zones/stats', self.httpZoneStats)
+        server.addRoute('GET', '/temperature', self.httpTemperature)
+        server.addRoute('GET', '/rules', self.httpRules)
+        server.addRoute('GET', '/labels', self.httpLabels)
+
+    # POST /commands, see dscBatch.py. Answers once the whole batch has
+    # been acknowledged, failed or timed out. Not added by addHttpRoutes
+    # as it can disarm the alarm, hosts offering it have to guard it.
+    def httpCommands(self, request):
+        try:
+            (specs, timeout) = dscBatch.parseBatch(
+                json.loads(request.body().decode('utf-8')))
+        except ValueError as err:
+            return (400, 'application/json',
+                    json.dumps({'errors': [{'error': str(err)}]}))
+
+        (batch, errors) = self.queueBatch(specs, timeout)
+        if batch is None:
+            return (400, 'application/json', json.dumps({'errors': errors}))
+        batch.wait()
+        return (200, 'application/json', json.dumps(batch.report()))
+
+    # /occupancy[?idle=N], every area or only those idle for more than N
+    # minutes, longest idle first
+    def httpOccupancy(self, request):
+        now = time.time()
+        if 'idle' in request.query:
+            try:
+                idle = 60 * float(request.query['idle'])
+            except ValueError:
+                return (400, 'text/plain', 'Invalid idle time.\n')
+            areas = self.occupancy.idleAreas(idle, now)
+        else:
+            areas = self.occupancy.report(now)
+        return (200, 'application/json', json.dumps({'areas': areas}))
+
+    # /zones/stats, open-duration statistics of every zone that has been
+    # opened, see dscZoneStats.py
+    def httpZoneStats(self, request):
+        report = self.zoneStats.report(time.time())
+        zones = []
+        for zone in list(self.zoneList.values()):
+            stats = report.get(zone.number)
+            if stats is not None:
+                stats['zone'] = zone.number
+                stats['name'] = zone.name
+                zones.append(stats)
+        return (200, 'application/json', json.dumps({'zones': zones}))
+
+    # /temperature lists the sensors with history and their last reading,
+    # /temperature?sensor=1&key=inside the readings of one, over the last
+    # day or from start to end (seconds since the epoch). step picks the
+    # resolution, see dscTempHistory.py.
+    def httpTemperature(self, request):
+        if 'sensor' not in request.query:
+            return (200, 'application/json',
+                    json.dumps({'series': self.tempHistory.report()}))
+        now = time.time()
+        try:
+            sensorNum = int(request.query['sensor'])
+            key = request.query.get('key', 'inside')
+            end = float(request.query.get('end', now))
+            start = float(request.query.get('start', end - 86400))
+            step = int(request.query.get('step', 0))
+        except ValueError:
+            return (400, 'text/plain', 'Invalid sensor, start, end or '
+                    'step.\n')
+        result = self.tempHistory.query(sensorNum, key, start, end, step)
+        if result is None:
+            return (404, 'text/plain', 'No readings for that sensor.\n')
+        return (200, 'application/json', json.dumps(result))
+
+    # /rules, every rule with whether its condition holds and how often
+    # it fired
+    def httpRules(self, request):
+        return (200, 'application/json',
+                json.dumps({'rules': self.rules.report()}))
+
+    # /labels, the zone, partition and other labels the panel sent
+    def httpLabels(self, request):
+        return (200, 'application/json', json.dumps(self.labels.report()))
+
+    def httpMetrics(self, request):
+        return (200, 'text/plain; version=0.0.4',
+                self.metrics.render())
+
+    # /debug/profile, samples the engine thread unless asked for all
+    def httpProfile(self, request):
+        return dscProfiler.httpProfile(self.profiler, request,
+                                       self.profiledThreads, self.host.log)
+
+    # The threads worth profiling, the one doing serial I/O and dispatch
+    def profiledThreads(self):
+        if self.threadId is None:
+            return None
+        return [self.threadId]
+
+    # Records how long the startup phase begun at started took. Hosts
+    # time their own phases, like registering devices, with this too.
+    def startupPhase(self, phase, started):
+        seconds = time.time() - started
+        self.startupTimes[phase] = seconds
+        self.metrics.startupSeconds.set(seconds, phase)
+
+    # Logs how long it took from creating the engine to talking to the
+    # panel, the first time only
+    def reportStartup(self):
+        if self.startupReported is True:
+            return
+        self.startupReported = True
+        self.host.log(1, "Started in %.2f s (%s)." % (
+            time.time() - self.createdAt,
+            ', '.join('%s %.3f s' % (phase, seconds) for (phase, seconds)
+                      in self.startupTimes.items())))
+
+    def closePort(self):
+        if self.port is None:
+            return
+        if self.port.isOpen() is True:
+            self.port.close()
+            self.port = None
+
+    # Opens the serial port or TCP connection serialPort names, see
+    # dscTransport.py
+    def openPort(self):
+        self.closePort()
+        self.host.log(1, "Initializing communication on port %s" %
+                      self.config.serialPort)
+        try:
+            self.port = dscTransport.openTransport(
+                self.config.serialPort, self.config.tpiPassword)
+        except Exception as err:
+            self.host.logError('Error opening port: %s' % (str(err)))
+            return False
+
+        return self.port.isOpen()
+
+    def readPort(self):
+        if self.port.isOpen() is False:
+            self.state = self.States.BOTH_INIT
+            return ""
+        data = ""
+        try:
+            raw = self.port.readline()
+            if self.capture is not None and len(raw) > 0:
+                self.capture.write(dscCapture.CAPTURE_RX, raw)
+            data = raw.decode('ascii', 'replace')
+        except Exception as err:
+            self.host.logError('Connection RX Error: %s' % (str(err)))
+            # Return with '-' signaling calling subs to abort
+            # so we can re-init.
+            data = '-'
+            # exit()
+        except:
+            self.host.logError('Connection RX Problem, engine quitting')
+            exit()
+        return data
+
+    def writePort(self, data):
+        raw = data.encode('ascii')
+        if self.capture is not None:
+            self.capture.write(dscCapture.CAPTURE_TX, raw)
+        self.port.write(raw)
+
+    # latency is how long flow control held the packet back, for tracing
+    def sendPacketOnly(self, data, latency=0):
+        pkt = dscCodec.encodeFrame(data)
+        self.metrics.txFrames.inc(data[:3])
+        if self.trace is not None:
+            self.trace.record(dscTrace.TRACE_TX, data[:3], data[3:], latency)
+        try:
+            self.writePort(pkt)
+        except Exception as err:
+            self.host.logError('Connection TX Error: %s' % (str(err)))
+            exit()
+        except:
+            self.host.logError('Connection TX Problem, engine quitting')
+            exit()
+
+    def sendPacket(self, tx, waitFor='500', rxTimeout=3, txRetries=3):
+        retries = txRetries
+        txCmd = tx[:3]
+        busyTimeout = time.time() + TX_BUSY_TIMEOUT
+
+        while txRetries > 0:
+            # Hold off while the panel has asked us to slow down
+            heldSince = time.time()
+            if self.waitForTxWindow() is False:
+                if self.shutdown is True:
+                    return ''
+                return '-'
+
+            if txRetries < retries:
+                self.metrics.txRetries.inc()
+            self.sendPacketOnly(tx, time.time() - heldSince)
+            sentAt = time.time()
+            self.txHoldUntil = sentAt + self.txPace
+            ourTimeout = sentAt + rxTimeout
+            txRetries -= 1
+            resend = False
+            while time.time() < ourTimeout:
+                if self.shutdown is True:
+                    return ''
+                (rxCmd, rxData) = self.readPacket()
+
+                # If rxCmd == - then the socket closed, return for re-init
+                if rxCmd == '-':
+                    return '-'
+
+                if rxCmd == '501':
+                    # The panel got a corrupted frame, most likely because
+                    # it was overrun. Resend once the hold has passed.
+                    resend = True
+                    break
+
+                if rxCmd == '502':
+                    if rxData == '017' and time.time() < busyTimeout:
+                        # Keybus busy, the command will be accepted once the
+                        # panel is idle again so this doesn't count as a retry
+                        txRetries += 1
+                        resend = True
+                        break
+                    self.host.logError('Received system error after '
+                                       'sending command, aborting.')
+                    return ''
+
+                # If rxCmd is not 0 length then we received a response
+                if len(rxCmd) > 0:
+                    if waitFor == '500':
+                        if (rxCmd == '500') and (rxData == txCmd):
+                            self.metrics.ackLatency.observe(time.time() -
+                                                            sentAt)
+                            self.txRelax()
+                            return rxData
+                    elif (rxCmd == waitFor):
+                        self.metrics.ackLatency.observe(time.time() - sentAt)
+                        self.txRelax()
+                        return rxData
+            if resend is True:
+                continue
+            self.metrics.txTimeouts.inc()
+            if txCmd != '000':
+                self.host.logError('Timed out after waiting for response to '
+                                   'command %s for %u seconds, retrying.' %
+                                   (tx, rxTimeout))
+        self.host.logError('Resent command %s %u times with no success, '
+                           'aborting.' % (tx, retries))
+        self.metrics.txFailures.inc()
+        return ''
+
+    def readPacket(self):
+        data = self.readPort()
+        if len(data) == 0:
+            return ('', '')
+        elif data == '-':
+            # socket has closed, return with signal to re-initialize
+            return ('-', '')
+
+        rxStart = time.time()
+        (cmd, dat) = self.decodePacket(data)
+        if len(cmd) == 0:
+            return ('', '')
+
+        self.processPacket(cmd, dat)
+        self.metrics.rxFrames.inc(cmd)
+        if cmd in ZONE_EVENT_CMDS:
+            self.metrics.zoneLatency.observe(time.time() - rxStart)
+        if self.trace is not None:
+            self.trace.record(dscTrace.TRACE_RX, cmd, dat,
+                              time.time() - rxStart)
+        return (cmd, dat)
+
+    # Splits a received line into command and data and verifies the checksum.
+    # Returns ('', '') if the line isn't a valid packet.
+    def decodePacket(self, data):
+        try:
+            frame = dscCodec.decodeFrame(data)
+        except dscCodec.ChecksumError:
+            self.host.logError("Checksum did not match "
+                               "on a received packet.")
+            self.metrics.rxChecksumErrors.inc()
+            return ('', '')
+        except dscCodec.FrameError:
+            # Non-ascii characters, most likely line noise
+            self.host.logError('IT-100 Error: '
+                               'Received a response with invalid characters')
+            self.metrics.rxInvalidFrames.inc()
+            return ('', '')
+
+        if frame is None:
+            self.metrics.rxInvalidFrames.inc()
+            return ('', '')
+        return frame
+
+    # Acts on a decoded packet
+    def processPacket(self, cmd, dat):
+        # Parse responses based on cmd value
+        if cmd == '500':  # Command Acknowledge
+            self.logDebug(3, "ACK for cmd %s.", dat)
+            self.cmdAck = dat
+
+        elif cmd == '501':  # Command Error
+            self.host.logError('IT-100: '
+                               'Received a command with a bad checksum')
+            self.metrics.commandErrors.inc()
+            self.txThrottle(cmd, TX_HOLD_CMD_ERROR)
+
+        elif cmd == '502':  # System Error
+            self.metrics.systemErrors.inc(dat)
+            errText = 'Unknown'
+            if dat == '017':
+                errText = 'Keybus Busy – Installer Mode'
+                self.txThrottle(cmd, TX_HOLD_BUSY)
+            elif dat == '021':
+                errText = 'Requested Partition is out of Range'
+            elif dat == '023':
+                errText = 'Partition is Not Armed'
+            elif dat == '024':
+                errText = 'Partition is Not Ready to Arm'
+                self.host.fireEvent('eventFailToArm')
+                self.speak('speakTextFailedToArm')
+            elif dat == '026':
+                errText = 'User Code Not Required'
+            elif dat == '027':
+                errText = 'Virtual Keypad is Disabled'
+            elif dat == '029':
+                errText = 'Not Valid Parameter'
+            elif dat == '030':
+                errText = 'Keypad Does Not Come Out of Blank Mode'
+            elif dat == '031':
+                errText = 'IT-100 is already in Thermostat menu'
+            elif dat == '032':
+                errText = 'IT-100 is Not in Thermostat menu'
+            elif dat == '033':
+                errText = 'No Response from Thermostat (or Escort Module)'
+            self.host.logError("IT-100 Error (%s): %s" % (dat, errText))
+
+        elif cmd == '550':  # Time/Date Broadcast
+            m = re.search(r'^(\d\d)(\d\d)(\d\d)(\d\d)(\d\d)$', dat)
+            if m:
+                tHour = int(m.group(1))
+                tMinute = int(m.group(2))
+                tMonth = int(m.group(3)) - 1
+                tDay = int(m.group(4))
+                tYear = int(m.group(5))
+
+                # Check if we should sync time
+                if self.config.syncTime is True:
+                    d = datetime.now()
+                    if (d.year != tYear) or (d.month != tMonth) or \
+                            (d.day != tDay) or (d.hour != tHour) or \
+                            (d.minute != tMinute):
+                        self.host.log(1, "Setting alarm panel time and "
+                                      "date.")
+                        self.queueCommand(CMD_NORMAL, "010%s" %
+                                          d.strftime("%H%M%m%d%y"))
+                    else:
+                        self.logDebug(3, "Alarm time is within 1 minute of "
+                                      "actual time, no update necessary.")
+
+        elif cmd == '560':  # Ring Detected
+            # NOTE: ESCORTTM5580TC module is required to receive this command.
+            # Not implemented
+            self.host.log(1, "Ring Detected. Not implemented!")
+
+        elif cmd == '561':  # Indoor Temperature Broadcast
+            m = re.search(r'^(.)(...)$', dat)
+            if m:
+                (sensor, temp) = (int(m.group(1)), int(m.group(2)))
+                self.updateSensorTemp(sensor, 'inside', temp)
+
+        elif cmd == '562':  # Outdoor Temperature Broadcast
+            m = re.search(r'^(.)(...)$', dat)
+            if m:
+                (sensor, temp) = (int(m.group(1)), int(m.group(2)))
+                self.updateSensorTemp(sensor, 'outside', temp)
+
+        elif cmd == '563':  # Thermostat Set Points
+            m = re.search(r'^(.)(...)(...)$', dat)
+            if m:
+                (sensor, cool, heat) = (int(m.group(1)),
+                                        int(m.group(2)),
+                                        int(m.group(3)))
+                self.updateSensorTemp(sensor, 'cool', cool)
+                self.updateSensorTemp(sensor, 'heat', heat)
+
+        elif cmd == '570':  # Broadcast Labels
+            # NOTE: This function is only available with the
+            #       PowerSeries PC1616/1832/1864 Panels
+            m = re.search(r'^(...)(.*)$', dat)
+            if m and m.group(1).isdigit():
+                (number, text) = (int(m.group(1)), m.group(2))
+                if self.labels.update(number, text) is True:
+                    self.logDebug(3, "Panel label %d is '%s'.", number,
+                                  text.strip())
+
+        elif cmd == '580':  # Baud Rate Set
+            # The IT-100 sends the command in response to
+            # the following command sent by the application.
+            # Baud Change Rate ........................................ (080)
+            # Val:
+            # 0 (30h) = 9600
+            # 1 (31h) = 19200
+            # 2 (32h) = 38400
+            # 3 (33h) = 57600
+            # 4 (34h) = 115200
+            # Not implemented
+            self.host.log(1, "Baud Rate Set. Not implemented!")
+
+        elif cmd == '601':  # Zone Alarm
+            m = re.search(r'^(.)(...)$', dat)
+            if m:
+                (partition, zone) = (int(m.group(1)), int(m.group(2)))
+                self.learnZonePartition(zone, partition)
+                self.updateZoneState(zone, ZONE_STATE_TRIPPED)
+                state = self.partitionState(partition)
+                if state is not None and zone not in state.trippedZoneList:
+                    state.trippedZoneList.append(zone)
+                    self.sendZoneTrippedEmail(state)
+
+        elif cmd == '602':  # Zone Alarm Restore
+            m = re.search(r'^(.)(...)$', dat)
+            if m:
+                (partition, zone) = (int(m.group(1)), int(m.group(2)))
+                self.learnZonePartition(zone, partition)
+                self.host.log(1, "Zone %d Restored. (Partition %d)" %
+                              (zone, partition))
+
+        elif cmd == '603':  # Zone Tamper
+            # Zone Tamper | 603 (36, 30, 33h) | 4 (Part. 1-8, Zn 1-64)
+            # This IT-100 command indicates that a zone and associated
+            # partition has a tamper condition.
+            # Partition 1(31h)-8(38h), Zn 1(30, 30, 31h)-Zone 64(30, 36, 34h)
+            # Not implemented
+            self.host.log(1, "Zone Tamper. Not implemented!")
+
+        elif cmd == '604':  # Zone Tamper Restore
+            # Not implemented
+            self.host.log(1, "Zone Tamper Restore. Not implemented!")
+
+        elif cmd == '605':  # Zone Fault
+            # Not implemented
+            self.host.log(1, "Zone Fault. Not implemented!")
+
+        elif cmd == '606':  # Zone Fault Restore
+            # Not implemented
+            self.host.log(1, "Zone Fault Restore. Not implemented!")
+
+        elif cmd == '609':  # Zone Open
+            zone = int(dat)
+            self.logDebug(3, "Zone number %d Open.", zone)
+            self.updateZoneState(zone, ZONE_STATE_OPEN)
+            partition = self.zonePartition(zone)
+            if partition.alarmTripped is True:
+                if zone in partition.closeTheseZonesList:
+                    partition.closeTheseZonesList.remove(zone)
+
+        elif cmd == '610':  # Zone Restored
+            zone = int(dat)
+            self.logDebug(3, "Zone number %d Closed.", zone)
+            # Update the zone to closed ONLY if the alarm is not tripped
+            # We want the tripped states to be preserved so someone looking
+            # at their control page will see all the zones that have been
+            # opened since the break in. Only the zone's own partition
+            # being in alarm holds it.
+            partition = self.zonePartition(zone)
+            if partition.alarmTripped is False:
+                self.updateZoneState(zone, ZONE_STATE_CLOSED)
+            else:
+                partition.closeTheseZonesList.append(zone)
+
+        elif cmd == '620':  # Duress Alarm
+            self.host.log(1, "Duress Alarm Detected")
+
+        elif cmd == '621':  # [F] Key Alarm
+            self.host.log(1, "Fire Key Alarm Detected")
+
+        elif cmd == '622':  # [F] Key Restoral
+            self.host.log(1, "Fire Key Alarm Restored")
+
+        elif cmd == '623':  # [A] Key Alarm
+            self.host.log(1, "Auxiliary Key Alarm Detected")
+
+        elif cmd == '624':  # [A] Key Restoral
+            self.host.log(1, "Auxiliary Key Alarm Restored")
+
+        elif cmd == '625':  # [P] Key Alarm
+            self.host.log(1, "Panic Key Alarm Detected")
+
+        elif cmd == '626':  # [P] Key Restoral
+            self.host.log(1, "Panic Key Alarm Restored")
+
+        elif cmd == '631':  # Auxiliary Input Alarm
+            self.host.log(1, "Auxiliary Input Alarm Detected")
+
+        elif cmd == '632':  # Auxiliary Input Alarm Restored
+            self.host.log(1, "Auxiliary Input Alarm Restored")
+
+        elif cmd == '650':  # Partition Ready
+            self.logDebug(3, "Partition %s Ready", dat)
+            self.installerMode = False
+
+        elif cmd == '651':  # Partition Not Ready
+            self.logDebug(3, "Partition %s Not Ready", dat)
+            self.installerMode = False
+
+        elif cmd == '652':  # Partition Armed - Descriptive Mode
+            if len(dat) == 1:
+                partition = int(dat)
+                self.logDebug(3, "Alarm Armed. (Partition %d)", partition)
+                self.updateKeypad(partition, 'state', ALARM_STATE_ARMED)
+                # TODO: This response does not tell us armed type trigger.
+                #       Stay, Away, etc.  :(
+            elif len(dat) == 2:
+                m = re.search(r'^(.)(.)$', dat)
+                if m:
+                    (partition, mode) = (int(m.group(1)), int(m.group(2)))
+                    self.host.log(1,
+                                  "Alarm Armed in %s mode. (Partition %d)" %
+                                  (ARMED_MODE_LIST[mode], partition))
+                    if (mode == 0) or (mode == 2):
+                        armedEvent = 'armedAway'
+                        self.updateKeypad(partition,
+                                          'ArmedState',
+                                          ALARM_ARMED_STATE_AWAY)
+                    else:
+                        armedEvent = 'armedStay'
+                        self.updateKeypad(partition,
+                                          'ArmedState',
+                                          ALARM_ARMED_STATE_STAY)
+
+                    self.host.fireEvent(armedEvent)
+                    self.updateKeypad(partition,
+                                      'state',
+                                      ALARM_STATE_ARMED)
+
+        elif cmd == '653':  # Partition in Ready to Force Arm
+            # Partition Ready - Forced Arming Enabled
+            # We don't do anything with this now.
+            # Not implemented
+            self.host.log(1, "Partition in Ready to Force Arm. "
+                          "Not implemented!")
+
+        elif cmd == '654':  # Partition In Alarm
+            state = self.partitionState(int(dat))
+            if state is not None:
+                self.host.log(1, "Alarm TRIPPED! (Partition %d)" % int(dat))
+                self.updateKeypad(int(dat),
+                                  'state',
+                                  ALARM_STATE_TRIPPED)
+                self.host.fireEvent('eventAlarmTripped')
+                self.repeatAlarmTrippedNext = time.time()
+                state.alarmTripped = True
+
+        elif cmd == '655':  # Partition Disarmed
+            # If the alarm has been disarmed while it was tripped,
+            # update any zone state that were closed during the break in.
+            # We don't update them during the event so that the host's zone
+            # states will represent a zone as tripped during the entire event.
+            partition = int(dat)
+            state = self.partitionState(partition)
+            if state is not None:
+                if state.alarmTripped is True:
+                    state.alarmTripped = False
+                    for zone in state.closeTheseZonesList:
+                        self.updateZoneState(zone, ZONE_STATE_CLOSED)
+                    state.closeTheseZonesList = []
+
+                self.host.log(1, "Alarm Disarmed. (Partition %d)" %
+                              partition)
+                state.trippedZoneList = []
+                self.updateKeypad(partition,
+                                  'state',
+                                  ALARM_STATE_DISARMED)
+                self.updateKeypad(partition,
+                                  'ArmedState', ALARM_ARMED_STATE_DISARMED)
+                self.host.fireEvent('eventAlarmDisarmed')
+                self.speak('speakTextDisarmed')
+
+        elif cmd == '656':  # Exit Delay in Progress
+            self.host.log(1, "Exit Delay. (Partition %d)" % int(dat))
+            self.updateKeypad(int(dat), 'state', ALARM_STATE_EXIT_DELAY)
+            self.speak('speakTextArming')
+
+        elif cmd == '657':  # Entry Delay in Progress
+            self.host.log(1, "Entry Delay. (Partition %d)" % int(dat))
+            self.updateKeypad(int(dat), 'state', ALARM_STATE_ENTRY_DELAY)
+            self.speak('speakTextEntryDelay')
+
+        elif cmd == '658':  # Keypad Lock-out
+            # Not implemented
+            self.host.log(1, "Keypad Lock-out. Not implemented!")
+
+        elif cmd == '659':  # Keypad Blanking
+            # Not implemented
+            self.host.log(1, "Keypad Blanking. Not implemented!")
+
+        elif cmd == '660':  # Command Output In Progress
+            # Not implemented
+            self.host.log(1, "Command Output In Progress. Not implemented!")
+
+        elif cmd == '670':  # Invalid Access Code
+            # Not implemented
+            self.host.log(1, "Invalid Access Code. Not implemented!")
+
+        elif cmd == '671':  # Function Not Available
+            # Not implemented
+            self.host.log(1, "Function Not Available. Not implemented!")
+
+        elif cmd == '672':  # Fail to Arm
+            self.host.log(1, "Alarm Failed to Arm. (Partition %d)" %
+                          int(dat))
+            self.host.fireEvent('eventFailToArm')
+            self.speak('speakTextFailedToArm')
+
+        elif cmd == '673':  # Partition Busy
+            self.logDebug(3, "Partition %s Busy.", dat)
+            self.txThrottle(cmd, TX_HOLD_BUSY)
+
+        elif cmd == '680':  # System in Installer's Mode
+            # Labels can only be changed here, ask for them again once the
+            # partitions report in
+            self.host.log(1, "Panel in installer's mode.")
+            self.installerMode = True
+            self.labelsWanted = True
+
+        elif cmd == '700':  # User Closing
+            m = re.search(r'^(.)(....)$', dat)
+            if m:
+                (partition, user) = (int(m.group(1)), m.group(2))
+                self.host.log(1, "Alarm armed by user %s. (Partition %d)" %
+                              (user, partition))
+                self.host.fireUserEvent('userArmed', user)
+
+        elif cmd == '701':  # Special Closing
+            partition = int(dat)
+            self.host.log(1, "Alarm armed by one of the following methods: "
+                          "Quick Arm, Auto Arm, Keyswitch, DLS software, "
+                          "Wireless Key. (Partition %d)" % partition)
+
+        elif cmd == '702':  # Partial Closing
+            partition = int(dat)
+            self.host.log(1, "Alarm armed but one or more zones have been "
+                          "bypassed. (Partition %d)" % partition)
+
+        elif cmd == '750':  # User Opening
+            m = re.search(r'^(.)(....)$', dat)
+            if m:
+                (partition, user) = (int(m.group(1)), m.group(2))
+                self.host.log(1,
+                              "Alarm disarmed by user %s. (Partition %d)" %
+                              (user, partition))
+                self.host.fireUserEvent('userDisarmed', user)
+
+        elif cmd == '751':  # Special Opening
+            partition = int(dat)
+            self.host.log(1, "Alarm disarmed by one of the following "
+                          "methods: Quick Arm, Auto Arm, Keyswitch, "
+                          "DLS software, Wireless Key. (Partition %d)" %
+                          partition)
+
+        elif cmd == '800':  # Panel Battery Trouble
+            self.host.log(1, "Alarm panel battery is low.")
+            self.sendTroubleEmail("Alarm panel battery is low.")
+
+        elif cmd == '801':  # Panel Battery Trouble Restore
+            self.host.log(1, "Alarm panel battery is now ok.")
+            self.sendTroubleEmail("Alarm panel battery is now ok.")
+
+        elif cmd == '802':  # Panel AC Trouble
+            self.host.log(1, "AC Power Lost.")
+            self.sendTroubleEmail("AC Power Lost.")
+            self.host.fireEvent('eventNoticeAC_Trouble')
+
+        elif cmd == '803':  # Panel AC Restore
+            self.host.log(1, "AC Power Restored.")
+            self.sendTroubleEmail("AC Power Restored.")
+            self.host.fireEvent('eventNoticeAC_Restore')
+
+        elif cmd == '806':  # System Bell Trouble
+            self.host.log(1, "An open circuit has been detected across "
+                             "the bell terminals.")
+            self.sendTroubleEmail("An open circuit has been detected across "
+                                  "the bell terminals.")
+
+        elif cmd == '807':  # System Bell Trouble Restoral
+            self.host.log(1, "The bell circuit has been restored.")
+            self.sendTroubleEmail("The bell circuit has been restored.")
+
+        elif cmd == '810':  # TLM Line 1 Trouble
+            self.host.log(1, "The phone line is in an open or "
+                          "shorted condition.")
+            self.sendTroubleEmail("The phone line is in an open or "
+                                  "shorted condition.")
+
+        elif cmd == '811':  # TLM Line 1 Trouble Restored
+            self.host.log(1, "The phone line trouble condition has been "
+                          "restored.")
+            self.sendTroubleEmail("The phone line trouble condition has been "
+                                  "restored.")
+
+        elif cmd == '812':  # TLM Line 2 Trouble
+            self.host.log(1, "The secondary phone line is in an open or "
+                          "shorted condition.")
+            self.sendTroubleEmail("The secondary phone line is in an open or "
+                                  "shorted condition.")
+
+        elif cmd == '813':  # TLM Line 2 Trouble Restored
+            self.host.log(1, "The secondary phone line trouble condition "
+                          "has been restored.")
+            self.sendTroubleEmail("The secondary phone line trouble condition "
+                                  "has been restored.")
+
+        elif cmd == '814':  # FTC Trouble
+            # Not implemented
+            self.host.log(1, "FTC Trouble. Not implemented!")
+
+        elif cmd == '816':  # Buffer Near Full
+            self.host.log(2, "Buffer Near Full, slowing down transmission.")
+            self.txThrottle(cmd, TX_HOLD_BUFFER_FULL)
+
+        elif cmd == '821':  # General Device Low Battery
+            # Not implemented
+            self.host.log(1, "General Device Low Battery. Not implemented!")
+
+        elif cmd == '822':  # General Device Low Battery Restore
+            # Not implemented
+            self.host.log(1, "General Device Low Battery Restore. "
+                          "Not implemented!")
+
+        elif cmd == '825':  # Wireless Key Low Battery Trouble
+            # Not implemented
+            self.host.log(1, "Wireless Key Low Battery Trouble. "
+                          "Not implemented!")
+
+        elif cmd == '826':  # Wireless Key Low Battery Trouble Restore
+            # Not implemented
+            self.host.log(1, "Wireless Key Low Battery Trouble Restore. "
+                          "Not implemented!")
+
+        elif cmd == '827':  # Handheld Keypad Low Battery Trouble
+            # Not implemented
+            self.host.log(1, "Handheld Keypad Low Battery Trouble. "
+                          "Not implemented!")
+
+        elif cmd == '828':  # Handheld Keypad Low Battery Trouble Restore
+            # Not implemented
+            self.host.log(1, "Handheld Keypad Low Battery Trouble Restore. "
+                          "Not implemented!")
+
+        elif cmd == '829':  # General System Tamper
+            # Not implemented
+            self.host.log(1, "General System Tamper. "
+                          "Not implemented!")
+
+        elif cmd == '830':  # General System Tamper Restore
+            # Not implemented
+            self.host.log(1, "General System Tamper Restore. "
+                          "Not implemented!")
+
+        elif cmd == '831':  # Home Automation Trouble
+            # Not implemented
+            self.host.log(1, "Home Automation Trouble. "
+                          "Not implemented!")
+
+        elif cmd == '832':  # Home Automation Trouble Restore
+            # Not implemented
+            self.host.log(1, "Home Automation Trouble Restore. "
+                          "Not implemented!")
+
+        elif cmd == '840':  # Trouble Status (LED ON)
+            self.host.log(1, "Trouble Status (LED ON). (Partition %d)" %
+                          int(dat))
+            self.troubleClearedTimer = 0
+
+        elif cmd == '841':  # Trouble Status Restore (LED OFF)
+            self.host.log(2, "Trouble Status Restore (LED OFF). "
+                          "(Partition %d)" % int(dat))
+            if self.troubleCode > 0:
+                # If the trouble light goes off, set a 10 second timer.
+                # If the light is still off after 10 seconds we'll clear our
+                # status- This is required because the panel turns the light
+                # off/on quickly when the light is actually on.
+                self.troubleClearedTimer = 10
+
+        elif cmd == '842':  # Fire Trouble Alarm
+            # Not implemented
+            self.host.log(1, "Fire Trouble Alarm. "
+                          "Not implemented!")
+
+        elif cmd == '843':  # Fire Trouble Alarm Restore
+            # Not implemented
+            self.host.log(1, "Fire Trouble Alarm Restore. "
+                          "Not implemented!")
+
+        elif cmd == '900':  # Code Required
+            self.host.logError("Code Required")
+
+        elif cmd == '901':  # LCD Update
+            # for char in dat:
+            #     self.host.log(3, u"LCD DEBUG: %d" % ord(char))
+            m = re.search(r'^...(..)(.*)$', dat)
+            if m:
+                lcdText = re.sub(r'[^ a-zA-Z0-9_/\:-]+', ' ', m.group(2))
+                half = len(lcdText) // 2
+                half1 = lcdText[:half]
+                half2 = lcdText[half:]
+                self.logDebug(3, "LCD Update, Line 1:'%s' Line 2:'%s'",
+                              half1, half2)
+                self.updateKeypad(self.config.keypadPartition,
+                                  'LCDLine1', half1)
+                self.updateKeypad(self.config.keypadPartition,
+                                  'LCDLine2', half2)
+
+        elif cmd == '902':  # LCD Cursor
+            # Not implemented
+            self.host.log(1, "LCD Cursor. "
+                          "Not implemented!")
+
+        elif cmd == '903':  # LED Status
+            m = re.search(r'^(.)(.)$', dat)
+            if m:
+                (ledName, ledState) = (LED_INDEX_LIST[int(m.group(1))],
+                                       LED_STATE_LIST[int(m.group(2))])
+                self.logDebug(3, "LED '%s' is '%s'.", ledName, ledState)
+                if self.snapshot is not None:
+                    self.snapshot.setLed(int(m.group(1)), int(m.group(2)))
+
+                if ledState == 'flashing':
+                    ledState = 'on'
+                if ledName == 'Ready':
+                    self.updateKeypad(self.config.keypadPartition,
+                                      'LEDReady', ledState)
+                elif ledName == 'Armed':
+                    self.updateKeypad(self.config.keypadPartition,
+                                      'LEDArmed', ledState)
+                elif ledName == 'Trouble':
+                    self.updateKeypad(self.config.keypadPartition,
+                                      'LEDTrouble', ledState)
+
+        else:  # Unrecognized command
+            self.host.log(2, "Unrecognized command received "
+                          "(Cmd:%s Dat:%s)" % (cmd, dat))
+
+    ###########################################################################
+    # Transmit Flow Control
+    ###########################################################################
+
+    # Called when the panel tells us it can't keep up (with cmd). Stops
+    # transmitting for holdTime seconds and doubles the gap we leave between
+    # frames after that.
+    def txThrottle(self, cmd, holdTime):
+        self.metrics.txThrottles.inc(cmd)
+        self.txPace = min(max(self.txPace * 2, TX_PACE_MIN), TX_PACE_MAX)
+        self.txHoldUntil = max(self.txHoldUntil, time.time() + holdTime)
+        self.logDebug(3, "TX throttled for %.1f seconds, pacing is now "
+                      "%.2f seconds.", holdTime, self.txPace)
+
+    # Called for every acknowledged command, halves the gap between frames
+    # until we're back to sending at full speed.
+    def txRelax(self):
+        if self.txPace > 0:
+            self.txPace /= 2
+            if self.txPace < TX_PACE_MIN:
+                self.txPace = 0
+                self.logDebug(3, "TX pacing back to full speed.")
+
+    # Keeps reading and processing received packets until we're allowed to
+    # transmit again. Returns False on shutdown or if the port closed.
+    def waitForTxWindow(self):
+        while self.shutdown is False:
+            remaining = self.txHoldUntil - time.time()
+            if remaining <= 0:
+                return True
+            if self.port.inWaiting() > 0:
+                (rxCmd, rxData) = self.readPacket()
+                if rxCmd == '-':
+                    return False
+            else:
+                time.sleep(min(remaining, 0.05))
+        return False
+
+    ###########################################################################
+    # Device State Updating
+    ###########################################################################
+
+    # Updates temperature of DSC temperature sensor
+    def updateSensorTemp(self, sensorNum, key, temp):
+        if temp > 127:
+            temp = 127 - temp
+        self.logDebug(3, "Temp sensor %d %s temp now %d degrees.",
+                      sensorNum, key, temp)
+        if self.snapshot is not None:
+            self.snapshot.setTemp(sensorNum, key, temp, time.time())
+        sensor = self.tempList.get(sensorNum)
+        if sensor is not None:
+            self.tempHistory.add(sensorNum, key, temp, time.time())
+            stateName = TEMP_STATE_KEYS[key]
+            sensor.states[stateName] = temp
+            self.host.tempSensorChanged(sensor, {stateName: temp})
+
+            if sensor.logChanges is True:
+                self.host.log(1, "Temp sensor %d %s temp now %d degrees." %
+                              (sensorNum, key, temp))
+
+    # Updates zone group
+    def updateZoneGroup(self, group):
+        group.anyMemberTimer = 0
+        states = {'AnyMemberLastChangedTimer': 0}
+        newState = ZONE_GROUP_STATE_CLOSED
+        for zoneNum in group.zones:
+            zone = self.zoneList.get(zoneNum)
+            if zone is None:
+                continue
+            if zone.state != ZONE_STATE_CLOSED and \
+                    newState != ZONE_GROUP_STATE_TRIPPED:
+                if zone.state == ZONE_STATE_OPEN:
+                    newState = ZONE_GROUP_STATE_OPEN
+                elif zone.state == ZONE_STATE_TRIPPED:
+                    newState = ZONE_GROUP_STATE_TRIPPED
+
+        if group.state != newState:
+            group.state = newState
+            group.entireGroupTimer = 0
+            states['EntireGroupLastChangedTimer'] = 0
+            states['state'] = newState
+        self.host.zoneGroupChanged(group, states)
+
+    def updateZoneState(self, zoneKey, newState):
+        if self.snapshot is not None:
+            self.snapshot.setZone(zoneKey, newState, time.time())
+        zone = self.zoneList.get(zoneKey)
+
+        # If the new state is different from the old state
+        # then lets update timers and set the new state
+        if zone is None or zone.state == newState:
+            return
+
+        # This is a new state, update all states and timers
+        zone.state = newState
+        zone.timer = 0
+        self.host.zoneChanged(zone, {'LastChangedShort': '0m',
+                                     'LastChangedTimer': 0,
+                                     'state': newState})
+
+        # Update the zone groups this zone is assigned to
+        for group in self.zoneGroupIndex.get(zoneKey, ()):
+            self.updateZoneGroup(group)
+
+        now = time.time()
+        self.runRules(self.rules.zoneChanged(zone.number, newState, now))
+        self.zoneStats.zoneChanged(zone.number,
+                                   newState != ZONE_STATE_CLOSED, now)
+        if zone.occupancyGroup > 0:
+            area = self.occupancy.zoneChanged(zone.occupancyGroup,
+                                              zone.number,
+                                              newState != ZONE_STATE_CLOSED,
+                                              now)
+            if area is not None:
+                self.host.occupancyChanged(area, {'state': area.state})
+
+        self.updateVariable(zone.var, newState)
+
+        if newState == ZONE_STATE_TRIPPED:
+            self.host.log(1, "Alarm Zone '%s' TRIPPED!" % zone.name)
+
+        if zone.logChanges is True:
+            if newState == ZONE_STATE_OPEN:
+                self.host.log(1, "Alarm Zone '%s' Opened." % zone.name)
+            elif newState == ZONE_STATE_CLOSED:
+                self.host.log(1, "Alarm Zone '%s' Closed." % zone.name)
+
+    # Partition 0 updates every keypad. Only states that actually change
+    # are pushed to the host.
+    def updateKeypad(self, partition, stateName, newState):
+
+        self.logDebug(4, "Updating state %s for keypad "
+                      "on partition %u to %s.", stateName, partition, newState)
+
+        # If we're updating the main keypad state, update the variable too.
+        # The variable follows the partition of the IT-100's own keypad.
+        if stateName == 'state' and partition == self.config.keypadPartition:
+            self.updateVariable(self.config.variableState, newState)
+
+        if self.snapshot is not None:
+            now = time.time()
+            for number in ([partition] if partition > 0 else
+                           self.partitionList):
+                self.snapshot.setPartition(number, stateName, newState, now)
+
+        if partition == 0:
+            keypads = list(self.keypadList.values())
+        elif partition in self.keypadList:
+            keypads = [self.keypadList[partition]]
+        else:
+            return
+
+        for keypad in keypads:
+            if keypad.states.get(stateName) != newState:
+                keypad.states[stateName] = newState
+                self.host.keypadChanged(keypad, {stateName: newState})
+
+    def updateVariable(self, varId, value):
+        if varId is None:
+            return
+        self.logDebug(3, "Variable: %s", varId)
+        self.host.updateVariable(varId, value)
+
+    # Increments all zone and zone group changed timers, once a minute
+    def updateTimers(self):
+        for zone in list(self.zoneList.values()):
+            zone.timer += 1
+            self.host.zoneChanged(zone, {
+                'LastChangedTimer': zone.timer,
+                'LastChangedShort': getShortTime(zone.timer)})
+
+        for group in list(self.zoneGroupList.values()):
+            group.anyMemberTimer += 1
+            group.entireGroupTimer += 1
+            self.host.zoneGroupChanged(group, {
+                'AnyMemberLastChangedTimer': group.anyMemberTimer,
+                'EntireGroupLastChangedTimer': group.entireGroupTimer})
+
+    ###########################################################################
+    # Misc
+    ###########################################################################
+    # The name zoneNum was registered with, or else its panel label
+    def zoneName(self, zoneNum):
+        if zoneNum in self.zoneList:
+            return self.zoneList[zoneNum].name
+        label = self.labels.zoneLabel(zoneNum)
+        if label is not None:
+            return label
+        return "Zone %d" % zoneNum
+
+    # Lists the zones tripped so far in the alarm on partition
+    def sendZoneTrippedEmail(self, partition):
+
+        if len(self.config.emailUrgent) == 0 or \
+                len(partition.trippedZoneList) == 0:
+            return
+
+        theBody = "The following zone(s) have been tripped:\n\n"
+
+        for zoneNum in partition.trippedZoneList:
+
+            if zoneNum in partition.closeTheseZonesList:
+                stateNow = "closed"
+            else:
+                stateNow = "open"
+
+            theBody += "%s (currently %s)\n" % (self.zoneName(zoneNum),
+                                                 stateNow)
+
+        theBody += "\n--\nDSC Alarm Plugin\n\n"
+
+        self.host.log(1, "Sending zone tripped email to %s." %
+                      self.config.emailUrgent)
+
+        contentPrefix = self.config.emailUrgentContent
+        if len(contentPrefix) > 0:
+            theBody = contentPrefix + "\n\n" + theBody
+
+        self.host.sendEmail(self.config.emailUrgent,
+                            self.config.emailUrgentSubject, theBody)
+
+    def sendTroubleEmail(self, bodyText):
+        self.host.panelChanged({'trouble': bodyText})
+        if len(self.config.emailNotice) == 0:
+            return
+
+        self.host.log(1, "Sending trouble email to %s." %
+                      self.config.emailNotice)
+
+        contentPrefix = self.config.emailNoticeContent
+        if len(contentPrefix) > 0:
+            bodyText = contentPrefix + "\n\n" + bodyText
+
+        self.host.sendEmail(self.config.emailNotice,
+                            self.config.emailNoticeSubject, bodyText)
+
+    def sayThis(self, text):
+        self.logDebug(3, "SAY: %s", text)
+        self.host.speak(text)
+
+    def speak(self, textId):
+        self.logDebug(3, "ID: %s", textId)
+        if self.config.speakingEnabled is False:
+            return
+
+        text = self.config.speakTexts.get(textId, '')
+        if len(text) == 0:
+            return
+
+        if textId == 'speakTextFailedToArm':
+            zones = 0
+            zoneText = ''
+            for zone in list(self.zoneList.values()):
+                if zone.state == ZONE_STATE_OPEN:
+                    if zones > 0:
+                        zoneText += ', '
+                    zoneText += zone.name.replace("Alarm_", "")
+                    zones += 1
+
+            if zones == 0:
+                say = text
+            elif zones == 1:
+                say = text + \
+                    '  The ' + zoneText + ' is open.'
+            else:
+                say = text + \
+                    '  The following zones are open: ' + zoneText + '.'
+
+            self.sayThis(say)
+
+        elif textId == 'speakTextTripped':
+            zones = 0
+            zoneText = ''
+            for zoneNum in [zoneNum for partition in self.trippedPartitions()
+                            for zoneNum in partition.trippedZoneList]:
+                if zones > 0:
+                    zoneText += ', '
+                zoneText += self.zoneName(zoneNum).replace("Alarm_", "")
+                zones += 1
+            if zones == 1:
+                say = text + \
+                    '  The ' + zoneText + ' has been tripped.'
+            else:
+                say = text + \
+                    '  The following zones have been tripped: ' + \
+                    zoneText + '.'
+            self.sayThis(say)
+        else:
+            self.sayThis(text)
+
+    ###########################################################################
+    # Run Loop
+    ###########################################################################
+
+    # Talks to the panel until stop() is called, reconnecting as needed
+    def run(self):
+        self.host.log(3, "Engine run called")
+        self.threadId = threading.get_ident()
+        self.minuteTracker = time.time() + 60
+        self.minutesRun = 0
+        self.nextUpdateCheckTime = 0
+
+        # While we haven't been told to shutdown
+        while self.shutdown is False:
+
+            self.timeNow = time.time()
+
+            if self.pendingPrefs is not None:
+                (prefs, self.pendingPrefs) = (self.pendingPrefs, None)
+                self.reload(prefs)
+
+            if self.state == self.States.STARTUP:
+                self.host.log(3, "STATE: Startup")
+
+                if self.configRead is False:
+                    if self.readConfiguration(self.prefs) is True:
+                        self.configRead = True
+
+                if self.configRead is True:
+                    self.state = self.States.BOTH_INIT
+                else:
+                    # Wait for usable prefs without holding up a start
+                    # that has them
+                    self.host.sleep(1)
+
+            elif self.state == self.States.HOLD:
+                if self.configRead is False:
+                    self.state = self.States.STARTUP
+                self.host.sleep(1)
+
+            elif self.state == self.States.HOLD_RETRY:
+                self.host.log(1, "Plugin will attempt to re-initialize "
+                              "again in %u minutes." %
+                              self.currentHoldRetryTime)
+                self.nextRetryTime = self.timeNow + \
+                    (HOLD_RETRY_TIME_MINUTES * 60)
+                self.state = self.States.HOLD_RETRY_LOOP
+
+            elif self.state == self.States.HOLD_RETRY_LOOP:
+                if self.configRead is False:
+                    self.state = self.States.STARTUP
+                if self.timeNow >= self.nextRetryTime:
+                    self.state = self.States.BOTH_INIT
+                self.host.sleep(1)
+
+            elif self.state == self.States.BOTH_INIT:
+                self.metrics.linkUp.set(0)
+                if self.snapshot is not None:
+                    self.snapshot.setLinkUp(False)
+                if self.portOpened is True:
+                    self.metrics.reconnects.inc()
+                started = time.time()
+                if self.openPort() is True:
+                    self.startupPhase('connect', started)
+                    self.portOpened = True
+                    self.state = self.States.ENABLE_TIME_BROADCAST
+                else:
+                    self.host.logError('Error opening port, will retry in '
+                                       '%u minutes.' %
+                                       self.currentHoldRetryTime)
+                    self.state = self.States.HOLD_RETRY
+
+            elif self.state == self.States.ENABLE_TIME_BROADCAST:
+                # Enable time broadcast
+                self.host.log(2, "Enabling Time Broadcast")
+                started = time.time()
+                rx = self.sendPacket('0561')
+                if len(rx) > 0:
+                    self.startupPhase('timeBroadcast', started)
+                    self.host.log(2, "Time Broadcast enabled.")
+                    self.state = self.States.BOTH_PING
+                else:
+                    self.host.logError('Error enabling Time Broadcast.')
+                    self.state = self.States.HOLD_RETRY
+
+            elif self.state == self.States.BOTH_PING:
+                # Ping the panel to confirm we are in communication
+                err = True
+                self.host.log(2, "Pinging the panel to test "
+                              "communication...")
+                started = time.time()
+                rx = self.sendPacket('000')
+                if len(rx) > 0:
+                    self.startupPhase('ping', started)
+                    self.host.log(2, "Ping was successful.")
+                    err = False
+                else:
+                    self.host.logError('Error pinging panel, aborting.')
+
+                if err is True:
+                    self.state = self.States.HOLD_RETRY
+                else:
+                    # Request a full state update
+                    self.host.log(2, "Requesting a full state update.")
+                    started = time.time()
+                    rx = self.sendPacket('001')
+                    if len(rx) == 0:
+                        self.host.logError('Error getting state update.')
+                        self.state = self.States.HOLD_RETRY
+                    else:
+                        self.host.log(2, "State update request successful, "
+                                      "initialization complete, "
+                                      "starting normal operation.")
+                        self.startupPhase('stateUpdate', started)
+                        self.reportStartup()
+                        self.metrics.linkUp.set(1)
+                        if self.snapshot is not None:
+                            self.snapshot.setLinkUp(True)
+                        self.state = self.States.BOTH_POLL
+
+            elif self.state == self.States.BOTH_POLL:
+                if self.configRead is False:
+                    self.state = self.States.STARTUP
+                else:
+                    if self.labelsWanted is True and \
+                            self.installerMode is False:
+                        self.labelsWanted = False
+                        self.queueCommand(CMD_NORMAL, '002')
+                    if len(self.txCmdList) > 0:
+                        (cmdType, data, queuedAt,
+                         batchRef) = self.txCmdList[0]
+                        self.metrics.queueWait.observe(self.timeNow -
+                                                       queuedAt)
+                        if batchRef is not None and \
+                                batchRef[0].shouldSend(batchRef[1],
+                                                       time.time()) is False:
+                            # Part of a batch that timed out or failed
+                            del self.txCmdList[0]
+
+                        elif cmdType == CMD_NORMAL:
+                            txRsp = self.sendPacket(data)
+                            if txRsp == '-':
+                                # If we receive - socket has closed,
+                                # lets re-init
+                                self.host.logError('Tried to send data but '
+                                                   'socket seems to have '
+                                                   'closed.  Trying to '
+                                                   're-initialize.')
+                                self.state = self.States.BOTH_INIT
+                            else:
+                                # send was a success, remove command from queue
+                                del self.txCmdList[0]
+                                if batchRef is not None:
+                                    batchRef[0].frameSent(batchRef[1],
+                                                          len(txRsp) > 0)
+
+                        elif cmdType == CMD_THERMO_SET:
+                            acked = self.setThermostat(data)
+                            del self.txCmdList[0]
+                            if batchRef is not None:
+                                batchRef[0].frameSent(batchRef[1], acked)
+                    else:
+                        (rxRsp, rxData) = self.readPacket()
+                        if rxRsp == '-':
+                            # If we receive - socket has closed, lets re-init
+                            self.host.logError('Tried to read data but '
+                                               'socket seems to have '
+                                               'closed. Trying to '
+                                               're-initialize.')
+                            self.state = self.States.BOTH_INIT
+
+            # Check if the trouble timer counter is timing
+            # We need to know if the trouble light has remained off
+            # for a few seconds before we assume the trouble is cleared
+            if self.troubleClearedTimer > 0:
+                self.troubleClearedTimer -= 1
+                if self.troubleClearedTimer == 0:
+                    self.troubleCode = 0
+                    self.sendTroubleEmail("Trouble Code Cleared")
+
+            for area in self.occupancy.expire(self.timeNow):
+                self.host.occupancyChanged(area, {'state': area.state})
+
+            self.runRules(self.rules.tick(self.timeNow))
+
+            if len(self.trippedPartitions()) > 0:
+                if self.timeNow >= self.repeatAlarmTrippedNext:
+                    self.repeatAlarmTrippedNext = self.timeNow + 12
+                    self.speak('speakTextTripped')
+
+            # If a minute has elapsed
+            if self.timeNow >= self.minuteTracker:
+
+                self.host.minuteElapsed()
+
+                if self.capture is not None:
+                    self.capture.flush()
+
+                self.minutesRun += 1
+                if self.minutesRun % dscTempHistory.TEMP_SAVE_MINUTES == 0:
+                    self.saveTempHistory()
+                self.saveLabels()
+
+                self.minuteTracker += 60
+                self.updateTimers()
+
+        self.closePort()
+        self.setCapture('')
+        self.saveTempHistory()
+        self.saveLabels()
+        self.setSnapshotFile('')
+        self.stopTrace()
+        self.host.log(3, "Exiting engine run")
+
+    # Makes run() return, may be called from any thread
+    def stop(self):
+        self.shutdown = True
@@ -0,0 +1,208 @@
+#######################################################################
+# DSC Alarm state feed
+#
+# Keeps the current state of every device the host has been told about
+# and the most recent changes, numbered by a sequence counter, and
+# serves them over the local HTTP server so clients can be pushed
+# changes instead of polling:
+#
+#   GET /state                 all device states, with an ETag
+#   GET /events?since=N        changes after N, waits for one if none
+#   GET /events/stream         the same as Server-Sent Events
+#
+# /events and /events/stream take zones=1,2,... and partitions=1,...
+# to only see changes of those zones and partitions. Every response
+# carries the sequence number to resume from, SSE clients resume with
+# Last-Event-ID. A client that has fallen further behind than the feed
+# remembers is told to fetch /state again, /events answers 410 and the
+# stream sends a reset event.
+#######################################################################
+
+import collections
+import itertools
+import json
+import threading
+import time
+
+FEED_SIZE = 10000  # Changes remembered for clients catching up
+FEED_POLL_TIMEOUT = 30  # Default seconds a long poll waits
+FEED_MAX_TIMEOUT = 300
+FEED_KEEPALIVE = 15  # Seconds between comments on an idle stream
+
+
+# Parses "1,2,3" into a set of ints, None if not given
+def parseNumbers(text):
+    if text is None or len(text) == 0:
+        return None
+    return set(int(number) for number in text.split(','))
+
+
+# Returns a function telling whether an event is wanted. Without filters
+# everything is, otherwise only changes of the given zones and partitions.
+def eventFilter(zones, partitions):
+    if zones is None and partitions is None:
+        return lambda event: True
+
+    def match(event):
+        return (zones is not None and event[4] in zones) or \
+            (partitions is not None and event[5] in partitions)
+    return match
+
+
+def eventDict(event):
+    (seq, timestamp, kind, hostRef, zone, partition, states) = event
+    d = {'seq': seq, 't': round(timestamp, 3), 'type': kind, 'id': hostRef,
+         'states': states}
+    if zone is not None:
+        d['zone'] = zone
+    if partition is not None:
+        d['partition'] = partition
+    return d
+
+
+class StateFeed(object):
+
+    def __init__(self, size=FEED_SIZE):
+        self.events = collections.deque(maxlen=size)
+        self.devices = {}
+        # Start from the clock so cursors from an earlier run of the
+        # gateway are seen as stale rather than resuming at the wrong place
+        self.seq = int(time.time() * 1000)
+        self.cond = threading.Condition()
+        self.closed = False
+        self.snapshotCache = (None, None)
+
+    # Records a change of the states of hostRef. Called from the engine
+    # thread, so this only appends and wakes up waiting clients.
+    def publish(self, kind, hostRef, states, zone=None, partition=None):
+        with self.cond:
+            self.seq += 1
+            device = self.devices.get(hostRef)
+            if device is None:
+                device = {'type': kind, 'states': {}}
+                if zone is not None:
+                    device['zone'] = zone
+                if partition is not None:
+                    device['partition'] = partition
+                self.devices[hostRef] = device
+            device['states'].update(states)
+            self.events.append((self.seq, time.time(), kind, hostRef, zone,
+                                partition, dict(states)))
+            self.cond.notify_all()
+
+    # Wakes up and ends all waiting clients
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    # Returns (seq, JSON of all devices), the JSON is only rebuilt after
+    # something changed
+    def snapshot(self):
+        with self.cond:
+            if self.snapshotCache[0] != self.seq:
+                self.snapshotCache = (self.seq, json.dumps(
+                    {'seq': self.seq, 'devices': self.devices}))
+            return self.snapshotCache
+
+    # Matching events after seq, None if the feed no longer goes back
+    # that far. Called with cond held.
+    def eventsSince(self, seq, match):
+        if seq > self.seq:
+            return None
+        if len(self.events) == 0:
+            return []
+        oldest = self.events[0][0]
+        if seq < oldest - 1:
+            return None
+        return [event for event in
+                itertools.islice(self.events, seq - oldest + 1, None)
+                if match(event)]
+
+    # Waits up to timeout seconds for events after seq that match.
+    # Returns (seq to resume from, events or None if seq is too old).
+    def wait(self, seq, match, timeout):
+        endTime = time.time() + timeout
+        with self.cond:
+            while True:
+                events = self.eventsSince(seq, match)
+                if events is None or len(events) > 0 or self.closed is True:
+                    return (self.seq, events)
+                # Nothing we want so far, don't look at those again
+                seq = self.seq
+                remaining = endTime - time.time()
+                if remaining <= 0:
+                    return (seq, [])
+                self.cond.wait(remaining)
+
+    ###########################################################################
+    # HTTP Endpoints
+    ###########################################################################
+
+    # Adds the feed's endpoints to a dscHttp.HttpServer
+    def addHttpRoutes(self, server):
+        server.addRoute('GET', '/state', self.httpState)
+        server.addRoute('GET', '/events', self.httpEvents)
+        server.addRoute('GET', '/events/stream', self.httpStream)
+
+    def httpState(self, request):
+        (seq, body) = self.snapshot()
+        etag = '"%d"' % seq
+        if request.headers.get('If-None-Match') == etag:
+            return (304, 'application/json', '', {'ETag': etag})
+        return (200, 'application/json', body, {'ETag': etag})
+
+    # Returns (since, match) from the query, or None if it's not valid
+    def parseQuery(self, request, since):
+        try:
+            since = int(request.query.get('since', since))
+            match = eventFilter(parseNumbers(request.query.get('zones')),
+                                parseNumbers(request.query.get('partitions')))
+        except ValueError:
+            return None
+        return (since, match)
+
+    # /events?since=N[&zones=..][&partitions=..][&timeout=S]
+    def httpEvents(self, request):
+        query = self.parseQuery(request, self.seq)
+        if query is None:
+            return (400, 'text/plain', 'Invalid query.\n')
+        (since, match) = query
+        try:
+            timeout = float(request.query.get('timeout', FEED_POLL_TIMEOUT))
+        except ValueError:
+            return (400, 'text/plain', 'Invalid timeout.\n')
+        timeout = max(0, min(timeout, FEED_MAX_TIMEOUT))
+        (seq, events) = self.wait(since, match, timeout)
+        if events is None:
+            return (410, 'application/json', json.dumps({'seq': seq}))
+        return (200, 'application/json',
+                json.dumps({'seq': seq,
+                            'events': [eventDict(e) for e in events]}))
+
+    # /events/stream[?since=N][&zones=..][&partitions=..]
+    def httpStream(self, request):
+        query = self.parseQuery(request, request.headers.get(
+            'Last-Event-ID', self.seq))
+        if query is None:
+            return (400, 'text/plain', 'Invalid query.\n')
+        (since, match) = query
+        request.startStream('text/event-stream')
+        try:
+            while self.closed is False:
+                (seq, events) = self.wait(since, match, FEED_KEEPALIVE)
+                if events is None:
+                    text = 'id: %d\nevent: reset\ndata: {"seq": %d}\n\n' % \
+                        (seq, seq)
+                elif len(events) == 0:
+                    text = ': keepalive\n\n'
+                else:
+                    text = ''.join('id: %d\nevent: %s\ndata: %s\n\n' %
+                                   (e[0], e[2], json.dumps(eventDict(e)))
+                                   for e in events)
+                request.wfile.write(text.encode('utf-8'))
+                since = seq
+        except (IOError, OSError):
+            # The client went away
+            pass
+        return None
@@ -1 +1,518 @@
 #!/usr/bin/python3
+#######################################################################
+# DSC Alarm to Fibaro Home Center 2 gateway
+#
+# Runs the engine from dscCore.py as a standalone process, configured
+# from a JSON file:
+#
+#   {"prefs": {"serialPort": "/dev/ttyUSB0", "code": "1234"},
+#    "httpPort": 8080,
+#    "hc2": {"address": "192.168.1.10", "user": "admin",
+#            "password": "secret"},
+#    "zones": [{"number": 1, "name": "Front Door", "partition": 1,
+#               "logChanges": true, "hc2Id": 123}],
+#    "zoneGroups": [{"id": "downstairs", "name": "Downstairs",
+#                    "zones": [1, 2, 3]}],
+#    "keypads": [{"partition": 1, "name": "Keypad"}],
+#    "areas": [{"group": 1, "name": "Kitchen", "hc2Id": 124}],
+#    "tempSensors": [{"number": 1, "name": "Hall"}]}
+#
+# prefs takes the same keys as the Indigo plugin's preferences, plus
+# keypadPartition, the partition of the IT-100's own keypad whose LCD and
+# LEDs the panel reports (1 by default). Zones belong to partition 1
+# unless given another. Zones, keypads and sensors can be given an "id"
+# to be known by, by default it's their name. Those with an "hc2Id" have
+# their states sent to that HC2 device, variables (prefs variableState
+# and zone "var") are set as HC2 global variables. hc2 also takes port,
+# batchWindow, connections, retries, storeFile, maxPending, probeInterval
+# and drainRate, see hc2.py.
+#
+# Zones with an occupancyGroup make up occupancy areas (dscOccupancy.py),
+# "areas" names them and maps them to HC2 devices. prefs occupancyMinutes
+# and occupancyWindowMinutes set when an area turns vacant and how far
+# back its activity is counted.
+#
+# prefs zoneStatsWindows lists the windows, in minutes, over which
+# /zones/stats reports open-duration statistics (dscZoneStats.py).
+#
+# prefs tempHistoryFile keeps the temperature history served on
+# /temperature (dscTempHistory.py) across restarts. With several panels
+# give each its own.
+#
+# With an "mqtt" section ({"address": ..., "port", "user", "password",
+# "prefix", "keepalive", "batchWindow"}) every state is also published
+# to an MQTT broker as a retained message (dscMqtt.py). With "commands":
+# true it also takes commands, on <prefix>/partition/<n>/set (armStay,
+# armAway or disarm, or Home Assistant's ARM_HOME, ARM_AWAY and DISARM)
+# and <prefix>/commands (a batch as for POST /commands). With several
+# panels the command topics start with the panel id after the prefix.
+# Batches and disarming need the mqtt section's "commandToken" (the top
+# level one if it has none) in the message:
+#
+#   <prefix>/partition/1/set  {"action": "DISARM", "token": "..."}
+#   <prefix>/commands         {"token": "...", "commands": [...]}
+#
+# prefs labelCacheFile keeps the labels programmed into the panel,
+# served on /labels (dscLabels.py), so they aren't asked for on every
+# start. Panels can share one file.
+#
+# prefs snapshotFile keeps the panel's state in a memory-mapped file
+# local programs can read without going through the gateway
+# (dscSnapshot.py). With several panels give each its own.
+#
+# "rules" lists automations the engine runs itself, like starting an HC2
+# scene when a zone group has been open for 10 minutes (dscRules.py).
+#
+# On SIGHUP the file is read again and every panel switches to its new
+# prefs without dropping the link to the panel, unless its serialPort or
+# tpiPassword changed (dscConfig.py). Devices, rules and the other
+# sections only change on a restart.
+#
+# With "split": true (or {"httpPort": ..., "ringKB": ...}) every panel's
+# engine runs in a process of its own at raised priority, and this
+# process only does the integrations (dscSplit.py). The engines'
+# endpoints (/occupancy, /commands and the like) are then served by
+# their processes on split httpPort and the ports after it, so
+# commandToken needs one. /metrics here still has the engines' metrics,
+# as their processes last sent them.
+#
+# With "commandToken" set, POST /commands takes batches of actions (see
+# dscBatch.py) from clients sending "Authorization: Bearer <token>".
+#
+# To serve several panels from one process, list them under "panels",
+# each with an "id" and its own prefs (at least serialPort), zones,
+# zoneGroups, keypads and tempSensors. The top level prefs then hold the
+# settings all panels share, and the logLevel the gateway logs at is
+# only taken from there. Device ids become "<panel id>/<id>", metrics
+# get a panel label, and /commands, /occupancy, /zones/stats, /temperature,
+# /rules and /labels take ?panel=<panel id>:
+#
+#   {"prefs": {"code": "1234"}, "hc2": {...},
+#    "panels": [{"id": "north", "prefs": {"serialPort": "/dev/ttyUSB0"},
+#                "zones": [...]},
+#               {"id": "south", "prefs": {"serialPort": "/dev/ttyUSB1"},
+#                "zones": [...]}]}
+#
+#   ./dscHc2Gateway.py gateway.json
+#######################################################################
+
+import argparse
+import collections
+import hmac
+import json
+import signal
+import threading
+import time
+
+import dscBatch
+import dscCore
+import dscHost
+import dscHttp
+import dscMetrics
+import dscMqtt
+import dscProfiler
+import dscSplit
+import hc2
+
+# Payloads of <prefix>/partition/<n>/set, lowercased
+MQTT_ACTIONS = {'armstay': 'armStay', 'armaway': 'armAway',
+                'disarm': 'disarm', 'arm_home': 'armStay',
+                'arm_away': 'armAway'}
+
+
+def loadConfig(fileName):
+    with open(fileName) as f:
+        return json.load(f)
+
+
+# Returns [(panel id, panel config)]. Without "panels" the top level is
+# the config of the only panel, which has no id.
+def panelConfigs(config):
+    if 'panels' not in config:
+        return [(None, config)]
+    panels = []
+    for panel in config['panels']:
+        prefs = dict(config.get('prefs', {}))
+        prefs.update(panel.get('prefs', {}))
+        panelConfig = dict(panel)
+        panelConfig['prefs'] = prefs
+        panels.append((str(panel['id']), panelConfig))
+    return panels
+
+
+# Returns the id a configured device is registered with, after telling
+# the host which HC2 device it maps to
+def deviceRef(host, entry, panelId=None):
+    hostRef = entry.get('id', entry['name'])
+    if panelId is not None:
+        hostRef = '%s/%s' % (panelId, hostRef)
+    if 'hc2Id' in entry:
+        host.mapDevice(hostRef, entry['hc2Id'])
+    return hostRef
+
+
+# Registers the configured devices of a panel with its engine
+def registerDevices(engine, config, host, panelId=None):
+    for zone in config.get('zones', []):
+        if engine.addZone(int(zone['number']), zone['name'],
+                          deviceRef(host, zone, panelId),
+                          logChanges=zone.get('logChanges', False),
+                          occupancyGroup=int(zone.get('occupancyGroup', 0)),
+                          var=zone.get('var'),
+                          partition=int(zone.get('partition', 1))) is None:
+            engine.host.logError("Zone %s is configured twice." %
+                                 zone['number'])
+
+    for group in config.get('zoneGroups', []):
+        engine.addZoneGroup(group['name'], deviceRef(host, group, panelId),
+                            [int(zone) for zone in group['zones']])
+
+    for keypad in config.get('keypads', []):
+        engine.addKeypad(int(keypad['partition']), keypad['name'],
+                         deviceRef(host, keypad, panelId))
+
+    for area in config.get('areas', []):
+        engine.occupancy.addArea(int(area['group']), area['name'],
+                                 deviceRef(host, area, panelId))
+
+    for sensor in config.get('tempSensors', []):
+        if engine.addTempSensor(int(sensor['number']), sensor['name'],
+                                deviceRef(host, sensor, panelId),
+                                sensor.get('logChanges', False)) is None:
+            engine.host.logError("Temperature sensor %s is configured "
+                                 "twice." % sensor['number'])
+
+    if 'rules' in config:
+        engine.setRules(config['rules'])
+
+
+# Creates the HC2 client from the hc2 section of the config, if any
+def newHc2Client(config, host):
+    hc2Config = config.get('hc2')
+    if hc2Config is None:
+        return None
+    return hc2.Hc2Client(
+        hc2Config['address'], int(hc2Config.get('port', 80)),
+        hc2Config.get('user', ''), hc2Config.get('password', ''),
+        batchWindow=float(hc2Config.get('batchWindow',
+                                        hc2.HC2_BATCH_WINDOW)),
+        connections=int(hc2Config.get('connections', hc2.HC2_CONNECTIONS)),
+        retries=int(hc2Config.get('retries', hc2.HC2_RETRIES)),
+        logger=host,
+        storeFile=hc2Config.get('storeFile'),
+        maxPending=int(hc2Config.get('maxPending', hc2.HC2_MAX_PENDING)),
+        probeInterval=float(hc2Config.get('probeInterval',
+                                          hc2.HC2_PROBE_INTERVAL)),
+        drainRate=float(hc2Config.get('drainRate', hc2.HC2_DRAIN_RATE)))
+
+
+# Creates the MQTT client from the mqtt section of the config, if any
+def newMqttClient(config, host):
+    mqttConfig = config.get('mqtt')
+    if mqttConfig is None:
+        return None
+    return dscMqtt.MqttClient(
+        mqttConfig['address'], int(mqttConfig.get('port', dscMqtt.MQTT_PORT)),
+        mqttConfig.get('clientId', 'dsc'), mqttConfig.get('user', ''),
+        mqttConfig.get('password', ''),
+        mqttConfig.get('prefix', dscMqtt.MQTT_PREFIX),
+        keepalive=int(mqttConfig.get('keepalive', dscMqtt.MQTT_KEEPALIVE)),
+        batchWindow=float(mqttConfig.get('batchWindow',
+                                         dscMqtt.MQTT_BATCH_WINDOW)),
+        logger=host)
+
+
+# Wraps an HTTP handler so it only answers requests carrying token
+def requireToken(token, handler):
+    expected = ('Bearer ' + token).encode('utf-8')
+
+    def check(request):
+        given = request.headers.get('Authorization', '').encode('utf-8')
+        if not hmac.compare_digest(given, expected):
+            # Read, or it would be taken for the next request on the
+            # connection
+            request.body()
+            return (401, 'text/plain', 'Unauthorized\n',
+                    {'WWW-Authenticate': 'Bearer'})
+        return handler(request)
+    return check
+
+
+# The engines of all configured panels. Each runs its own serial loop on
+# a thread of its own, they share the host, HC2 client, feed and HTTP
+# server.
+class PanelSet(object):
+
+    def __init__(self):
+        self.engines = collections.OrderedDict()
+        self.metrics = dscMetrics.PanelRegistry()
+        self.threads = []
+        self.mqttToken = None
+
+    def add(self, panelId, engine):
+        self.engines[panelId] = engine
+        self.metrics.addPanel(panelId, engine.metrics)
+
+    # Metrics all panels share, like the HC2 client's. With one panel
+    # they go with the engine's so its page looks as it always has.
+    def addMetric(self, metric):
+        if len(self.engines) == 1:
+            list(self.engines.values())[0].metrics.add(metric)
+        else:
+            self.metrics.add(metric)
+
+    # Runs every engine until all have stopped
+    def run(self):
+        for (panelId, engine) in self.engines.items():
+            thread = threading.Thread(target=engine.run,
+                                      name='dsc-%s' % (panelId or 'panel'))
+            thread.start()
+            self.threads.append(thread)
+        # Joined with a timeout so signals still reach the main thread
+        for thread in self.threads:
+            while thread.is_alive():
+                thread.join(1)
+
+    def stop(self):
+        for engine in self.engines.values():
+            engine.stop()
+
+    # Hands the prefs of config to the engines, each switches to them on
+    # its own thread. Panels not running already are left out.
+    def reload(self, config):
+        for (panelId, panelConfig) in panelConfigs(config):
+            engine = self.engines.get(panelId)
+            if engine is not None:
+                engine.reloadConfiguration(panelConfig['prefs'])
+
+    def profiledThreads(self):
+        threadIds = [engine.threadId for engine in self.engines.values()
+                     if engine.threadId is not None]
+        return threadIds or None
+
+    ###########################################################################
+    # HTTP Endpoints
+    ###########################################################################
+    def addHttpRoutes(self, server, commandToken=None):
+        server.addRoute('GET', '/metrics', self.httpMetrics)
+        server.addRoute('GET', '/debug/profile', self.httpProfile)
+        for (path, handlerName) in (('/occupancy', 'httpOccupancy'),
+                                    ('/zones/stats', 'httpZoneStats'),
+                                    ('/temperature', 'httpTemperature'),
+                                    ('/rules', 'httpRules'),
+                                    ('/labels', 'httpLabels')):
+            server.addRoute('GET', path, self.panelHandler(handlerName))
+        if commandToken:
+            server.addRoute('POST', '/commands',
+                            requireToken(commandToken,
+                                         self.panelHandler('httpCommands')))
+
+    # Returns a handler passing requests to the engine handler of the same
+    # name of the panel given by ?panel=<panel id>, the first by default
+    def panelHandler(self, handlerName):
+        def handler(request):
+            panelId = request.query.get('panel')
+            if panelId is None:
+                engine = list(self.engines.values())[0]
+            else:
+                engine = self.engines.get(panelId)
+            if engine is None:
+                return (404, 'text/plain', 'No panel %s.\n' % panelId)
+            return getattr(engine, handlerName)(request)
+        return handler
+
+    ###########################################################################
+    # MQTT Commands
+    ###########################################################################
+    def addMqttSubscriptions(self, mqtt, commandToken):
+        self.mqttToken = commandToken.encode('utf-8')
+        mqtt.onMessage = self.mqttMessage
+        mqtt.subscribe('partition/+/set')
+        mqtt.subscribe('commands')
+        if len(self.engines) > 1:
+            mqtt.subscribe('+/partition/+/set')
+            mqtt.subscribe('+/commands')
+
+    # Queues the commands of a message on a command topic, topic is
+    # without the prefix. Batches and disarming have to carry the token,
+    # anyone able to publish to the broker could send them otherwise.
+    def mqttMessage(self, topic, message):
+        levels = topic.split('/')
+        engine = self.engines.get(levels[0])
+        if engine is not None:
+            levels.pop(0)
+        else:
+            engine = list(self.engines.values())[0]
+
+        timeout = dscBatch.BATCH_TIMEOUT
+        if levels == ['commands']:
+            body = json.loads(message)
+            self.checkMqttToken(body)
+            (specs, timeout) = dscBatch.parseBatch(body)
+        elif len(levels) == 3 and levels[0] == 'partition' and \
+                levels[2] == 'set':
+            # A bare action, or an object with the action and the token
+            body = message.strip()
+            if body.startswith('{'):
+                body = json.loads(body)
+                name = body.get('action') if isinstance(body, dict) else None
+            else:
+                (name, body) = (body, None)
+            action = MQTT_ACTIONS.get(str(name).lower())
+            if action is None:
+                raise ValueError('unknown action %r' % name)
+            if action == 'disarm':
+                self.checkMqttToken(body)
+            specs = [{'action': action, 'partition': int(levels[1])}]
+        else:
+            return
+
+        (batch, errors) = engine.queueBatch(specs, timeout)
+        if batch is None:
+            engine.host.logError('Invalid commands on MQTT topic %s: %s' %
+                                 (topic, errors))
+
+    # Raises ValueError unless body is an object with the right token
+    def checkMqttToken(self, body):
+        given = body.get('token') if isinstance(body, dict) else None
+        if not isinstance(given, str) or \
+                not hmac.compare_digest(given.encode('utf-8'),
+                                        self.mqttToken):
+            raise ValueError('missing or wrong token')
+
+    def httpMetrics(self, request):
+        if len(self.engines) == 1:
+            return list(self.engines.values())[0].httpMetrics(request)
+        return (200, 'text/plain; version=0.0.4', self.metrics.render())
+
+    def httpProfile(self, request):
+        engine = list(self.engines.values())[0]
+        return dscProfiler.httpProfile(engine.profiler, request,
+                                       self.profiledThreads, engine.host.log)
+
+
+# The "split" section as a dict, {} for true
+def splitConfig(split):
+    return dict(split) if isinstance(split, dict) else {}
+
+
+# Starts the serial process of a panel for split mode. split is the
+# "split" section. Panels after the first serve their endpoints on the
+# ports after its httpPort.
+def newSplitEngine(split, index, panelId, panelConfig, host, panelHost,
+                   commandToken=None):
+    config = splitConfig(split)
+    if int(config.get('httpPort', 0)) > 0:
+        config['httpPort'] = int(config['httpPort']) + index
+
+    def setup(engine, ringHost):
+        registerDevices(engine, panelConfig, ringHost, panelId)
+
+    def addRoutes(engine, server):
+        engine.addHttpRoutes(server)
+        if commandToken:
+            server.addRoute('POST', '/commands',
+                            requireToken(commandToken, engine.httpCommands))
+    return dscSplit.SplitEngine(panelConfig['prefs'], host, panelHost, setup,
+                                config, addRoutes)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='DSC Alarm to Fibaro Home Center 2 gateway')
+    parser.add_argument('config', help='JSON configuration file')
+    args = parser.parse_args()
+
+    config = loadConfig(args.config)
+    split = config.get('split')
+    commandToken = config.get('commandToken')
+    if split and commandToken and \
+            int(splitConfig(split).get('httpPort', 0)) <= 0:
+        parser.error('commandToken needs an httpPort in the split section, '
+                     'the serial processes serve /commands')
+    mqttToken = None
+    if config.get('mqtt', {}).get('commands', False) is True:
+        mqttToken = config['mqtt'].get('commandToken', commandToken)
+        if not mqttToken:
+            parser.error('MQTT commands need a commandToken, in the mqtt '
+                         'section or at the top level')
+    prefs = config.get('prefs', {})
+    host = hc2.Hc2Host(int(prefs.get('logLevel', 1)))
+    host.client = newHc2Client(config, host)
+    host.mqtt = newMqttClient(config, host)
+    panels = PanelSet()
+    for (index, (panelId, panelConfig)) in \
+            enumerate(panelConfigs(config)):
+        panelHost = host
+        if panelId is not None:
+            panelHost = dscHost.PanelHost(host, panelId)
+        if split:
+            engine = newSplitEngine(split, index, panelId, panelConfig,
+                                    host, panelHost, commandToken)
+        else:
+            engine = dscCore.DscEngine(panelHost, panelConfig['prefs'])
+            started = time.time()
+            registerDevices(engine, panelConfig, host, panelId)
+            engine.startupPhase('registration', started)
+        panels.add(panelId, engine)
+    if host.client is not None:
+        for metric in host.client.metricList():
+            panels.addMetric(metric)
+        host.client.start()
+    if host.mqtt is not None:
+        if mqttToken is not None:
+            panels.addMqttSubscriptions(host.mqtt, mqttToken)
+        for metric in host.mqtt.metricList():
+            panels.addMetric(metric)
+        host.mqtt.start()
+
+    httpServer = None
+    httpPort = int(config.get('httpPort', 0))
+    if httpPort > 0:
+        httpServer = dscHttp.HttpServer(httpPort,
+                                        config.get('httpAddress',
+                                                   '127.0.0.1'))
+        if split:
+            # The engines' own endpoints are served by their processes
+            httpServer.addRoute('GET', '/metrics', panels.httpMetrics)
+        else:
+            panels.addHttpRoutes(httpServer, commandToken)
+        host.feed.addHttpRoutes(httpServer)
+        httpServer.start()
+        host.log(1, "Serving state and metrics on port %u" % httpPort)
+
+    if not split:
+        dscProfiler.installSignalHandler(
+            list(panels.engines.values())[0].profiler,
+            panels.profiledThreads)
+
+    def stop(sig, frame):
+        panels.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    def reload(sig, frame):
+        try:
+            newConfig = loadConfig(args.config)
+            # With several panels the engines don't configure the host
+            if 'panels' in newConfig:
+                host.readConfiguration(newConfig.get('prefs', {}))
+            panels.reload(newConfig)
+        except (OSError, ValueError, KeyError) as err:
+            host.logError('Error reloading %s: %s' % (args.config, str(err)))
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, reload)
+
+    panels.run()
+
+    if host.client is not None:
+        host.client.stop()
+    if host.mqtt is not None:
+        host.mqtt.stop()
+    if httpServer is not None:
+        host.feed.close()
+        httpServer.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+#######################################################################
+# Minimal Home Center 2 REST stand-in
+#
+# Answers the requests hc2.Hc2Client sends (PUT /api/devices/<id>,
+# PUT /api/globalVariables/<name> and POST /api/scenes/<id>/action/
+# start) over keep-alive connections, and records each one with the
+# connection it came on. Failures can be injected: answer the next
+# requests with a status, answer one path with a status, or drop every
+# connection as if HC2 went away. Every request is printed, and --check
+# runs the client against it and tells whether it behaves:
+#
+#   ./dscHc2Stub.py --port 8090
+#   ./dscHc2Stub.py --check
+#
+# Not meant for anything but testing, it keeps everything in memory and
+# accepts any credentials.
+#######################################################################
+
+import argparse
+import collections
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+from socketserver import ThreadingMixIn
+import sys
+import threading
+import time
+
+import dscHost
+import hc2
+
+HC2_STUB_PORT = 8090
+
+# Request recorded by the stub. connection is the client's address and
+# port, the same for every request on one keep-alive connection.
+Hc2Request = collections.namedtuple(
+    'Hc2Request', ['time', 'method', 'path', 'body', 'connection'])
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Hc2Stub(object):
+
+    def __init__(self, port=HC2_STUB_PORT, address='127.0.0.1',
+                 verbose=False):
+        self.verbose = verbose
+        self.requests = []
+        self.lock = threading.Lock()
+        self.failures = []  # Statuses for the next requests, in order
+        self.pathStatus = {}  # path: status it always gets
+        self.down = False
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def handle_one(self):
+                length = int(self.headers.get('Content-Length', 0))
+                data = self.rfile.read(length) if length > 0 else b''
+                status = stub.record(self.command, self.path, data,
+                                     self.client_address)
+                if status is None:
+                    self.close_connection = True
+                    return
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            do_PUT = handle_one
+            do_POST = handle_one
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((address, port), Handler)
+        self.port = self.server.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='hc2-stub')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Answers the next len(statuses) requests with these statuses
+    def failNext(self, *statuses):
+        with self.lock:
+            self.failures.extend(statuses)
+
+    # Answers every request for path with status, None for 200 again
+    def setStatus(self, path, status):
+        with self.lock:
+            if status is None:
+                self.pathStatus.pop(path, None)
+            else:
+                self.pathStatus[path] = status
+
+    # Returns the status to answer with, None to drop the connection
+    # without answering
+    def record(self, method, path, data, connection):
+        body = json.loads(data) if len(data) > 0 else None
+        with self.lock:
+            if self.down is True:
+                return None
+            self.requests.append(Hc2Request(time.time(), method, path, body,
+                                            connection))
+            if len(self.failures) > 0:
+                status = self.failures.pop(0)
+            else:
+                status = self.pathStatus.get(path, 200)
+        if self.verbose is True:
+            sys.stdout.write('%s %s %s -> %u\n' % (method, path,
+                                                   data.decode('utf-8'),
+                                                   status))
+            sys.stdout.flush()
+        return status
+
+    def requestsFor(self, path):
+        with self.lock:
+            return [request for request in self.requests
+                    if request.path == path]
+
+    def clear(self):
+        with self.lock:
+            self.requests = []
+
+
+###############################################################################
+# Client Checks
+###############################################################################
+
+# Runs Hc2Client against a stub on port and returns the names of the
+# checks that failed
+def checkClient(port):
+    stub = Hc2Stub(port)
+    stub.start()
+    client = hc2.Hc2Client('127.0.0.1', stub.port,
+                           logger=dscHost.HostAdapter())
+    client.start()
+    failed = []
+
+    def check(name, ok, detail):
+        sys.stdout.write('%-12s %s  %s\n' % (name, 'ok' if ok else 'FAILED',
+                                             detail))
+        if not ok:
+            failed.append(name)
+
+    try:
+        # Updates within the batch window become one request per device,
+        # carrying the latest values
+        for i in range(50):
+            client.updateDevice(5, {'value': i})
+            client.updateDevice(6, {'armed': i % 2, 'value': i})
+        client.flush()
+        requests = stub.requestsFor('/api/devices/5')
+        check('collapse', len(stub.requests) == 2 and len(requests) == 1 and
+              requests[0].body['properties']['value'] == '49',
+              '%u requests for 100 updates' % len(stub.requests))
+
+        # Requests spread out in time still share the open connections
+        stub.clear()
+        for i in range(20):
+            client.setVariable('dscTest', i)
+            time.sleep(2 * client.batchWindow)
+        client.flush()
+        connections = set(request.connection for request in stub.requests)
+        check('keep-alive', len(stub.requests) == 20 and
+              len(connections) <= client.connections,
+              '%u requests on %u connections' % (len(stub.requests),
+                                                 len(connections)))
+
+        # Server errors are retried, and HC2 isn't taken for down
+        stub.clear()
+        stub.failNext(503, 503)
+        client.updateDevice(7, {'value': 1})
+        client.flush()
+        check('retry 5xx', len(stub.requests) == 3 and
+              client.retried.get() == 2 and client.online is True,
+              '%u attempts' % len(stub.requests))
+
+        # A refused update is given up on at once and not held
+        stub.clear()
+        stub.setStatus('/api/devices/8', 404)
+        client.updateDevice(8, {'value': 1})
+        client.flush()
+        check('give up 4xx', len(stub.requests) == 1 and
+              client.failures.get() == 1 and client.online is True and
+              len(client.pending) == 0,
+              '%u attempts' % len(stub.requests))
+    finally:
+        client.stop(1)
+        stub.stop()
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='HC2 REST stand-in')
+    parser.add_argument('--port', type=int,
+                        help='default %u, any free port with --check' %
+                        HC2_STUB_PORT)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--check', action='store_true',
+                        help='run the HC2 client against the stub, on any '
+                        'free port unless --port is given, and exit')
+    args = parser.parse_args()
+
+    if args.check is True:
+        failed = checkClient(args.port or 0)
+        sys.exit(1 if len(failed) > 0 else 0)
+
+    stub = Hc2Stub(args.port or HC2_STUB_PORT, args.address, verbose=True)
+    stub.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+#######################################################################
+# DSC Alarm host adapter interface
+#
+# The engine in dscCore.py knows nothing about the home automation
+# system it runs under. Everything it needs from the host - logging,
+# pushing device states, firing events, email and speech - goes
+# through a HostAdapter. dsc.py implements one for Indigo and hc2.py
+# one for the standalone Fibaro Home Center 2 gateway. A PanelHost lets
+# the engines of several panels share one host.
+#
+# State changes are pushed with the object the engine keeps for the
+# zone, zone group, keypad or sensor and a dict of only the states
+# that changed, keyed by the Indigo state names:
+#   zone:       state, LastChangedTimer, LastChangedShort
+#   zone group: state, AnyMemberLastChangedTimer,
+#               EntireGroupLastChangedTimer
+#   keypad:     state, ArmedState, LCDLine1, LCDLine2, LEDReady,
+#               LEDArmed, LEDTrouble
+#   sensor:     temperatureInside, temperatureOutside, setPointCool,
+#               setPointHeat
+#   area:       state (occupied or vacant), see dscOccupancy.py
+#   panel:      trouble, the last trouble message
+# Each object carries the hostRef it was registered with, so the host
+# can find its own device without a lookup table.
+#######################################################################
+
+import time
+
+
+class HostAdapter(object):
+
+    ###########################################################################
+    # Logging
+    ###########################################################################
+    def log(self, level, msg):
+        pass
+
+    def logError(self, msg):
+        pass
+
+    ###########################################################################
+    # Configuration
+    ###########################################################################
+
+    # Called whenever the engine reads its configuration, for settings only
+    # the host cares about. Return False if the configuration is unusable.
+    def readConfiguration(self, prefs):
+        return True
+
+    ###########################################################################
+    # State Updates
+    ###########################################################################
+    def zoneChanged(self, zone, states):
+        pass
+
+    def zoneGroupChanged(self, group, states):
+        pass
+
+    def keypadChanged(self, keypad, states):
+        pass
+
+    def tempSensorChanged(self, sensor, states):
+        pass
+
+    def occupancyChanged(self, area, states):
+        pass
+
+    # States of the panel as a whole, panel is the name of a PanelHost's
+    # panel
+    def panelChanged(self, states, panel=None):
+        pass
+
+    def updateVariable(self, varId, value):
+        pass
+
+    ###########################################################################
+    # Events and Notifications
+    ###########################################################################
+
+    # eventId is one of eventFailToArm, armedAway, armedStay,
+    # eventAlarmTripped, eventAlarmDisarmed, eventNoticeAC_Trouble or
+    # eventNoticeAC_Restore
+    def fireEvent(self, eventId):
+        pass
+
+    # eventId is userArmed or userDisarmed, userCode the 4 digit user number
+    def fireUserEvent(self, eventId, userCode):
+        pass
+
+    def sendEmail(self, address, subject, body):
+        pass
+
+    def speak(self, text):
+        pass
+
+    # Starts a scene (HC2) or action group (Indigo), for local rules
+    def runScene(self, sceneId):
+        pass
+
+    ###########################################################################
+    # Run Loop
+    ###########################################################################
+
+    # Called once a minute from the engine's thread
+    def minuteElapsed(self):
+        pass
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+# Lets several engines, one per panel, share a host. Log messages are
+# prefixed with the panel's name, everything else is passed on as is, so
+# the engines' hostRefs have to be unique across panels. The panels'
+# prefs aren't passed on, the shared host is configured with the prefs
+# all panels share by whoever created it.
+class PanelHost(HostAdapter):
+
+    def __init__(self, host, name):
+        self.host = host
+        self.name = name
+
+    def log(self, level, msg):
+        self.host.log(level, "%s: %s" % (self.name, msg))
+
+    def logError(self, msg):
+        self.host.logError("%s: %s" % (self.name, msg))
+
+    def readConfiguration(self, prefs):
+        return True
+
+    def zoneChanged(self, zone, states):
+        self.host.zoneChanged(zone, states)
+
+    def zoneGroupChanged(self, group, states):
+        self.host.zoneGroupChanged(group, states)
+
+    def keypadChanged(self, keypad, states):
+        self.host.keypadChanged(keypad, states)
+
+    def tempSensorChanged(self, sensor, states):
+        self.host.tempSensorChanged(sensor, states)
+
+    def occupancyChanged(self, area, states):
+        self.host.occupancyChanged(area, states)
+
+    def panelChanged(self, states, panel=None):
+        self.host.panelChanged(states, self.name)
+
+    def updateVariable(self, varId, value):
+        self.host.updateVariable(varId, value)
+
+    def fireEvent(self, eventId):
+        self.host.fireEvent(eventId)
+
+    def fireUserEvent(self, eventId, userCode):
+        self.host.fireUserEvent(eventId, userCode)
+
+    def sendEmail(self, address, subject, body):
+        self.host.sendEmail(address, subject, body)
+
+    def speak(self, text):
+        self.host.speak(text)
+
+    def runScene(self, sceneId):
+        self.host.runScene(sceneId)
+
+    def minuteElapsed(self):
+        self.host.minuteElapsed()
+
+    def sleep(self, seconds):
+        self.host.sleep(seconds)
@@ -0,0 +1,133 @@
+#######################################################################
+# DSC Alarm local HTTP server
+#
+# A small threaded HTTP server with a route table, shared by the local
+# endpoints the gateway offers (metrics, profiling, ...). Each request
+# runs in its own thread so a slow client never holds up the others.
+#######################################################################
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import threading
+from urllib.parse import parse_qs, urlparse
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class HttpRequest(object):
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.method = handler.command
+        url = urlparse(handler.path)
+        self.path = url.path
+        self.query = dict((k, v[-1]) for (k, v) in
+                          parse_qs(url.query).items())
+        self.headers = handler.headers
+        self.wfile = handler.wfile
+        self._body = None
+
+    def body(self):
+        if self._body is None:
+            length = int(self.headers.get('Content-Length', 0))
+            self._body = self.handler.rfile.read(length) if length > 0 \
+                else b''
+        return self._body
+
+    # Sends the headers of a response of unknown length, the handler then
+    # writes the body to wfile and the connection is closed after it
+    def startStream(self, contentType):
+        handler = self.handler
+        handler.close_connection = True
+        handler.send_response(200)
+        handler.send_header('Content-Type', contentType)
+        handler.send_header('Cache-Control', 'no-cache')
+        handler.send_header('Connection', 'close')
+        handler.end_headers()
+
+
+# Handlers are called with an HttpRequest and return
+# (status, content type, body) or (status, content type, body, headers).
+# A handler that has written its own response, for instance a stream,
+# returns None.
+class HttpServer(object):
+
+    def __init__(self, port, address='127.0.0.1'):
+        self.port = port
+        self.address = address
+        self.routes = {}
+        self.server = None
+        self.thread = None
+
+    def addRoute(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    def start(self):
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Small writes like stream events go out right away
+            disable_nagle_algorithm = True
+
+            def handle_one(self):
+                request = HttpRequest(self)
+                handler = routes.get((self.command, request.path))
+                if handler is None:
+                    self.discardBody(request)
+                    self.respond(404, 'text/plain', b'Not found\n')
+                    return
+                try:
+                    response = handler(request)
+                except Exception as err:
+                    self.discardBody(request)
+                    self.respond(500, 'text/plain',
+                                 ('%s\n' % err).encode('utf-8'))
+                    return
+                if response is not None:
+                    self.discardBody(request)
+                    self.respond(*response)
+
+            # Reads the body if the handler didn't, or the next request on
+            # the connection would start with it. A body that can't be
+            # read closes the connection instead.
+            def discardBody(self, request):
+                try:
+                    request.body()
+                except (ValueError, OSError):
+                    self.close_connection = True
+
+            def respond(self, status, contentType, body, headers=None):
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                for (name, value) in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            do_GET = handle_one
+            do_POST = handle_one
+
+            # Keep the host's log free of per-request lines
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.address, self.port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       name='dscHttp')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+            self.thread = None
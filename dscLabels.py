@@ -0,0 +1,119 @@
+#######################################################################
+# DSC Alarm panel labels
+#
+# The names programmed into the panel, as it sends them in 570 Broadcast
+# Labels frames after a 002 Labels Request (PowerSeries PC1616/1832/1864
+# only). Label numbers 001-064 are the zones and 101-108 the partitions,
+# the others name system messages and are kept as they came.
+#
+# Labels are interned, there are few of them and the same strings end up
+# in every log line, email and spoken message about a zone.
+#
+# With a cache file the labels of every panel are kept there, under a
+# key naming the panel (its serial port), so a restart has them without
+# asking the panel. They are only asked for again when the panel has
+# been in installer's mode, the only place they can be changed.
+#######################################################################
+
+import json
+import os
+import sys
+import threading
+
+LABELS_VERSION = 1
+LABEL_LENGTH = 32
+ZONE_LABEL_LAST = 64
+PARTITION_LABEL_BASE = 100
+PARTITION_LABEL_LAST = 108
+
+
+class LabelTable(object):
+
+    def __init__(self):
+        self.labels = {}  # label number: text
+        self.dirty = False  # Changed since loaded or saved
+        # Looked up from HTTP threads, set from the engine's
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.labels)
+
+    # Records the label the panel sent. Returns True if it changed.
+    def update(self, number, text):
+        text = sys.intern(text.strip())
+        with self.lock:
+            if self.labels.get(number) == text:
+                return False
+            if len(text) == 0:
+                self.labels.pop(number, None)
+            else:
+                self.labels[number] = text
+            self.dirty = True
+            return True
+
+    def get(self, number):
+        return self.labels.get(number)
+
+    def zoneLabel(self, zoneNum):
+        return self.labels.get(zoneNum)
+
+    def partitionLabel(self, partition):
+        return self.labels.get(PARTITION_LABEL_BASE + partition)
+
+    def clear(self):
+        with self.lock:
+            self.labels = {}
+            self.dirty = False
+
+    # The labels as {'zones': ..., 'partitions': ..., 'other': ...}, each
+    # keyed by zone, partition or label number
+    def report(self):
+        with self.lock:
+            labels = sorted(self.labels.items())
+        report = {'zones': {}, 'partitions': {}, 'other': {}}
+        for (number, text) in labels:
+            if number <= ZONE_LABEL_LAST:
+                report['zones'][number] = text
+            elif PARTITION_LABEL_BASE < number <= PARTITION_LABEL_LAST:
+                report['partitions'][number - PARTITION_LABEL_BASE] = text
+            else:
+                report['other'][number] = text
+        return report
+
+    # Loads the labels cached for key from fileName. Returns how many
+    # there were.
+    def load(self, fileName, key):
+        cached = readCache(fileName).get(key, {})
+        with self.lock:
+            self.labels = dict((int(number), sys.intern(text))
+                               for (number, text) in cached.items())
+            self.dirty = False
+            return len(self.labels)
+
+    # Puts the labels in fileName under key, leaving other panels' alone.
+    # Written to a temporary file first so a crash never leaves half a
+    # file.
+    def save(self, fileName, key):
+        with self.lock:
+            labels = dict((str(number), text)
+                          for (number, text) in self.labels.items())
+            self.dirty = False
+        panels = readCache(fileName)
+        panels[key] = labels
+        tmpName = fileName + '.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump({'version': LABELS_VERSION, 'panels': panels}, f,
+                      indent=1, sort_keys=True)
+        os.replace(tmpName, fileName)
+
+
+# The {panel key: {label number: text}} in fileName, empty if there is no
+# such file
+def readCache(fileName):
+    if not os.path.exists(fileName):
+        return {}
+    with open(fileName) as f:
+        cached = json.load(f)
+    if cached.get('version') != LABELS_VERSION:
+        raise ValueError('unknown label cache version')
+    return cached['panels']
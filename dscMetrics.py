@@ -0,0 +1,237 @@
+#######################################################################
+# DSC Alarm runtime metrics
+#
+# Counters, gauges and histograms for the gateway, rendered in the
+# Prometheus text exposition format. Metrics are updated from the
+# serial thread only and read by the HTTP thread, so updates are plain
+# dictionary operations without locking; a scrape may at worst see a
+# histogram that is one observation behind on some buckets.
+#######################################################################
+
+import bisect
+
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+QUEUE_WAIT_BUCKETS = [0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+                      60.0]
+
+
+def formatLabels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"')) for (name, value) in pairs)
+
+
+# Puts name="value" in front of already formatted labels
+def addLabel(labels, name, value):
+    label = formatLabels((name,), (value,))
+    if len(labels) == 0:
+        return label
+    return label[:-1] + ',' + labels[1:]
+
+
+def formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labelValues):
+        values = self.values
+        values[labelValues] = values.get(labelValues, 0) + 1
+
+    def add(self, amount, *labelValues):
+        self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def get(self, *labelValues):
+        return self.values.get(labelValues, 0)
+
+    def samples(self):
+        if len(self.values) == 0 and len(self.labels) == 0:
+            return [(self.name, '', 0)]
+        return [(self.name, formatLabels(self.labels, key), value)
+                for (key, value) in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def __init__(self, name, help_, labels=(), function=None):
+        Counter.__init__(self, name, help_, labels)
+        self.function = function
+
+    def set(self, value, *labelValues):
+        self.values[labelValues] = value
+
+    def samples(self):
+        # Gauges backed by a function cost nothing until scraped
+        if self.function is not None:
+            return [(self.name, '', self.function())]
+        return Counter.samples(self)
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, help_, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self.buckets = list(buckets)
+        self.series = {}
+
+    def observe(self, value, *labelValues):
+        series = self.series.get(labelValues)
+        if series is None:
+            series = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            self.series[labelValues] = series
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labelValues):
+        series = self.series.get(labelValues)
+        return 0 if series is None else series[2]
+
+    def samples(self):
+        out = []
+        series = self.series
+        if len(series) == 0 and len(self.labels) == 0:
+            series = {(): [[0] * (len(self.buckets) + 1), 0.0, 0]}
+        for (key, (counts, total, count)) in sorted(series.items()):
+            cumulative = 0
+            for (bound, n) in zip(self.buckets + [float('inf')], counts):
+                cumulative += n
+                out.append((self.name + '_bucket',
+                            formatLabels(self.labels, key,
+                                         ('le', formatValue(bound))),
+                            cumulative))
+            out.append((self.name + '_sum',
+                        formatLabels(self.labels, key), total))
+            out.append((self.name + '_count',
+                        formatLabels(self.labels, key), count))
+        return out
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for (name, labels, value) in metric.samples():
+                lines.append('%s%s %s' % (name, labels, formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# Renders the GatewayMetrics of several panels as one page, each sample
+# labelled with the panel it's from, followed by the metrics added to
+# this registry itself, which are shared by all panels.
+class PanelRegistry(Registry):
+
+    def __init__(self):
+        Registry.__init__(self)
+        self.panels = []
+
+    def addPanel(self, name, metrics):
+        self.panels.append((name, metrics))
+
+    # Panels are matched up by metric name, a panel without the first
+    # panel's metric (yet) is left out of it
+    def render(self):
+        lines = []
+        if len(self.panels) > 0:
+            panels = [(panel, dict((metric.name, metric)
+                                   for metric in metrics.metrics))
+                      for (panel, metrics) in self.panels]
+            for metric in self.panels[0][1].metrics:
+                lines.append('# HELP %s %s' % (metric.name, metric.help))
+                lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+                for (panel, metrics) in panels:
+                    if metric.name not in metrics:
+                        continue
+                    for (name, labels, value) in \
+                            metrics[metric.name].samples():
+                        lines.append('%s%s %s' % (
+                            name, addLabel(labels, 'panel', panel),
+                            formatValue(value)))
+        if len(self.metrics) > 0:
+            lines.append(Registry.render(self).rstrip('\n'))
+        return '\n'.join(lines) + '\n'
+
+
+# All metrics the gateway keeps about its panel link
+class GatewayMetrics(Registry):
+
+    def __init__(self):
+        Registry.__init__(self)
+        self.rxFrames = self.add(Counter(
+            'dsc_rx_frames_total', 'Frames received from the panel',
+            ('cmd',)))
+        self.rxChecksumErrors = self.add(Counter(
+            'dsc_rx_checksum_errors_total',
+            'Received frames with a checksum that did not match'))
+        self.rxInvalidFrames = self.add(Counter(
+            'dsc_rx_invalid_frames_total',
+            'Received lines that were not a valid frame'))
+        self.txFrames = self.add(Counter(
+            'dsc_tx_frames_total', 'Frames sent to the panel', ('cmd',)))
+        self.commandErrors = self.add(Counter(
+            'dsc_command_errors_total',
+            '501 Command Error replies from the panel'))
+        self.systemErrors = self.add(Counter(
+            'dsc_system_errors_total',
+            '502 System Error replies from the panel', ('code',)))
+        self.txRetries = self.add(Counter(
+            'dsc_tx_retries_total', 'Commands that had to be resent'))
+        self.txTimeouts = self.add(Counter(
+            'dsc_tx_timeouts_total', 'Waits for a response that timed out'))
+        self.txFailures = self.add(Counter(
+            'dsc_tx_failures_total', 'Commands given up on after retries'))
+        self.txThrottles = self.add(Counter(
+            'dsc_tx_throttles_total',
+            'Times the panel asked us to slow down', ('cmd',)))
+        self.queueDepth = self.add(Gauge(
+            'dsc_command_queue_depth', 'Commands waiting to be sent'))
+        self.queueWait = self.add(Histogram(
+            'dsc_command_queue_wait_seconds',
+            'Time commands spent queued before being sent',
+            QUEUE_WAIT_BUCKETS))
+        self.ackLatency = self.add(Histogram(
+            'dsc_ack_latency_seconds',
+            'Time from sending a command to its acknowledgement'))
+        self.zoneLatency = self.add(Histogram(
+            'dsc_zone_event_latency_seconds',
+            'Time from receiving a zone event to its state being pushed '
+            'downstream'))
+        self.reconnects = self.add(Counter(
+            'dsc_reconnects_total', 'Times the panel link was re-opened'))
+        self.linkUp = self.add(Gauge(
+            'dsc_link_up', '1 while the panel link is in normal operation'))
+        self.startupSeconds = self.add(Gauge(
+            'dsc_startup_phase_seconds',
+            'Time the last start or reconnect spent in each phase',
+            ('phase',)))
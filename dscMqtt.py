@@ -0,0 +1,398 @@
+#######################################################################
+# DSC Alarm MQTT output
+#
+# Publishes device states to an MQTT broker as retained messages, one
+# topic per state:
+#
+#   <prefix>/<type>/<id>/<state>    e.g. dsc/zone/frontDoor/state open
+#
+# type and id are what the host was told (zone, zoneGroup, keypad for
+# a partition's state and LEDs, tempSensor, area, variable, panel for
+# trouble messages). <prefix>/status is "online" while connected and
+# the broker sets it to "offline" (our will) if we go away.
+#
+# MqttClient speaks plain MQTT 3.1.1 over one persistent connection from
+# its own thread, so the engine never waits on the network. Publishes
+# are collected for the batch window, a value superseded before it was
+# sent is simply replaced, and everything due goes out in one write.
+# While the broker is away updates keep collapsing, and on every
+# (re)connect the last value of every topic is published again, so a
+# broker that lost its retained messages is brought back up to date.
+#
+# Messages on subscribed topics (command topics, see dscHc2Gateway.py)
+# are handed to onMessage on the client's thread. Everything is sent
+# and received at QoS 0.
+#######################################################################
+
+import collections
+import select
+import socket
+import struct
+import threading
+import time
+
+import dscHost
+import dscMetrics
+
+MQTT_PORT = 1883
+MQTT_KEEPALIVE = 60  # Seconds, we ping after half of it without traffic
+MQTT_BATCH_WINDOW = 0.1  # Seconds to collect publishes before sending
+MQTT_CONNECT_TIMEOUT = 10
+MQTT_RECONNECT_DELAY = 1  # Doubled after every failed attempt
+MQTT_MAX_RECONNECT_DELAY = 60
+MQTT_PREFIX = 'dsc'
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+SUBSCRIBE = 8
+SUBACK = 9
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+class MqttError(IOError):
+    pass
+
+
+###############################################################################
+# Packets
+###############################################################################
+def encodeLength(length):
+    encoded = bytearray()
+    while True:
+        (length, digit) = divmod(length, 128)
+        encoded.append(digit | 0x80 if length > 0 else digit)
+        if length == 0:
+            return bytes(encoded)
+
+
+def encodeString(text):
+    if isinstance(text, str):
+        text = text.encode('utf-8')
+    return struct.pack('!H', len(text)) + text
+
+
+def packet(packetType, flags, body):
+    return bytes([packetType << 4 | flags]) + encodeLength(len(body)) + body
+
+
+def connectPacket(clientId, keepalive, user='', password='', will=None):
+    flags = 0x02  # Clean session
+    payload = encodeString(clientId)
+    if will is not None:
+        (topic, message) = will
+        flags |= 0x04 | 0x20  # Will, retained, at QoS 0
+        payload += encodeString(topic) + encodeString(message)
+    if len(user) > 0:
+        flags |= 0x80
+        payload += encodeString(user)
+        if len(password) > 0:
+            flags |= 0x40
+            payload += encodeString(password)
+    return packet(CONNECT, 0, encodeString('MQTT') +
+                  struct.pack('!BBH', 4, flags, keepalive) + payload)
+
+
+def publishPacket(topic, message, retain=False):
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    return packet(PUBLISH, 1 if retain else 0, encodeString(topic) + message)
+
+
+def subscribePacket(packetId, topics):
+    return packet(SUBSCRIBE, 0x02, struct.pack('!H', packetId) +
+                  b''.join(encodeString(topic) + b'\x00'
+                           for topic in topics))
+
+
+# Takes the first whole packet off the front of buffer. Returns (type,
+# flags, body, rest of buffer), or None if it hasn't all arrived yet.
+def splitPacket(buffer):
+    length = 0
+    multiplier = 1
+    for index in range(1, min(len(buffer), 5)):
+        length += (buffer[index] & 0x7f) * multiplier
+        multiplier *= 128
+        if buffer[index] & 0x80 == 0:
+            end = index + 1 + length
+            if len(buffer) < end:
+                return None
+            return (buffer[0] >> 4, buffer[0] & 0x0f,
+                    bytes(buffer[index + 1:end]), buffer[end:])
+    if len(buffer) >= 5:
+        raise MqttError('invalid packet length')
+    return None
+
+
+# Returns (topic, message, packet id or None) of a PUBLISH body
+def parsePublish(flags, body):
+    (length,) = struct.unpack('!H', body[:2])
+    topic = body[2:2 + length].decode('utf-8', 'replace')
+    rest = body[2 + length:]
+    packetId = None
+    if flags & 0x06:
+        (packetId,) = struct.unpack('!H', rest[:2])
+        rest = rest[2:]
+    return (topic, rest, packetId)
+
+
+# Tells whether topic matches a subscription filter with + and #
+def topicMatches(topicFilter, topic):
+    filterLevels = topicFilter.split('/')
+    levels = topic.split('/')
+    for (index, level) in enumerate(filterLevels):
+        if level == '#':
+            return True
+        if index >= len(levels) or (level != '+' and level != levels[index]):
+            return False
+    return len(levels) == len(filterLevels)
+
+
+###############################################################################
+# Client
+###############################################################################
+class MqttClient(object):
+
+    def __init__(self, address, port=MQTT_PORT, clientId='dsc', user='',
+                 password='', prefix=MQTT_PREFIX, keepalive=MQTT_KEEPALIVE,
+                 batchWindow=MQTT_BATCH_WINDOW, logger=None, onMessage=None):
+        self.address = address
+        self.port = port
+        self.clientId = clientId
+        self.user = user
+        self.password = password
+        self.prefix = prefix
+        self.keepalive = keepalive
+        self.batchWindow = batchWindow
+        self.logger = logger or dscHost.HostAdapter()
+        self.onMessage = onMessage
+        self.subscriptions = []
+        # topic: (message, retain) waiting to be sent, oldest first
+        self.pending = collections.OrderedDict()
+        # The last retained message of every topic, to send on reconnect
+        self.retained = {}
+        self.lock = threading.Lock()
+        self.sock = None
+        self.buffer = b''
+        self.connected = False
+        self.running = False
+        self.thread = None
+        self.lastSent = 0
+
+        self.published = dscMetrics.Counter(
+            'dsc_mqtt_published_total', 'MQTT messages published')
+        self.collapsed = dscMetrics.Counter(
+            'dsc_mqtt_collapsed_total',
+            'MQTT messages replaced by a newer one before being sent')
+        self.received = dscMetrics.Counter(
+            'dsc_mqtt_received_total', 'MQTT messages received')
+        self.reconnects = dscMetrics.Counter(
+            'dsc_mqtt_connects_total', 'Connections made to the broker')
+        self.up = dscMetrics.Gauge(
+            'dsc_mqtt_up', '1 while connected to the MQTT broker',
+            function=lambda: 1 if self.connected is True else 0)
+
+    def metricList(self):
+        return [self.published, self.collapsed, self.received,
+                self.reconnects, self.up]
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='dsc-mqtt')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=MQTT_CONNECT_TIMEOUT):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    ###########################################################################
+    # Publishing
+    ###########################################################################
+
+    # Topics under our prefix, filters may use + and #
+    def subscribe(self, topicFilter):
+        self.subscriptions.append(self.prefix + '/' + topicFilter)
+
+    def publish(self, topic, message, retain=True):
+        topic = self.prefix + '/' + topic
+        message = str(message)
+        with self.lock:
+            if retain is True:
+                if self.retained.get(topic) == message and \
+                        topic not in self.pending:
+                    return
+                self.retained[topic] = message
+            if topic in self.pending:
+                self.collapsed.inc()
+            self.pending[topic] = (message, retain)
+
+    # Publishes the changed states of the device the host knows as hostRef
+    def publishStates(self, kind, hostRef, states):
+        for (name, value) in states.items():
+            if isinstance(value, bool):
+                value = 'true' if value is True else 'false'
+            self.publish('%s/%s/%s' % (kind, hostRef, name), value)
+
+    ###########################################################################
+    # Connection
+    ###########################################################################
+    def run(self):
+        delay = MQTT_RECONNECT_DELAY
+        while self.running is True:
+            try:
+                self.connect()
+                delay = MQTT_RECONNECT_DELAY
+                self.serve()
+            except (IOError, OSError, struct.error) as err:
+                if self.connected is True:
+                    self.logger.logError('MQTT connection lost: %s' %
+                                         str(err))
+                else:
+                    self.logger.log(2, "MQTT connect to %s failed: %s" %
+                             (self.address, str(err)))
+            self.disconnect()
+            if self.running is True:
+                time.sleep(delay)
+                delay = min(delay * 2, MQTT_MAX_RECONNECT_DELAY)
+
+    def connect(self):
+        self.sock = socket.create_connection((self.address, self.port),
+                                             MQTT_CONNECT_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = b''
+        self.sock.sendall(connectPacket(
+            self.clientId, self.keepalive, self.user, self.password,
+            (self.prefix + '/status', 'offline')))
+        (packetType, flags, body) = self.readPacket(MQTT_CONNECT_TIMEOUT)
+        if packetType != CONNACK or len(body) < 2:
+            raise MqttError('expected CONNACK')
+        if body[1] != 0:
+            raise MqttError('broker refused the connection (%u)' % body[1])
+        self.sock.setblocking(False)
+        self.connected = True
+        self.reconnects.inc()
+        self.logger.log(1, "Connected to MQTT broker %s:%u" %
+                 (self.address, self.port))
+
+        if len(self.subscriptions) > 0:
+            self.send(subscribePacket(1, self.subscriptions))
+        # The broker may have lost our retained messages, send them again
+        with self.lock:
+            for (topic, message) in self.retained.items():
+                self.pending.setdefault(topic, (message, True))
+            self.pending[self.prefix + '/status'] = ('online', True)
+
+    def disconnect(self):
+        if self.sock is not None:
+            # Stopping: send what's left, and say we're going as a clean
+            # disconnect makes the broker drop our will
+            if self.running is False and self.connected is True:
+                with self.lock:
+                    self.pending[self.prefix + '/status'] = ('offline', True)
+                try:
+                    self.flush()
+                    self.send(packet(DISCONNECT, 0, b''))
+                except (IOError, OSError):
+                    pass
+            self.sock.close()
+            self.sock = None
+        self.connected = False
+
+    # Blocking read of one packet while connecting
+    def readPacket(self, timeout):
+        endTime = time.time() + timeout
+        while True:
+            split = splitPacket(self.buffer)
+            if split is not None:
+                self.buffer = split[3]
+                return split[:3]
+            remaining = endTime - time.time()
+            if remaining <= 0:
+                raise MqttError('timed out waiting for the broker')
+            self.sock.settimeout(remaining)
+            data = self.sock.recv(4096)
+            if len(data) == 0:
+                raise MqttError('connection closed by the broker')
+            self.buffer += data
+
+    def send(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            (r, writable, x) = select.select([], [self.sock], [],
+                                             MQTT_CONNECT_TIMEOUT)
+            if len(writable) == 0:
+                raise MqttError('write to the broker timed out')
+            try:
+                view = view[self.sock.send(view):]
+            except (BlockingIOError, InterruptedError):
+                pass
+        self.lastSent = time.time()
+
+    # Sends what has been published every batch window, answers the
+    # broker and pings it when there's nothing else to send
+    def serve(self):
+        lastReceived = time.time()
+        while self.running is True:
+            (readable, w, x) = select.select([self.sock], [], [],
+                                             self.batchWindow)
+            now = time.time()
+            if len(readable) > 0:
+                data = self.sock.recv(65536)
+                if len(data) == 0:
+                    raise MqttError('connection closed by the broker')
+                self.buffer += data
+                lastReceived = now
+                self.receive()
+
+            self.flush()
+            if now - self.lastSent >= self.keepalive / 2.0:
+                self.send(packet(PINGREQ, 0, b''))
+            if now - lastReceived >= self.keepalive * 1.5:
+                raise MqttError('the broker stopped answering')
+
+    def flush(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                return
+            batch = list(self.pending.items())
+            self.pending.clear()
+        try:
+            self.send(b''.join(publishPacket(topic, message, retain)
+                               for (topic, (message, retain)) in batch))
+        except (IOError, OSError):
+            # Put back what wasn't replaced meanwhile, in front
+            with self.lock:
+                for (topic, entry) in reversed(batch):
+                    if topic not in self.pending:
+                        self.pending[topic] = entry
+                        self.pending.move_to_end(topic, last=False)
+            raise
+        self.published.add(len(batch))
+
+    def receive(self):
+        while True:
+            split = splitPacket(self.buffer)
+            if split is None:
+                return
+            (packetType, flags, body, self.buffer) = split
+            if packetType == PUBLISH:
+                (topic, message, packetId) = parsePublish(flags, body)
+                if packetId is not None:
+                    self.send(packet(PUBACK, 0, struct.pack('!H',
+                                                            packetId)))
+                self.received.inc()
+                if self.onMessage is not None:
+                    try:
+                        self.onMessage(topic[len(self.prefix) + 1:],
+                                       message.decode('utf-8', 'replace'))
+                    except Exception as err:
+                        self.logger.logError('Error handling MQTT message '
+                                             'on %s: %s' % (topic, str(err)))
+            elif packetType == SUBACK and b'\x80' in body[2:]:
+                self.logger.logError('MQTT broker refused a subscription')
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+#######################################################################
+# Minimal MQTT broker stand-in
+#
+# Just enough of MQTT 3.1.1 to test the gateway's MQTT output without
+# installing a real broker: CONNECT (with an optional user and
+# password), PUBLISH at QoS 0 and 1, retained messages, SUBSCRIBE with
+# + and # filters, PINGREQ, DISCONNECT and wills. Every message it gets
+# is printed, and --publish sends one on behalf of a client, e.g. a
+# command the gateway should act on:
+#
+#   ./dscMqttBroker.py --port 1883
+#   ./dscMqttBroker.py --port 1883 --publish dsc/partition/1/set armStay
+#
+# Not meant for anything but testing, it keeps everything in memory and
+# has no access control beyond the password.
+#######################################################################
+
+import argparse
+import socket
+import struct
+import sys
+import threading
+import time
+
+import dscMqtt
+
+
+class BrokerClient(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.clientId = None
+        self.subscriptions = []
+        self.will = None
+        self.lock = threading.Lock()
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+
+class MqttBroker(object):
+
+    def __init__(self, port=dscMqtt.MQTT_PORT, address='127.0.0.1', user='',
+                 password='', verbose=False):
+        self.user = user
+        self.password = password
+        self.verbose = verbose
+        self.retained = {}
+        self.clients = []
+        # Every message published to the broker, as (topic, message,
+        # retain), for tests to look at
+        self.messages = []
+        self.lock = threading.Lock()
+        self.running = False
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((address, port))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+
+    def start(self):
+        self.running = True
+        thread = threading.Thread(target=self.run, name='mqtt-broker')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running = False
+        self.server.close()
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            self.drop(client, sendWill=False)
+
+    def run(self):
+        while self.running is True:
+            try:
+                (sock, address) = self.server.accept()
+            except OSError:
+                return
+            client = BrokerClient(sock)
+            thread = threading.Thread(target=self.serve, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    # Drops every connection as if the network went away, wills and all
+    def dropClients(self):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            self.drop(client)
+
+    def drop(self, client, sendWill=True):
+        with self.lock:
+            if client not in self.clients:
+                return
+            self.clients.remove(client)
+        try:
+            client.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        client.sock.close()
+        if sendWill is True and client.will is not None:
+            self.publish(*client.will)
+
+    def publish(self, topic, message, retain=False):
+        if self.verbose is True:
+            sys.stdout.write('%s %s%s\n' % (topic, message.decode(
+                'utf-8', 'replace'), ' (retained)' if retain else ''))
+            sys.stdout.flush()
+        with self.lock:
+            self.messages.append((topic, message, retain))
+            if retain is True:
+                if len(message) == 0:
+                    self.retained.pop(topic, None)
+                else:
+                    self.retained[topic] = message
+            clients = [client for client in self.clients
+                       if any(dscMqtt.topicMatches(topicFilter, topic)
+                              for topicFilter in client.subscriptions)]
+        for client in clients:
+            try:
+                client.send(dscMqtt.publishPacket(topic, message))
+            except OSError:
+                self.drop(client)
+
+    def serve(self, client):
+        buffer = b''
+        try:
+            while True:
+                split = dscMqtt.splitPacket(buffer)
+                if split is None:
+                    data = client.sock.recv(65536)
+                    if len(data) == 0:
+                        break
+                    buffer += data
+                    continue
+                (packetType, flags, body, buffer) = split
+                if self.handle(client, packetType, flags, body) is False:
+                    break
+        except (OSError, struct.error, dscMqtt.MqttError):
+            pass
+        self.drop(client)
+
+    # Returns False once the client has to go
+    def handle(self, client, packetType, flags, body):
+        if packetType == dscMqtt.CONNECT:
+            return self.connect(client, body)
+        if client.clientId is None:
+            return False
+
+        if packetType == dscMqtt.PUBLISH:
+            (topic, message, packetId) = dscMqtt.parsePublish(flags, body)
+            if packetId is not None:
+                client.send(dscMqtt.packet(dscMqtt.PUBACK, 0,
+                                           struct.pack('!H', packetId)))
+            self.publish(topic, message, flags & 0x01 == 1)
+
+        elif packetType == dscMqtt.SUBSCRIBE:
+            (packetId,) = struct.unpack('!H', body[:2])
+            (offset, topicFilters) = (2, [])
+            while offset < len(body):
+                (length,) = struct.unpack('!H', body[offset:offset + 2])
+                topicFilters.append(body[offset + 2:offset + 2 + length]
+                                    .decode('utf-8'))
+                offset += 3 + length
+            client.subscriptions.extend(topicFilters)
+            client.send(dscMqtt.packet(dscMqtt.SUBACK, 0,
+                                       struct.pack('!H', packetId) +
+                                       b'\x00' * len(topicFilters)))
+            with self.lock:
+                retained = [(topic, message) for (topic, message) in
+                            self.retained.items()
+                            if any(dscMqtt.topicMatches(topicFilter, topic)
+                                   for topicFilter in topicFilters)]
+            for (topic, message) in retained:
+                client.send(dscMqtt.publishPacket(topic, message, True))
+
+        elif packetType == dscMqtt.PINGREQ:
+            client.send(dscMqtt.packet(dscMqtt.PINGRESP, 0, b''))
+
+        elif packetType == dscMqtt.DISCONNECT:
+            client.will = None
+            return False
+        return True
+
+    def connect(self, client, body):
+        (length,) = struct.unpack('!H', body[:2])
+        (level, flags, keepalive) = struct.unpack(
+            '!BBH', body[2 + length:6 + length])
+        fields = []
+        offset = 6 + length
+        while offset < len(body):
+            (length,) = struct.unpack('!H', body[offset:offset + 2])
+            fields.append(body[offset + 2:offset + 2 + length])
+            offset += 2 + length
+        client.clientId = fields.pop(0).decode('utf-8')
+        if flags & 0x04:
+            client.will = (fields.pop(0).decode('utf-8'), fields.pop(0),
+                           flags & 0x20 != 0)
+        user = fields.pop(0).decode('utf-8') if flags & 0x80 else ''
+        password = fields.pop(0).decode('utf-8') if flags & 0x40 else ''
+        if len(self.user) > 0 and (user, password) != (self.user,
+                                                       self.password):
+            client.send(dscMqtt.packet(dscMqtt.CONNACK, 0, b'\x00\x04'))
+            return False
+        client.send(dscMqtt.packet(dscMqtt.CONNACK, 0, b'\x00\x00'))
+        with self.lock:
+            self.clients.append(client)
+        return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description='MQTT broker stand-in')
+    parser.add_argument('--port', type=int, default=dscMqtt.MQTT_PORT)
+    parser.add_argument('--address', default='127.0.0.1')
+    parser.add_argument('--user', default='')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--publish', nargs=2, metavar=('TOPIC', 'MESSAGE'),
+                        help='publish to a running broker on --port and '
+                        'exit')
+    args = parser.parse_args()
+
+    if args.publish is not None:
+        sock = socket.create_connection((args.address, args.port))
+        sock.sendall(dscMqtt.connectPacket('dscMqttBroker', 10, args.user,
+                                           args.password))
+        sock.sendall(dscMqtt.publishPacket(*args.publish))
+        sock.sendall(dscMqtt.packet(dscMqtt.DISCONNECT, 0, b''))
+        time.sleep(0.1)
+        sock.close()
+        return
+
+    broker = MqttBroker(args.port, args.address, args.user, args.password,
+                        verbose=True)
+    broker.start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        broker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#######################################################################
+# DSC Alarm occupancy tracking
+#
+# Zones with an occupancyGroup above 0 (motion detectors, inside doors)
+# make up areas, one per group number. An area is occupied while one of
+# its zones is open and for vacantAfter seconds after the last open or
+# close, vacant after that. Activity is also counted over a sliding
+# window, in per-minute buckets so an area takes the same memory however
+# busy it is.
+#
+# Areas are kept in OrderedDicts ordered by last activity, least recent
+# first, so marking areas vacant and finding those idle for more than N
+# minutes only look at the front instead of at every area.
+#######################################################################
+
+import collections
+import threading
+
+OCCUPANCY_VACANT_MINUTES = 15
+OCCUPANCY_WINDOW_MINUTES = 60
+OCCUPANCY_BUCKET_SECONDS = 60
+
+OCCUPANCY_STATE_OCCUPIED = 'occupied'
+OCCUPANCY_STATE_VACANT = 'vacant'
+
+
+class Area(object):
+
+    def __init__(self, group, name, hostRef, buckets):
+        self.group = group
+        self.name = name
+        self.hostRef = hostRef
+        self.state = OCCUPANCY_STATE_VACANT
+        self.lastActivity = None
+        self.openZones = set()
+        # [bucket number, activity count] of the most recent buckets
+        # that saw any activity
+        self.buckets = collections.deque(maxlen=buckets)
+
+    def addActivity(self, now, bucketSeconds):
+        bucket = int(now // bucketSeconds)
+        if len(self.buckets) > 0 and self.buckets[-1][0] == bucket:
+            self.buckets[-1][1] += 1
+        else:
+            self.buckets.append([bucket, 1])
+
+    def activityCount(self, now, bucketSeconds):
+        first = int(now // bucketSeconds) - self.buckets.maxlen + 1
+        return sum(count for (bucket, count) in self.buckets
+                   if bucket >= first)
+
+
+class OccupancyTracker(object):
+
+    def __init__(self, vacantAfter=OCCUPANCY_VACANT_MINUTES * 60,
+                 window=OCCUPANCY_WINDOW_MINUTES * 60,
+                 bucketSeconds=OCCUPANCY_BUCKET_SECONDS):
+        self.vacantAfter = vacantAfter
+        self.bucketSeconds = bucketSeconds
+        self.buckets = max(1, int(window // bucketSeconds))
+        # Every area that has seen activity, least recent first
+        self.areas = collections.OrderedDict()
+        # Occupied areas waiting to become vacant, least recent first
+        self.occupied = collections.OrderedDict()
+        self.names = {}
+        # Queries come from HTTP threads, changes from the engine's
+        self.lock = threading.Lock()
+
+    # Gives area group a name and the hostRef its states are pushed with,
+    # by default they are "Area <group>" and "area<group>"
+    def addArea(self, group, name, hostRef):
+        self.names[group] = (name, hostRef)
+
+    # Changes the size of the activity window, counts so far are kept as
+    # far as they fit
+    def setWindow(self, window):
+        with self.lock:
+            self.buckets = max(1, int(window // self.bucketSeconds))
+            for area in self.areas.values():
+                area.buckets = collections.deque(area.buckets,
+                                                 maxlen=self.buckets)
+
+    # Records an open (or tripped) or close of zoneNum, which is in group.
+    # Returns the Area if it just became occupied, otherwise None.
+    def zoneChanged(self, group, zoneNum, isOpen, now):
+        with self.lock:
+            area = self.areas.get(group)
+            if area is None:
+                (name, hostRef) = self.names.get(
+                    group, ('Area %d' % group, 'area%d' % group))
+                area = Area(group, name, hostRef, self.buckets)
+                self.areas[group] = area
+            else:
+                self.areas.move_to_end(group)
+            self.occupied[group] = area
+            self.occupied.move_to_end(group)
+
+            area.lastActivity = now
+            area.addActivity(now, self.bucketSeconds)
+            if isOpen is True:
+                area.openZones.add(zoneNum)
+            else:
+                area.openZones.discard(zoneNum)
+
+            if area.state == OCCUPANCY_STATE_OCCUPIED:
+                return None
+            area.state = OCCUPANCY_STATE_OCCUPIED
+            return area
+
+    # Marks areas vacant that have been quiet for vacantAfter seconds with
+    # all their zones closed. Returns the areas that became vacant.
+    def expire(self, now):
+        vacated = []
+        with self.lock:
+            cutoff = now - self.vacantAfter
+            while len(self.occupied) > 0:
+                (group, area) = next(iter(self.occupied.items()))
+                if area.lastActivity > cutoff:
+                    break
+                del self.occupied[group]
+                # A zone left open keeps the area occupied, its close is
+                # activity that puts the area back in the queue
+                if len(area.openZones) == 0:
+                    area.state = OCCUPANCY_STATE_VACANT
+                    vacated.append(area)
+        return vacated
+
+    def areaDict(self, area, now):
+        return {'group': area.group, 'name': area.name, 'id': area.hostRef,
+                'state': area.state,
+                'idleSeconds': int(now - area.lastActivity),
+                'openZones': sorted(area.openZones),
+                'activity': area.activityCount(now, self.bucketSeconds)}
+
+    # Areas that have seen no activity for more than idleSeconds and have
+    # no zone open, longest idle first
+    def idleAreas(self, idleSeconds, now):
+        idle = []
+        with self.lock:
+            cutoff = now - idleSeconds
+            for area in self.areas.values():
+                if area.lastActivity > cutoff:
+                    break
+                if len(area.openZones) == 0:
+                    idle.append(self.areaDict(area, now))
+        return idle
+
+    # Every area, longest idle first
+    def report(self, now):
+        with self.lock:
+            return [self.areaDict(area, now) for area in self.areas.values()]
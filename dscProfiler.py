@@ -0,0 +1,148 @@
+#######################################################################
+# DSC Alarm sampling profiler
+#
+# Samples the stacks of running threads at a fixed rate for a number
+# of seconds and writes them in the collapsed stack format used by
+# flamegraph.pl and speedscope:
+#   thread;file:function;file:function <samples>
+# Sampling happens in its own thread using sys._current_frames(), so
+# the profiled threads run unmodified and the cost is a few stack
+# walks per interval.
+#######################################################################
+
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+PROFILE_INTERVAL = 0.005
+PROFILE_DEFAULT_SECONDS = 30
+PROFILE_MAX_SECONDS = 600
+
+
+# The length of a profile asked for seconds, what start() uses
+def clampSeconds(seconds):
+    return max(1, min(seconds, PROFILE_MAX_SECONDS))
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, outputDir, interval=PROFILE_INTERVAL):
+        self.outputDir = outputDir
+        self.interval = interval
+        self.thread = None
+        self.threadIds = None
+        self.stacks = {}
+        self.samples = 0
+        self.fileName = None
+        self.done = threading.Event()
+
+    def isRunning(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Starts sampling threadIds (all threads if None) for the given number
+    # of seconds. Returns the name of the file the result will be written
+    # to, or None if a profile is already being taken.
+    def start(self, seconds=PROFILE_DEFAULT_SECONDS, threadIds=None):
+        if self.isRunning() is True:
+            return None
+        seconds = clampSeconds(seconds)
+        self.threadIds = threadIds
+        self.stacks = {}
+        self.samples = 0
+        self.fileName = os.path.join(
+            self.outputDir, time.strftime('dsc-profile-%Y%m%d-%H%M%S.folded'))
+        self.done.clear()
+        self.thread = threading.Thread(target=self.run, args=(seconds,),
+                                       name='dscProfiler')
+        self.thread.daemon = True
+        self.thread.start()
+        return self.fileName
+
+    # Blocks until the current profile has been written
+    def wait(self):
+        self.done.wait()
+
+    def run(self, seconds):
+        ownId = threading.get_ident()
+        endTime = time.time() + seconds
+        while time.time() < endTime:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for (threadId, frame) in sys._current_frames().items():
+                if threadId == ownId:
+                    continue
+                if self.threadIds is not None and \
+                        threadId not in self.threadIds:
+                    continue
+                self.addSample(names.get(threadId, str(threadId)), frame)
+            self.samples += 1
+            time.sleep(self.interval)
+        # Whoever waits for the profile mustn't wait forever if it can't
+        # be written
+        try:
+            self.write()
+        finally:
+            self.done.set()
+
+    def addSample(self, threadName, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s' % (os.path.basename(code.co_filename),
+                                    code.co_name))
+            frame = frame.f_back
+        stack.append(threadName)
+        key = ';'.join(reversed(stack))
+        self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def collapsed(self):
+        return ''.join('%s %d\n' % (stack, count) for (stack, count) in
+                       sorted(self.stacks.items()))
+
+    def write(self):
+        with open(self.fileName, 'w') as f:
+            f.write(self.collapsed())
+
+
+# Handles /debug/profile?seconds=N[&threads=all][&wait=1] for a
+# dscHttp.HttpServer. Samples threadIds() (or all threads) for N seconds.
+# With wait=1 the collapsed stacks are returned, otherwise the name of the
+# file they will be written to.
+def httpProfile(profiler, request, threadIds=lambda: None, log=None):
+    try:
+        seconds = clampSeconds(int(request.query.get(
+            'seconds', PROFILE_DEFAULT_SECONDS)))
+    except ValueError:
+        return (400, 'text/plain', 'seconds must be a whole number.\n')
+    threads = None
+    if request.query.get('threads') != 'all':
+        threads = threadIds()
+    fileName = profiler.start(seconds, threads)
+    if fileName is None:
+        return (409, 'text/plain', 'A profile is already running.\n')
+    if log is not None:
+        log(1, "Profiling for %u seconds to %s" % (seconds, fileName))
+    if request.query.get('wait') == '1':
+        profiler.wait()
+        return (200, 'text/plain', profiler.collapsed())
+    return (202, 'application/json', json.dumps({'file': fileName}))
+
+
+# Makes signum (SIGUSR2 by default) start a profile of threadIds().
+# Signal handlers can only be installed from the main thread, returns
+# False if that's not where we are.
+def installSignalHandler(profiler, threadIds=lambda: None,
+                         seconds=PROFILE_DEFAULT_SECONDS,
+                         signum=getattr(signal, 'SIGUSR2', None)):
+    if signum is None:
+        return False
+
+    def handler(sig, frame):
+        profiler.start(seconds, threadIds())
+    try:
+        signal.signal(signum, handler)
+    except ValueError:
+        return False
+    return True
@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+#######################################################################
+# DSC Alarm capture replay
+#
+# Feeds a wire traffic capture (see dscCapture.py) back through the
+# decoder and event engine in dscCore.py, against stand-in devices, and
+# reports throughput and per-stage latency. Turns recorded production
+# traffic into a reproducible benchmark.
+#
+#   ./dscReplay.py capture.dsccap            # real time
+#   ./dscReplay.py capture.dsccap --speed 10 # ten times faster
+#   ./dscReplay.py capture.dsccap --speed 0  # as fast as possible
+#######################################################################
+
+import argparse
+import json
+import time
+
+import dscCapture
+import dscStubHost
+
+STAGES = ['read', 'decode', 'dispatch']
+
+
+# Plays the received side of a capture back through readline() the way
+# pyserial would, keeping the recorded timing scaled by speed.
+class ReplayPort(object):
+
+    def __init__(self, records, speed):
+        self.records = records
+        self.speed = speed
+        self.pos = 0
+        self.start = None
+        self.timeout = 1
+        self.written = 0
+
+    def isOpen(self):
+        return True
+
+    def flushInput(self):
+        pass
+
+    def close(self):
+        pass
+
+    def done(self):
+        return self.pos >= len(self.records)
+
+    def inWaiting(self):
+        return 0 if self.done() else 1
+
+    def readline(self):
+        if self.done():
+            return b''
+        (timestamp, frame) = self.records[self.pos]
+        if self.start is None:
+            self.start = time.perf_counter() - timestamp / self.speed \
+                if self.speed > 0 else 0
+        if self.speed > 0:
+            wait = self.start + timestamp / self.speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        self.pos += 1
+        return frame + b'\r\n'
+
+    def write(self, data):
+        self.written += 1
+
+
+def percentile(sortedValues, pct):
+    if len(sortedValues) == 0:
+        return 0
+    index = int(round(pct / 100.0 * (len(sortedValues) - 1)))
+    return sortedValues[index]
+
+
+def summarize(samples):
+    samples.sort()
+    count = len(samples)
+    return {'count': count,
+            'meanUs': sum(samples) / count * 1e6 if count > 0 else 0,
+            'p50Us': percentile(samples, 50) * 1e6,
+            'p99Us': percentile(samples, 99) * 1e6,
+            'maxUs': samples[-1] * 1e6 if count > 0 else 0}
+
+
+def replay(fileName, speed=0, zones=64, groups=4, keypads=1, sensors=4):
+    reader = dscCapture.CaptureReader(fileName)
+    records = []
+    txFrames = 0
+    for (timestamp, direction, frame) in reader:
+        if direction == dscCapture.CAPTURE_RX:
+            records.append((timestamp, frame))
+        else:
+            txFrames += 1
+
+    (host, engine) = dscStubHost.newEngine()
+    dscStubHost.buildSite(engine, zones=zones, groups=groups,
+                          keypads=keypads, sensors=sensors)
+    port = ReplayPort(records, speed)
+    engine.port = port
+
+    timings = dict((stage, []) for stage in STAGES)
+    perCommand = {}
+    invalid = 0
+
+    startTime = time.perf_counter()
+    while not port.done():
+        t0 = time.perf_counter()
+        data = engine.readPort()
+        t1 = time.perf_counter()
+        (cmd, dat) = engine.decodePacket(data)
+        t2 = time.perf_counter()
+        if len(cmd) == 0:
+            invalid += 1
+            continue
+        engine.processPacket(cmd, dat)
+        t3 = time.perf_counter()
+
+        # With real time replay the read stage is mostly waiting
+        timings['read'].append(t1 - t0)
+        timings['decode'].append(t2 - t1)
+        timings['dispatch'].append(t3 - t2)
+        perCommand.setdefault(cmd, []).append(t3 - t2)
+    elapsed = time.perf_counter() - startTime
+
+    frames = len(records)
+    return {'capture': fileName,
+            'speed': speed,
+            'frames': frames,
+            'invalidFrames': invalid,
+            'capturedTxFrames': txFrames,
+            'queuedTxCommands': len(engine.txCmdList),
+            'elapsedSeconds': elapsed,
+            'framesPerSecond': frames / elapsed if elapsed > 0 else 0,
+            'stages': dict((stage, summarize(timings[stage]))
+                           for stage in STAGES),
+            'dispatchByCommand': dict((cmd, summarize(perCommand[cmd]))
+                                      for cmd in perCommand)}
+
+
+def printReport(result):
+    print("Replayed %d frames (%d invalid) in %.3f s: %.0f frames/s" %
+          (result['frames'], result['invalidFrames'],
+           result['elapsedSeconds'], result['framesPerSecond']))
+    print("%-10s %8s %10s %10s %10s %10s" %
+          ('stage', 'count', 'mean us', 'p50 us', 'p99 us', 'max us'))
+    rows = [(stage, result['stages'][stage]) for stage in STAGES]
+    rows += sorted(('cmd ' + cmd, stats) for (cmd, stats) in
+                   result['dispatchByCommand'].items())
+    for (name, stats) in rows:
+        print("%-10s %8d %10.1f %10.1f %10.1f %10.1f" %
+              (name, stats['count'], stats['meanUs'], stats['p50Us'],
+               stats['p99Us'], stats['maxUs']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a DSC capture')
+    parser.add_argument('capture')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed multiplier, 0 for maximum')
+    parser.add_argument('--zones', type=int, default=64)
+    parser.add_argument('--groups', type=int, default=4)
+    parser.add_argument('--keypads', type=int, default=1)
+    parser.add_argument('--sensors', type=int, default=4)
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    args = parser.parse_args()
+
+    result = replay(args.capture, args.speed, args.zones, args.groups,
+                    args.keypads, args.sensors)
+    if args.json is True:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        printReport(result)
+
+
+if __name__ == '__main__':
+    main()
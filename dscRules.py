@@ -0,0 +1,296 @@
+#######################################################################
+# DSC Alarm local rules
+#
+# Automations that run in the engine itself, straight off the decoded
+# zone events, instead of going through the host and a controller
+# script first:
+#
+#   {"name": "Garage left open",
+#    "if": {"group": "Garage", "state": "open", "minutes": 10},
+#    "then": [{"scene": 42},
+#             {"command": {"action": "armStay", "partition": 2}}]}
+#
+# A condition is about zones, all of them or any one of them (match,
+# any by default) being in state (open, which includes tripped, closed
+# or tripped), for at least minutes if given:
+#
+#   {"zone": 5, ...}  {"zones": [1, 2], ...}  {"group": "<name>", ...}
+#
+# or combines others: {"any": [...]} or {"all": [...]}.
+#
+# A rule fires once when its condition becomes true and again only
+# after it has been false in between. The actions are run in order:
+# command takes a command or list of commands as in dscBatch.py, scene
+# starts a scene on the host (an HC2 scene, an Indigo action group),
+# event fires a host event and log writes to the log.
+#
+# Rules are indexed by the zones they look at, so a zone event only
+# evaluates the rules that can change because of it. A condition that
+# needs time to pass puts its rule on a timer heap, and the engine's
+# run loop only looks at the front of the heap.
+#######################################################################
+
+import heapq
+
+RULE_STATE_OPEN = 'open'
+RULE_STATE_CLOSED = 'closed'
+RULE_STATE_TRIPPED = 'tripped'
+RULE_STATES = (RULE_STATE_OPEN, RULE_STATE_CLOSED, RULE_STATE_TRIPPED)
+RULE_ACTIONS = ('command', 'scene', 'event', 'log')
+
+
+class RuleError(ValueError):
+    pass
+
+
+# What the rules know of a zone: its state, when that last changed and
+# when it last went from closed to open or tripped
+class ZoneTrack(object):
+
+    def __init__(self, state, now):
+        self.state = state
+        self.changedAt = now
+        self.openedAt = now
+
+    # The time since which the zone has been in state, None if it isn't
+    def since(self, state):
+        if state == RULE_STATE_OPEN:
+            if self.state == RULE_STATE_CLOSED:
+                return None
+            return self.openedAt
+        if self.state != state:
+            return None
+        return self.changedAt
+
+
+class ZoneCondition(object):
+
+    def __init__(self, zones, state, seconds, matchAll):
+        self.zones = zones
+        self.state = state
+        self.seconds = seconds
+        self.matchAll = matchAll
+
+    # Returns (true now, when it could become true with no other change
+    # or None)
+    def evaluate(self, tracks, now):
+        dues = []
+        for zoneNum in self.zones:
+            track = tracks.get(zoneNum)
+            since = None if track is None else track.since(self.state)
+            if since is None:
+                if self.matchAll is True:
+                    return (False, None)
+                continue
+            due = since + self.seconds
+            if due <= now:
+                if self.matchAll is False:
+                    return (True, None)
+                continue
+            dues.append(due)
+        if len(dues) == 0:
+            return (self.matchAll, None)
+        return (False, max(dues) if self.matchAll is True else min(dues))
+
+
+class AnyCondition(object):
+
+    def __init__(self, conditions):
+        self.conditions = conditions
+        self.zones = set().union(*(c.zones for c in conditions))
+
+    def evaluate(self, tracks, now):
+        dues = []
+        for condition in self.conditions:
+            (met, due) = condition.evaluate(tracks, now)
+            if met is True:
+                return (True, None)
+            if due is not None:
+                dues.append(due)
+        return (False, min(dues) if len(dues) > 0 else None)
+
+
+class AllCondition(object):
+
+    def __init__(self, conditions):
+        self.conditions = conditions
+        self.zones = set().union(*(c.zones for c in conditions))
+
+    def evaluate(self, tracks, now):
+        dues = []
+        for condition in self.conditions:
+            (met, due) = condition.evaluate(tracks, now)
+            if met is False:
+                if due is None:
+                    return (False, None)
+                dues.append(due)
+        if len(dues) == 0:
+            return (True, None)
+        return (False, max(dues))
+
+
+class Rule(object):
+
+    def __init__(self, name, condition, actions):
+        self.name = name
+        self.condition = condition
+        self.actions = actions
+        self.active = False
+        self.nextDue = None
+        self.fired = 0
+        self.firedAt = None
+
+
+# Turns the "if" of a rule into a condition. groups maps group names to
+# their zone numbers. Raises RuleError if spec isn't valid.
+def compileCondition(spec, groups):
+    if not isinstance(spec, dict):
+        raise RuleError('a condition must be an object')
+    for combine in ('any', 'all'):
+        if combine in spec:
+            children = spec[combine]
+            if not isinstance(children, list) or len(children) == 0:
+                raise RuleError('%s takes a list of conditions' % combine)
+            conditions = [compileCondition(child, groups)
+                          for child in children]
+            if combine == 'any':
+                return AnyCondition(conditions)
+            return AllCondition(conditions)
+
+    if 'zone' in spec:
+        zones = [spec['zone']]
+    elif 'zones' in spec:
+        zones = spec['zones']
+    elif 'group' in spec:
+        zones = groups.get(spec['group'])
+        if zones is None:
+            raise RuleError('unknown zone group %r' % (spec['group'],))
+    else:
+        raise RuleError('a condition needs zone, zones, group, any or all')
+    if not isinstance(zones, list) or len(zones) == 0 or \
+            any(type(zoneNum) is not int for zoneNum in zones):
+        raise RuleError('zones must be a list of zone numbers')
+
+    state = spec.get('state', RULE_STATE_OPEN)
+    if state not in RULE_STATES:
+        raise RuleError('state must be one of %s' % ', '.join(RULE_STATES))
+    match = spec.get('match', 'any')
+    if match not in ('any', 'all'):
+        raise RuleError('match must be any or all')
+    minutes = spec.get('minutes', 0)
+    if type(minutes) not in (int, float) or minutes < 0:
+        raise RuleError('invalid minutes %r' % (minutes,))
+    return ZoneCondition(frozenset(zones), state, 60 * minutes,
+                         match == 'all')
+
+
+# Checks the "then" of a rule, checkCommand raises ValueError for a
+# command the engine can't send
+def compileActions(specs, checkCommand):
+    if not isinstance(specs, list) or len(specs) == 0:
+        raise RuleError('then must be a list of actions')
+    actions = []
+    for spec in specs:
+        if not isinstance(spec, dict) or len(spec) != 1 or \
+                list(spec)[0] not in RULE_ACTIONS:
+            raise RuleError('an action must be one of %s' %
+                            ', '.join(RULE_ACTIONS))
+        (kind, value) = list(spec.items())[0]
+        if kind == 'command':
+            commands = value if isinstance(value, list) else [value]
+            for command in commands:
+                checkCommand(command)
+            value = commands
+        actions.append((kind, value))
+    return actions
+
+
+class RuleEngine(object):
+
+    def __init__(self):
+        self.rules = []
+        self.zoneIndex = {}  # zone number: rules looking at it
+        self.tracks = {}  # zone number: ZoneTrack
+        self.timers = []  # heap of (due, sequence, rule)
+        self.sequence = 0
+
+    # Replaces the rules with specs, leaving the old ones in place if any
+    # isn't valid. Rules already true now are taken as having fired.
+    def setRules(self, specs, groups, checkCommand, now):
+        rules = []
+        for (index, spec) in enumerate(specs):
+            name = spec.get('name', 'rule %u' % (index + 1)) \
+                if isinstance(spec, dict) else index
+            try:
+                if not isinstance(spec, dict):
+                    raise RuleError('a rule must be an object')
+                rules.append(Rule(name, compileCondition(spec.get('if'),
+                                                         groups),
+                                  compileActions(spec.get('then'),
+                                                 checkCommand)))
+            except ValueError as err:
+                raise RuleError('rule %s: %s' % (name, str(err)))
+
+        self.rules = rules
+        self.zoneIndex = {}
+        self.timers = []
+        for rule in rules:
+            for zoneNum in rule.condition.zones:
+                self.zoneIndex.setdefault(zoneNum, []).append(rule)
+            self.evaluate(rule, now, [])
+            rule.fired = 0
+
+    # Sets the state a zone had before any rule saw it change
+    def initialState(self, zoneNum, state, now):
+        self.tracks[zoneNum] = ZoneTrack(state, now)
+
+    # Records a zone event. Returns the rules that fired.
+    def zoneChanged(self, zoneNum, state, now):
+        track = self.tracks.get(zoneNum)
+        if track is None:
+            track = ZoneTrack(state, now)
+            self.tracks[zoneNum] = track
+        else:
+            if track.state == RULE_STATE_CLOSED:
+                track.openedAt = now
+            track.state = state
+            track.changedAt = now
+
+        fired = []
+        for rule in self.zoneIndex.get(zoneNum, ()):
+            self.evaluate(rule, now, fired)
+        return fired
+
+    # Evaluates the rules whose timers are due. Returns the rules that
+    # fired.
+    def tick(self, now):
+        fired = []
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            (due, sequence, rule) = heapq.heappop(self.timers)
+            # Only the rule's earliest timer counts, later ones are stale
+            if rule.nextDue != due:
+                continue
+            rule.nextDue = None
+            self.evaluate(rule, now, fired)
+        return fired
+
+    def evaluate(self, rule, now, fired):
+        (met, due) = rule.condition.evaluate(self.tracks, now)
+        if met is True:
+            if rule.active is False:
+                rule.active = True
+                rule.fired += 1
+                rule.firedAt = now
+                fired.append(rule)
+        else:
+            rule.active = False
+        if due is not None and (rule.nextDue is None or due < rule.nextDue):
+            rule.nextDue = due
+            self.sequence += 1
+            heapq.heappush(self.timers, (due, self.sequence, rule))
+
+    def report(self):
+        return [{'name': rule.name, 'active': rule.active,
+                 'zones': sorted(rule.condition.zones), 'fired': rule.fired,
+                 'firedAt': rule.firedAt, 'nextCheck': rule.nextDue}
+                for rule in self.rules]
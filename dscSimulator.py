@@ -0,0 +1,643 @@
+#!/usr/bin/python3
+#######################################################################
+# DSC IT-100 panel simulator
+#
+# Creates a pseudo-terminal that speaks the IT-100 protocol so the
+# gateway can be load and soak tested without a real panel. Point the
+# serialPort setting at the printed device (or the --link path) and the
+# gateway will talk to it exactly as it would to a real IT-100. With
+# --tcp it listens on a TCP port instead, like an IP serial server, or
+# with --password like an Envisalink asking for its TPI login.
+#
+# Example, 64 zones changing 20 times a second with 1% corrupt frames:
+#   ./dscSimulator.py --link /tmp/dsc-sim --rate 609:10 --rate 610:10 \
+#                     --error-rate 0.01
+#######################################################################
+
+import argparse
+from datetime import datetime
+import heapq
+import json
+import os
+import pty
+import random
+import select
+import socket
+import threading
+import time
+import tty
+
+import dscCodec
+import dscLabels
+
+ZONE_COUNT = 64
+PARTITION_COUNT = 8
+SENSOR_COUNT = 4
+EXIT_DELAY = 2.0
+TIME_BROADCAST_INTERVAL = 240
+BUFFER_WINDOW = 1.0
+
+# Commands that can be generated as a continuous stream with --rate
+STREAM_COMMANDS = ['550', '609', '610', '901', '903']
+
+LCD_MESSAGES = ['System is Ready to Arm    ',
+                'Secure System Before Arming',
+                'Exit Delay in Progress     ',
+                'Date     Time  ',
+                'Enter Code to Disarm System']
+
+
+class PanelSimulator(object):
+
+    def __init__(self, zones=ZONE_COUNT, partitions=1, baud=0, ackDelay=0,
+                 errorRate=0, garbageRate=0, busyRate=0, dropRate=0,
+                 bufferLimit=0, seed=None):
+        self.zones = zones
+        self.partitions = partitions
+        self.baud = baud
+        self.ackDelay = ackDelay
+        self.errorRate = errorRate
+        self.garbageRate = garbageRate
+        self.busyRate = busyRate
+        self.dropRate = dropRate
+        self.bufferLimit = bufferLimit
+        self.random = random.Random(seed)
+
+        self.master = None
+        self.slave = None
+        self.link = None
+        self.listener = None
+        self.client = None
+        self.password = ''
+        self.loggedIn = True
+        self.thread = None
+        self.running = False
+        self.rxBuffer = b''
+        self.txQueue = []
+        self.wireFree = 0
+        self.timers = []
+        self.timerSeq = 0
+        self.streams = {}
+        self.recentRx = []
+        self.nextGarbage = 0
+        self.timeBroadcast = False
+
+        self.openZones = set()
+        self.labels = dict((zone, 'Zone %d' % zone)
+                           for zone in range(1, zones + 1))
+        self.labels.update((dscLabels.PARTITION_LABEL_BASE + partition,
+                            'Partition %d' % partition)
+                           for partition in range(1, partitions + 1))
+        self.armed = {}
+        self.setPoints = {}
+        for sensor in range(1, SENSOR_COUNT + 1):
+            self.setPoints[sensor] = [24, 20]
+
+        self.stats = {'rxFrames': 0, 'rxBadChecksum': 0, 'rxGarbage': 0,
+                      'txFrames': 0, 'txBytes': 0, 'txCorrupted': 0,
+                      'txGarbage': 0, 'acks': 0, 'busy': 0, 'dropped': 0,
+                      'bufferNearFull': 0, 'commands': {}}
+
+    ###########################################################################
+    # Pseudo-terminal
+    ###########################################################################
+
+    # Creates the pty pair and returns the path the gateway should open
+    def open(self, link=None):
+        (self.master, self.slave) = pty.openpty()
+        # Raw mode so the line discipline doesn't echo or translate CR/LF
+        tty.setraw(self.slave)
+        path = os.ttyname(self.slave)
+        if link is not None:
+            if os.path.lexists(link):
+                os.unlink(link)
+            os.symlink(path, link)
+            self.link = link
+            return link
+        return path
+
+    # Listens on a TCP port instead of a pty, one client at a time. With a
+    # password, clients have to log in as on an Envisalink TPI. Returns
+    # the port setting for the gateway.
+    def openTcp(self, port, address='127.0.0.1', password=''):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((address, port))
+        self.listener.listen(1)
+        self.password = password
+        return 'tcp://%s:%u' % (address, self.listener.getsockname()[1])
+
+    def acceptClient(self):
+        (client, peer) = self.listener.accept()
+        self.dropClient()
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.client = client
+        self.master = client.fileno()
+        self.rxBuffer = b''
+        self.txQueue = []
+        if len(self.password) > 0:
+            self.loggedIn = False
+            self.txQueue.append(dscCodec.encodeFrame('5053').encode('ascii'))
+
+    def dropClient(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+            self.master = None
+
+    def close(self):
+        if self.link is not None and os.path.islink(self.link):
+            os.unlink(self.link)
+        if self.listener is not None:
+            self.dropClient()
+            self.listener.close()
+            self.listener = None
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = None
+        self.slave = None
+
+    ###########################################################################
+    # Scheduling
+    ###########################################################################
+
+    # Runs func(*args) delay seconds from now
+    def schedule(self, delay, func, *args):
+        self.timerSeq += 1
+        heapq.heappush(self.timers,
+                       (time.time() + delay, self.timerSeq, func, args))
+
+    # Generates a stream of the given command at rate frames per second
+    def addStream(self, cmd, rate):
+        if cmd not in STREAM_COMMANDS:
+            raise ValueError("Can't generate a stream of command %s" % cmd)
+        if rate <= 0:
+            self.streams.pop(cmd, None)
+            return
+        self.streams[cmd] = [1.0 / rate, time.time()]
+
+    ###########################################################################
+    # Transmit
+    ###########################################################################
+
+    # Queues a frame for the gateway, adding checksum and CR/LF
+    def send(self, data):
+        if self.loggedIn is False:
+            return
+        checksum = dscCodec.calcChecksum(data)
+        if self.errorRate > 0 and self.random.random() < self.errorRate:
+            checksum = (checksum + 1) % 256
+            self.stats['txCorrupted'] += 1
+        self.txQueue.append(("%s%02X\r\n" % (data, checksum)).encode('ascii'))
+        self.stats['txFrames'] += 1
+
+    # Queues count bytes of line noise, ending in CR/LF like a real frame
+    def sendGarbage(self, count=16):
+        noise = bytes(self.random.randrange(256) for i in range(count))
+        self.txQueue.append(noise + b'\r\n')
+        self.stats['txGarbage'] += 1
+
+    def flushTx(self, now):
+        if self.master is None:
+            # No TCP client, what the panel says goes nowhere
+            self.txQueue = []
+            return
+        while len(self.txQueue) > 0 and now >= self.wireFree:
+            pkt = self.txQueue.pop(0)
+            try:
+                os.write(self.master, pkt)
+            except OSError:
+                self.dropClient()
+                return
+            self.stats['txBytes'] += len(pkt)
+            if self.baud > 0:
+                # 10 bits per byte on the wire, 8N1
+                self.wireFree = now + len(pkt) * 10.0 / self.baud
+
+    ###########################################################################
+    # Receive
+    ###########################################################################
+
+    def readMaster(self):
+        try:
+            data = os.read(self.master, 4096)
+        except OSError:
+            return
+        if len(data) == 0 and self.client is not None:
+            self.dropClient()
+            return
+        self.rxBuffer += data
+        while b'\n' in self.rxBuffer:
+            (line, self.rxBuffer) = self.rxBuffer.split(b'\n', 1)
+            self.receiveLine(line.strip())
+
+    def receiveLine(self, line):
+        if len(line) == 0:
+            return
+        try:
+            line = line.decode('ascii')
+            (cmd, dat, sum_) = (line[:3], line[3:-2], int(line[-2:], 16))
+        except ValueError:
+            self.stats['rxGarbage'] += 1
+            return
+
+        self.stats['rxFrames'] += 1
+        if sum_ != dscCodec.calcChecksum(cmd + dat):
+            self.stats['rxBadChecksum'] += 1
+            self.respond(['501'])
+            return
+
+        if self.loggedIn is False:
+            self.login(cmd, dat)
+            return
+
+        self.stats['commands'][cmd] = self.stats['commands'].get(cmd, 0) + 1
+        self.checkBufferLimit()
+
+        if self.dropRate > 0 and self.random.random() < self.dropRate:
+            self.stats['dropped'] += 1
+            return
+        if self.busyRate > 0 and self.random.random() < self.busyRate:
+            self.stats['busy'] += 1
+            self.respond(['502017'])
+            return
+
+        self.respond(self.handleCommand(cmd, dat))
+
+    # Handles a frame from a TPI client that hasn't logged in yet. All it
+    # may send is 005 <password>, answered with 505 1 if the password is
+    # right and 505 0 if not.
+    def login(self, cmd, dat):
+        if cmd != '005':
+            return
+        result = '1' if dat == self.password else '0'
+        self.txQueue.append(dscCodec.encodeFrame('505' + result)
+                            .encode('ascii'))
+        self.loggedIn = result == '1'
+
+    # Sends 816 when more than bufferLimit commands arrived within a second
+    def checkBufferLimit(self):
+        if self.bufferLimit <= 0:
+            return
+        now = time.time()
+        self.recentRx.append(now)
+        while self.recentRx[0] < now - BUFFER_WINDOW:
+            self.recentRx.pop(0)
+        if len(self.recentRx) > self.bufferLimit:
+            self.stats['bufferNearFull'] += 1
+            self.send('816')
+            self.recentRx = []
+
+    def respond(self, frames):
+        if self.ackDelay > 0:
+            self.schedule(self.ackDelay, self.sendAll, frames)
+        else:
+            self.sendAll(frames)
+
+    def sendAll(self, frames):
+        for frame in frames:
+            if frame.startswith('500'):
+                self.stats['acks'] += 1
+            self.send(frame)
+
+    ###########################################################################
+    # IT-100 Command Handling
+    ###########################################################################
+
+    # Returns the list of frames the panel answers cmd with
+    def handleCommand(self, cmd, dat):
+        ack = '500' + cmd
+
+        if cmd == '000':  # Poll
+            return [ack]
+
+        elif cmd == '001':  # Status Request
+            return [ack] + self.statusDump()
+
+        elif cmd == '002':  # Labels Request
+            return [ack] + ['570%03d%-*s' % (number, dscLabels.LABEL_LENGTH,
+                                              text)
+                            for (number, text) in sorted(self.labels.items())]
+
+        elif cmd == '010':  # Set Date and Time
+            return [ack]
+
+        elif cmd == '056':  # Time Stamp Control / Time Broadcast
+            self.timeBroadcast = (dat == '1')
+            if self.timeBroadcast is True:
+                self.schedule(TIME_BROADCAST_INTERVAL, self.broadcastTime)
+            return [ack]
+
+        elif cmd in ('030', '031', '032', '033'):  # Arm
+            partition = self.partitionArg(dat)
+            if partition is None:
+                return ['502021']
+            if len(self.openZones) > 0:
+                return [ack, '672%d' % partition]
+            mode = {'030': 0, '031': 1, '032': 3, '033': 0}[cmd]
+            self.schedule(EXIT_DELAY, self.finishArming, partition, mode)
+            return [ack, '656%d' % partition]
+
+        elif cmd == '040':  # Disarm
+            partition = self.partitionArg(dat)
+            if partition is None:
+                return ['502021']
+            if partition not in self.armed:
+                return [ack, '502023']
+            del self.armed[partition]
+            return [ack, '750%d0001' % partition, '655%d' % partition]
+
+        elif cmd == '060':  # Panic
+            return [ack]
+
+        elif cmd == '070':  # Send Keypress
+            return [ack]
+
+        elif cmd in ('095', '096', '097'):  # Thermostat
+            sensor = self.sensorArg(dat)
+            if sensor is None:
+                return ['502029']
+            if cmd == '096' and self.adjustSetPoint(sensor, dat) is False:
+                return ['502029']
+            (cool, heat) = self.setPoints[sensor]
+            return [ack, '563%d%03d%03d' % (sensor, cool, heat)]
+
+        # Anything else is a command the IT-100 doesn't know
+        return ['502029']
+
+    def partitionArg(self, dat):
+        if len(dat) < 1 or not dat[0].isdigit():
+            return None
+        partition = int(dat[0])
+        if partition < 1 or partition > self.partitions:
+            return None
+        return partition
+
+    def sensorArg(self, dat):
+        if len(dat) < 1 or not dat[0].isdigit():
+            return None
+        sensor = int(dat[0])
+        if sensor not in self.setPoints:
+            return None
+        return sensor
+
+    # 096TWA### where W is C(ool)/H(eat) and A is +, - or =
+    def adjustSetPoint(self, sensor, dat):
+        if len(dat) != 6 or dat[1] not in 'CcHh' or dat[2] not in '+-=':
+            return False
+        which = 0 if dat[1] in 'Cc' else 1
+        if dat[2] == '+':
+            self.setPoints[sensor][which] += 1
+        elif dat[2] == '-':
+            self.setPoints[sensor][which] -= 1
+        else:
+            self.setPoints[sensor][which] = int(dat[3:])
+        return True
+
+    def finishArming(self, partition, mode):
+        self.armed[partition] = mode
+        self.send('652%d%d' % (partition, mode))
+        self.send('700%d0001' % partition)
+
+    def statusDump(self):
+        frames = []
+        for zone in range(1, self.zones + 1):
+            if zone in self.openZones:
+                frames.append('609%03d' % zone)
+            else:
+                frames.append('610%03d' % zone)
+        for partition in range(1, self.partitions + 1):
+            if partition in self.armed:
+                frames.append('652%d%d' % (partition, self.armed[partition]))
+            elif len(self.openZones) > 0:
+                frames.append('651%d' % partition)
+            else:
+                frames.append('650%d' % partition)
+        for led in range(1, 10):
+            frames.append('903%d%d' % (led, 1 if led == 9 else 0))
+        frames.append('8411')
+        return frames
+
+    ###########################################################################
+    # Generated Events
+    ###########################################################################
+
+    def broadcastTime(self):
+        if self.timeBroadcast is False:
+            return
+        self.send(self.timeFrame())
+        self.schedule(TIME_BROADCAST_INTERVAL, self.broadcastTime)
+
+    # Changes a label as an installer would, which the panel reports as
+    # installer's mode followed by the partitions' states
+    def programLabel(self, number, text):
+        self.labels[number] = text[:dscLabels.LABEL_LENGTH]
+        self.send('680')
+        self.schedule(1.0, self.sendAll, [frame for frame in
+                                          self.statusDump()
+                                          if frame[:3] in ('650', '651')])
+
+    def timeFrame(self):
+        return '550' + datetime.now().strftime("%H%M%m%d%y")
+
+    def generate(self, cmd):
+        if cmd == '550':
+            self.send(self.timeFrame())
+        elif cmd == '609':
+            closed = [z for z in range(1, self.zones + 1)
+                      if z not in self.openZones]
+            if len(closed) > 0:
+                zone = self.random.choice(closed)
+                self.openZones.add(zone)
+                self.send('609%03d' % zone)
+        elif cmd == '610':
+            if len(self.openZones) > 0:
+                zone = self.random.choice(sorted(self.openZones))
+                self.openZones.discard(zone)
+                self.send('610%03d' % zone)
+        elif cmd == '901':
+            text = self.random.choice(LCD_MESSAGES)
+            self.send('90110032%-32s' % text[:32])
+        elif cmd == '903':
+            self.send('903%d%d' % (self.random.randint(1, 9),
+                                   self.random.randint(0, 2)))
+
+    ###########################################################################
+    # Main Loop
+    ###########################################################################
+
+    def step(self, timeout):
+        now = time.time()
+        wake = now + timeout
+        if len(self.timers) > 0:
+            wake = min(wake, self.timers[0][0])
+        for (interval, due) in self.streams.values():
+            wake = min(wake, due)
+        if len(self.txQueue) > 0:
+            wake = min(wake, self.wireFree)
+        if self.garbageRate > 0:
+            wake = min(wake, self.nextGarbage)
+
+        fds = [fd for fd in (self.master, self.listener) if fd is not None]
+        (readable, w, x) = select.select(fds, [], [], max(0, wake - now))
+        if self.listener is not None and self.listener in readable:
+            self.acceptClient()
+        elif self.master is not None and self.master in readable:
+            self.readMaster()
+
+        now = time.time()
+        while len(self.timers) > 0 and self.timers[0][0] <= now:
+            (due, seq, func, args) = heapq.heappop(self.timers)
+            func(*args)
+
+        for cmd in list(self.streams.keys()):
+            stream = self.streams[cmd]
+            # Catch up on missed frames, but never by more than a second
+            stream[1] = max(stream[1], now - 1)
+            while stream[1] <= now:
+                self.generate(cmd)
+                stream[1] += stream[0]
+
+        if self.garbageRate > 0 and now >= self.nextGarbage:
+            self.sendGarbage(self.random.randint(1, 40))
+            self.nextGarbage = now + \
+                self.random.expovariate(self.garbageRate)
+
+        self.flushTx(now)
+
+    def run(self, duration=None):
+        self.running = True
+        endTime = None
+        if duration is not None:
+            endTime = time.time() + duration
+        while self.running is True:
+            if endTime is not None and time.time() >= endTime:
+                break
+            self.step(0.1)
+        self.running = False
+
+    # Runs the simulator in a background thread, for use from test scripts
+    def start(self, duration=None):
+        self.thread = threading.Thread(target=self.run, args=(duration,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    ###########################################################################
+    # Scripting
+    ###########################################################################
+
+    # Loads a script of timed actions, one per line:
+    #   <seconds> send <frame without checksum>
+    #   <seconds> garbage <bytes>
+    #   <seconds> rate <cmd> <frames per second>
+    #   <seconds> delay <ack delay seconds>
+    #   <seconds> errors <corrupt frame probability>
+    #   <seconds> busy <busy reply probability>
+    #   <seconds> label <label number> <text>
+    #   <seconds> quit
+    def loadScript(self, fileName):
+        with open(fileName) as f:
+            for line in f:
+                line = line.split('#', 1)[0].split()
+                if len(line) < 2:
+                    continue
+                (at, action, args) = (float(line[0]), line[1], line[2:])
+                self.schedule(at, self.runScriptAction, action, args)
+
+    def runScriptAction(self, action, args):
+        if action == 'send':
+            self.send(args[0])
+        elif action == 'garbage':
+            self.sendGarbage(int(args[0]))
+        elif action == 'rate':
+            self.addStream(args[0], float(args[1]))
+        elif action == 'delay':
+            self.ackDelay = float(args[0])
+        elif action == 'errors':
+            self.errorRate = float(args[0])
+        elif action == 'busy':
+            self.busyRate = float(args[0])
+        elif action == 'label':
+            self.programLabel(int(args[0]), ' '.join(args[1:]))
+        elif action == 'quit':
+            self.running = False
+        else:
+            raise ValueError("Unknown script action '%s'" % action)
+
+
+def parseRate(text):
+    (cmd, rate) = text.split(':')
+    return (cmd, float(rate))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DSC IT-100 simulator')
+    parser.add_argument('--link', help='symlink to create for the pty')
+    parser.add_argument('--tcp', type=int, metavar='PORT',
+                        help='listen on this TCP port instead of a pty')
+    parser.add_argument('--password', default='',
+                        help='TPI password TCP clients have to log in with')
+    parser.add_argument('--zones', type=int, default=ZONE_COUNT)
+    parser.add_argument('--partitions', type=int, default=1,
+                        choices=range(1, PARTITION_COUNT + 1))
+    parser.add_argument('--rate', type=parseRate, action='append',
+                        default=[], metavar='CMD:HZ',
+                        help='generate CMD (%s) at HZ frames per second' %
+                        '/'.join(STREAM_COMMANDS))
+    parser.add_argument('--baud', type=int, default=0,
+                        help='emulate wire speed, 0 for unlimited')
+    parser.add_argument('--ack-delay', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='probability of a corrupt checksum')
+    parser.add_argument('--garbage-rate', type=float, default=0,
+                        help='bursts of line noise per second')
+    parser.add_argument('--busy-rate', type=float, default=0,
+                        help='probability of a 502-017 reply')
+    parser.add_argument('--drop-rate', type=float, default=0,
+                        help='probability of not answering a command')
+    parser.add_argument('--buffer-limit', type=int, default=0,
+                        help='send 816 above this many commands a second')
+    parser.add_argument('--script', help='file of timed actions')
+    parser.add_argument('--duration', type=float)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--stats', help='write statistics JSON here on exit')
+    args = parser.parse_args()
+
+    sim = PanelSimulator(zones=args.zones, partitions=args.partitions,
+                         baud=args.baud, ackDelay=args.ack_delay,
+                         errorRate=args.error_rate,
+                         garbageRate=args.garbage_rate,
+                         busyRate=args.busy_rate, dropRate=args.drop_rate,
+                         bufferLimit=args.buffer_limit, seed=args.seed)
+    if args.tcp is not None:
+        address = sim.openTcp(args.tcp, password=args.password)
+    else:
+        address = sim.open(args.link)
+    print("IT-100 simulator listening on %s" % address)
+    for (cmd, rate) in args.rate:
+        sim.addStream(cmd, rate)
+    if args.script is not None:
+        sim.loadScript(args.script)
+
+    try:
+        sim.run(args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.close()
+
+    print(json.dumps(sim.stats, indent=2, sort_keys=True))
+    if args.stats is not None:
+        with open(args.stats, 'w') as f:
+            json.dump(sim.stats, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
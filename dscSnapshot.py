@@ -0,0 +1,280 @@
+#!/usr/bin/python3
+#######################################################################
+# DSC Alarm shared state snapshot
+#
+# The engine keeps the panel's state in a small memory-mapped file so
+# local dashboards and scripts can read it without asking the gateway
+# anything. Once a reader has mapped the file, a read is a copy of a
+# few hundred bytes: no system call, no lock and no work for the engine.
+#
+# The layout is fixed, little-endian, SNAPSHOT_SIZE bytes:
+#
+#   offset  size
+#        0     4  magic 'DSCS'
+#        4     2  layout version, SNAPSHOT_VERSION
+#        8     4  sequence, odd while the engine is writing
+#       12     4  flags, bit 0 set while the panel link is up
+#       16     8  time of the last change, seconds since the epoch
+#       24     9  LEDs Ready, Armed, Memory, Bypass, Trouble, Program,
+#                 Fire, Backlight and AC: 0 off, 1 on, 2 flashing,
+#                 255 not reported yet
+#       40  64x16 zones 1-64: state (see ZONE_STATES) at +0, time it
+#                 changed (double) at +8
+#     1064   8x16 partitions 1-8: state (PARTITION_STATES) at +0, armed
+#                 state (ARMED_STATES) at +1, time either changed at +8
+#     1192   4x16 thermostats 1-4: inside, outside, cool and heat set
+#                 point as signed bytes at +0, a bit per one that was
+#                 reported at +4, time of the last reading at +8
+#
+# The engine is the only writer, and updates the block with a seqlock:
+# it makes the sequence odd, writes, then makes it even again. Readers
+# copy the block and use the copy only if the sequence was the same
+# even number before and after, see SnapshotReader. Each update is
+# consistent on its own, a zone and its partition changing together
+# are two updates. A reader that gets no consistent copy within
+# SNAPSHOT_WAIT seconds (an engine that died while writing leaves the
+# sequence odd) uses the last one and reports it as stale.
+#
+#   ./dscSnapshot.py /tmp/dsc.state
+#######################################################################
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import time
+
+SNAPSHOT_MAGIC = b'DSCS'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SIZE = 1256
+ZONE_COUNT = 64
+PARTITION_COUNT = 8
+SENSOR_COUNT = 4
+
+SEQUENCE_OFFSET = 8
+FLAGS_OFFSET = 12
+UPDATED_OFFSET = 16
+LED_OFFSET = 24
+ZONE_OFFSET = 40
+PARTITION_OFFSET = 1064
+SENSOR_OFFSET = 1192
+ENTRY_SIZE = 16
+
+# Reads retried at once before backing off, an update takes microseconds
+SNAPSHOT_SPINS = 100
+SNAPSHOT_BACKOFF = 0.001
+SNAPSHOT_WAIT = 0.1
+
+FLAG_LINK_UP = 0x01
+LED_UNKNOWN = 255
+
+# Codes of the states, 0 is always not reported yet
+ZONE_STATES = (None, 'closed', 'open', 'tripped')
+PARTITION_STATES = (None, 'disarmed', 'exitDelay', 'FailedToArm', 'armed',
+                    'entryDelay', 'tripped')
+ARMED_STATES = (None, 'disarmed', 'stay', 'away')
+LED_NAMES = ('Ready', 'Armed', 'Memory', 'Bypass', 'Trouble', 'Program',
+             'Fire', 'Backlight', 'AC')
+LED_STATES = ('off', 'on', 'flashing')
+TEMP_KEYS = ('inside', 'outside', 'cool', 'heat')
+
+
+class SnapshotWriter(object):
+
+    # Maps fileName, creating it if needed. An existing file is reused,
+    # not replaced, so readers that have it mapped keep seeing updates.
+    def __init__(self, fileName):
+        self.fileName = fileName
+        fd = os.open(fileName, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            os.ftruncate(fd, SNAPSHOT_SIZE)
+            self.map = mmap.mmap(fd, SNAPSHOT_SIZE)
+        finally:
+            os.close(fd)
+        self.sequence = struct.unpack_from('<I', self.map,
+                                           SEQUENCE_OFFSET)[0] & ~1
+        # Starts from nothing reported, what a previous run left is stale
+        self.begin()
+        self.map[FLAGS_OFFSET:SNAPSHOT_SIZE] = \
+            bytes(SNAPSHOT_SIZE - FLAGS_OFFSET)
+        self.map[LED_OFFSET:LED_OFFSET + len(LED_NAMES)] = \
+            bytes([LED_UNKNOWN] * len(LED_NAMES))
+        struct.pack_into('<4sH', self.map, 0, SNAPSHOT_MAGIC,
+                         SNAPSHOT_VERSION)
+        self.end()
+
+    def begin(self):
+        self.sequence = (self.sequence + 1) & 0xffffffff
+        struct.pack_into('<I', self.map, SEQUENCE_OFFSET, self.sequence)
+
+    def end(self):
+        struct.pack_into('<d', self.map, UPDATED_OFFSET, time.time())
+        self.sequence = (self.sequence + 1) & 0xffffffff
+        struct.pack_into('<I', self.map, SEQUENCE_OFFSET, self.sequence)
+
+    def setLinkUp(self, up):
+        self.begin()
+        struct.pack_into('<I', self.map, FLAGS_OFFSET,
+                         FLAG_LINK_UP if up is True else 0)
+        self.end()
+
+    # index as in the 903 frame, 1 for Ready to 9 for AC
+    def setLed(self, index, state):
+        if not 1 <= index <= len(LED_NAMES):
+            return
+        self.begin()
+        self.map[LED_OFFSET + index - 1] = state
+        self.end()
+
+    def setZone(self, zoneNum, state, now):
+        if not 1 <= zoneNum <= ZONE_COUNT:
+            return
+        offset = ZONE_OFFSET + (zoneNum - 1) * ENTRY_SIZE
+        code = ZONE_STATES.index(state)
+        if self.map[offset] == code:
+            return
+        self.begin()
+        struct.pack_into('<B7xd', self.map, offset, code, now)
+        self.end()
+
+    # stateName is 'state' or 'ArmedState', the keypad states the engine
+    # keeps for the partition. Other keypad states aren't kept here.
+    def setPartition(self, partition, stateName, state, now):
+        if stateName == 'state':
+            (field, codes) = (0, PARTITION_STATES)
+        elif stateName == 'ArmedState':
+            (field, codes) = (1, ARMED_STATES)
+        else:
+            return
+        if state not in codes or not 1 <= partition <= PARTITION_COUNT:
+            return
+        offset = PARTITION_OFFSET + (partition - 1) * ENTRY_SIZE
+        code = codes.index(state)
+        if self.map[offset + field] == code:
+            return
+        self.begin()
+        self.map[offset + field] = code
+        struct.pack_into('<d', self.map, offset + 8, now)
+        self.end()
+
+    def setTemp(self, sensorNum, key, temp, now):
+        if not 1 <= sensorNum <= SENSOR_COUNT:
+            return
+        offset = SENSOR_OFFSET + (sensorNum - 1) * ENTRY_SIZE
+        field = TEMP_KEYS.index(key)
+        self.begin()
+        struct.pack_into('<b', self.map, offset + field, temp)
+        self.map[offset + 4] |= 1 << field
+        struct.pack_into('<d', self.map, offset + 8, now)
+        self.end()
+
+    def close(self):
+        self.setLinkUp(False)
+        self.map.close()
+
+
+class SnapshotReader(object):
+
+    def __init__(self, fileName):
+        with open(fileName, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), SNAPSHOT_SIZE,
+                                 access=mmap.ACCESS_READ)
+
+    # Returns (data, stale), a consistent copy of the block and False,
+    # retrying while the engine is in the middle of an update. Gives up
+    # after SNAPSHOT_WAIT seconds and returns the last copy and True.
+    def readBytes(self):
+        spins = 0
+        deadline = None
+        while True:
+            before = struct.unpack_from('<I', self.map, SEQUENCE_OFFSET)[0]
+            data = self.map[:SNAPSHOT_SIZE]
+            after = struct.unpack_from('<I', self.map, SEQUENCE_OFFSET)[0]
+            if before == after and before & 1 == 0:
+                return (data, False)
+            spins += 1
+            if spins < SNAPSHOT_SPINS:
+                continue
+            if deadline is None:
+                deadline = time.monotonic() + SNAPSHOT_WAIT
+            elif time.monotonic() >= deadline:
+                return (data, True)
+            time.sleep(SNAPSHOT_BACKOFF)
+
+    # The snapshot as a dict, leaving out what wasn't reported yet. stale
+    # is True if it may be torn, see readBytes.
+    def read(self):
+        (data, stale) = self.readBytes()
+        snapshot = decode(data)
+        snapshot['stale'] = stale
+        return snapshot
+
+    def close(self):
+        self.map.close()
+
+
+def decode(data):
+    (magic, version, sequence, flags, updatedAt) = struct.unpack_from(
+        '<4sHxxIId', data, 0)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError('not a state snapshot of a known version')
+    snapshot = {'sequence': sequence, 'updatedAt': updatedAt,
+                'linkUp': flags & FLAG_LINK_UP != 0, 'leds': {},
+                'zones': {}, 'partitions': {}, 'sensors': {}}
+    for (index, name) in enumerate(LED_NAMES):
+        if data[LED_OFFSET + index] < len(LED_STATES):
+            snapshot['leds'][name] = LED_STATES[data[LED_OFFSET + index]]
+    for zoneNum in range(1, ZONE_COUNT + 1):
+        (code, changedAt) = struct.unpack_from(
+            '<B7xd', data, ZONE_OFFSET + (zoneNum - 1) * ENTRY_SIZE)
+        if code > 0:
+            snapshot['zones'][zoneNum] = {'state': ZONE_STATES[code],
+                                          'changedAt': changedAt}
+    for partition in range(1, PARTITION_COUNT + 1):
+        (code, armed, changedAt) = struct.unpack_from(
+            '<BB6xd', data, PARTITION_OFFSET + (partition - 1) * ENTRY_SIZE)
+        if code > 0 or armed > 0:
+            snapshot['partitions'][partition] = {
+                'state': PARTITION_STATES[code],
+                'armedState': ARMED_STATES[armed], 'changedAt': changedAt}
+    for sensorNum in range(1, SENSOR_COUNT + 1):
+        offset = SENSOR_OFFSET + (sensorNum - 1) * ENTRY_SIZE
+        temps = struct.unpack_from('<4b', data, offset)
+        (valid, updatedAt) = struct.unpack_from('<B3xd', data, offset + 4)
+        if valid > 0:
+            sensor = dict((key, temp) for (index, (key, temp)) in
+                          enumerate(zip(TEMP_KEYS, temps))
+                          if valid & (1 << index))
+            sensor['updatedAt'] = updatedAt
+            snapshot['sensors'][sensorNum] = sensor
+    return snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Print the state snapshot the engine keeps in a file')
+    parser.add_argument('file')
+    parser.add_argument('--watch', type=float, metavar='SECONDS',
+                        help='print again whenever it changed, checking '
+                        'this often')
+    args = parser.parse_args()
+
+    reader = SnapshotReader(args.file)
+    sequence = None
+    while True:
+        snapshot = reader.read()
+        if snapshot['sequence'] != sequence:
+            sequence = snapshot['sequence']
+            print(json.dumps(snapshot, sort_keys=True))
+        if args.watch is None:
+            break
+        try:
+            time.sleep(args.watch)
+        except KeyboardInterrupt:
+            break
+    reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,485 @@
+#######################################################################
+# DSC Alarm split process mode
+#
+# Runs a panel's engine in a process of its own, at raised priority,
+# so the serial link is served on time however busy the integrations
+# (HC2 requests, MQTT, the state feed, email) get. The two processes
+# share nothing but two ring buffers in shared memory:
+#
+#   events    engine to gateway: every HostAdapter call the engine
+#             makes, pickled, in order, and every SPLIT_METRICS_SECONDS
+#             the samples of the engine's metrics
+#   commands  gateway to engine: command batches (from MQTT) and new
+#             prefs (on SIGHUP)
+#
+# Each ring has one writer and one reader. The writer only moves the
+# write position and the reader only the read position, which is how
+# the reader acknowledges what it has handled and gives the space back.
+# Neither side ever waits for the other: an engine whose events ring is
+# full keeps up to SPLIT_MAX_PENDING events in its own memory, dropping
+# the oldest beyond that, and the readers poll every SPLIT_POLL_SECONDS
+# while their ring is empty.
+#
+# The serial process stops when the gateway process is gone, and the
+# rings are removed from shared memory however the gateway exits.
+#######################################################################
+
+import atexit
+import collections
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import pickle
+import signal
+import struct
+import threading
+import time
+
+import dscBatch
+import dscCore
+import dscHost
+import dscHttp
+import dscMetrics
+import dscProfiler
+
+SPLIT_RING_BYTES = 1024 * 1024
+SPLIT_MAX_PENDING = 10000
+SPLIT_POLL_SECONDS = 0.002
+SPLIT_DRAIN_SECONDS = 5
+SPLIT_METRICS_SECONDS = 2
+SPLIT_RT_PRIORITY = 10
+SPLIT_NICE = -10
+
+# The positions are on cache lines of their own, the data follows
+RING_WRITE_OFFSET = 0
+RING_READ_OFFSET = 64
+RING_HEADER = 128
+
+# What the gateway side gets for the zone, keypad, sensor, zone group
+# or area of a state update
+DeviceRef = collections.namedtuple('DeviceRef',
+                                   ['hostRef', 'name', 'number', 'partition'])
+
+
+# A ring of length-prefixed records in shared memory, for one writer
+# and one reader. Positions count bytes ever written and read, so they
+# only grow and equal positions mean an empty ring.
+class ShmRing(object):
+
+    def __init__(self, capacity=SPLIT_RING_BYTES):
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=RING_HEADER + capacity)
+        self.buf = self.shm.buf
+        struct.pack_into('<Q', self.buf, RING_WRITE_OFFSET, 0)
+        struct.pack_into('<Q', self.buf, RING_READ_OFFSET, 0)
+
+    def positions(self):
+        return (struct.unpack_from('<Q', self.buf, RING_WRITE_OFFSET)[0],
+                struct.unpack_from('<Q', self.buf, RING_READ_OFFSET)[0])
+
+    # Bytes written but not yet acknowledged by the reader
+    def used(self):
+        (head, tail) = self.positions()
+        return head - tail
+
+    # Returns False, writing nothing, if data doesn't fit
+    def put(self, data):
+        (head, tail) = self.positions()
+        size = 4 + len(data)
+        if size > self.capacity - (head - tail):
+            return False
+        self.copyIn(head, struct.pack('<I', len(data)))
+        self.copyIn(head + 4, data)
+        # Only now the reader can see the record
+        struct.pack_into('<Q', self.buf, RING_WRITE_OFFSET, head + size)
+        return True
+
+    # Returns the oldest record, None if there is none
+    def get(self):
+        (head, tail) = self.positions()
+        if head == tail:
+            return None
+        (length,) = struct.unpack('<I', self.copyOut(tail, 4))
+        data = self.copyOut(tail + 4, length)
+        struct.pack_into('<Q', self.buf, RING_READ_OFFSET, tail + 4 + length)
+        return data
+
+    def copyIn(self, position, data):
+        start = position % self.capacity
+        first = min(len(data), self.capacity - start)
+        self.buf[RING_HEADER + start:RING_HEADER + start + first] = \
+            data[:first]
+        if first < len(data):
+            self.buf[RING_HEADER:RING_HEADER + len(data) - first] = \
+                data[first:]
+
+    def copyOut(self, position, length):
+        start = position % self.capacity
+        first = min(length, self.capacity - start)
+        data = bytes(self.buf[RING_HEADER + start:RING_HEADER + start + first])
+        if first < length:
+            data += bytes(self.buf[RING_HEADER:RING_HEADER + length - first])
+        return data
+
+    def close(self, unlink=False):
+        self.buf.release()
+        self.shm.close()
+        if unlink is True:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                # The other process got there first
+                pass
+
+
+# A metric of the serial process as last forwarded, rendered by the
+# gateway process like its own
+class ForwardedMetric(object):
+
+    def __init__(self, name, help_, kind, samples):
+        self.name = name
+        self.help = help_
+        self.kind = kind
+        self.sampleList = samples
+
+    def samples(self):
+        return self.sampleList
+
+
+###############################################################################
+# Serial Process
+###############################################################################
+
+# The host of an engine in the serial process, passing every call on to
+# the gateway process through the events ring
+class RingHost(dscHost.HostAdapter):
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.pending = collections.deque()
+        # The engine thread, command thread and HTTP threads all log
+        self.lock = threading.Lock()
+        self.overflows = dscMetrics.Counter(
+            'dsc_split_overflows_total',
+            'Events kept back because the events ring was full')
+        self.dropped = dscMetrics.Counter(
+            'dsc_split_dropped_total',
+            'Events dropped because too many were kept back')
+
+    def send(self, method, *args):
+        data = pickle.dumps((method, args), pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if len(self.pending) == 0 and self.ring.put(data) is True:
+                return
+            self.overflows.inc()
+            if len(self.pending) >= SPLIT_MAX_PENDING:
+                self.pending.popleft()
+                self.dropped.inc()
+            self.pending.append(data)
+            self.flushPending()
+
+    def flush(self):
+        with self.lock:
+            self.flushPending()
+
+    def flushPending(self):
+        while len(self.pending) > 0 and \
+                self.ring.put(self.pending[0]) is True:
+            self.pending.popleft()
+
+    # The gateway process has the backlog of the ring, live
+    def metricList(self):
+        return [self.overflows, self.dropped,
+                dscMetrics.Gauge('dsc_split_pending',
+                                 'Events kept back, waiting for room',
+                                 function=lambda: len(self.pending))]
+
+    def sendMetrics(self, registry):
+        self.send('forwardMetrics', [
+            (metric.name, metric.help, metric.kind, metric.samples())
+            for metric in registry.metrics])
+
+    def log(self, level, msg):
+        self.send('log', level, msg)
+
+    def logError(self, msg):
+        self.send('logError', msg)
+
+    def readConfiguration(self, prefs):
+        self.send('readConfiguration', dict(prefs))
+        return True
+
+    def mapDevice(self, hostRef, hc2Id):
+        self.send('mapDevice', hostRef, hc2Id)
+
+    def zoneChanged(self, zone, states):
+        self.send('zoneChanged', DeviceRef(zone.hostRef, zone.name,
+                                           zone.number, zone.partition),
+                  states)
+
+    def zoneGroupChanged(self, group, states):
+        self.send('zoneGroupChanged',
+                  DeviceRef(group.hostRef, group.name, None, None), states)
+
+    def keypadChanged(self, keypad, states):
+        self.send('keypadChanged', DeviceRef(keypad.hostRef, keypad.name,
+                                             None, keypad.partition),
+                  states)
+
+    def tempSensorChanged(self, sensor, states):
+        self.send('tempSensorChanged', DeviceRef(sensor.hostRef,
+                                                 sensor.name, sensor.number,
+                                                 None), states)
+
+    def occupancyChanged(self, area, states):
+        self.send('occupancyChanged',
+                  DeviceRef(area.hostRef, area.name, area.group, None),
+                  states)
+
+    def panelChanged(self, states, panel=None):
+        self.send('panelChanged', states)
+
+    def updateVariable(self, varId, value):
+        self.send('updateVariable', varId, value)
+
+    def fireEvent(self, eventId):
+        self.send('fireEvent', eventId)
+
+    def fireUserEvent(self, eventId, userCode):
+        self.send('fireUserEvent', eventId, userCode)
+
+    def sendEmail(self, address, subject, body):
+        self.send('sendEmail', address, subject, body)
+
+    def speak(self, text):
+        self.send('speak', text)
+
+    def runScene(self, sceneId):
+        self.send('runScene', sceneId)
+
+    def minuteElapsed(self):
+        self.send('minuteElapsed')
+
+    def sleep(self, seconds):
+        self.flush()
+        time.sleep(seconds)
+
+
+# Runs at SCHED_FIFO if allowed, else at least ahead of the gateway
+def raisePriority(host):
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO,
+                              os.sched_param(SPLIT_RT_PRIORITY))
+        host.log(2, "Serial process running at real-time priority.")
+        return
+    except (AttributeError, OSError):
+        pass
+    try:
+        os.nice(SPLIT_NICE)
+        host.log(2, "Serial process running at nice %d." % SPLIT_NICE)
+    except OSError:
+        host.log(2, "No permission to raise the serial process's "
+                 "priority.")
+
+
+# Takes batches and prefs off the commands ring until the engine stops
+def takeCommands(engine, ring):
+    while engine.shutdown is False:
+        data = ring.get()
+        if data is None:
+            time.sleep(SPLIT_POLL_SECONDS)
+            continue
+        (kind, payload) = pickle.loads(data)
+        if kind == 'reload':
+            engine.reloadConfiguration(payload)
+        elif kind == 'batch':
+            (batch, errors) = engine.queueBatch(*payload)
+            if batch is None:
+                engine.host.logError('Invalid commands: %s' % errors)
+
+
+# Forwards the engine's metrics every SPLIT_METRICS_SECONDS, and stops
+# the engine once the gateway process is gone, as nothing reads its
+# events then
+def watchGateway(engine, host, gatewayPid):
+    while engine.shutdown is False:
+        time.sleep(SPLIT_METRICS_SECONDS)
+        if os.getppid() != gatewayPid:
+            host.logError('The gateway process is gone, stopping.')
+            engine.stop()
+            break
+        host.sendMetrics(engine.metrics)
+
+
+# The serial process. setup(engine, host) registers the panel's devices,
+# addRoutes(engine, server) adds the endpoints it serves on httpPort.
+def serialMain(prefs, events, commands, setup, addRoutes, httpPort,
+               httpAddress, gatewayPid):
+    host = RingHost(events)
+    raisePriority(host)
+    engine = dscCore.DscEngine(host, prefs)
+    for metric in host.metricList():
+        engine.metrics.add(metric)
+    started = time.time()
+    setup(engine, host)
+    engine.startupPhase('registration', started)
+
+    def stop(sig, frame):
+        engine.stop()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    # The gateway process reads the config file again and sends the prefs
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    dscProfiler.installSignalHandler(engine.profiler, engine.profiledThreads)
+
+    httpServer = None
+    if httpPort > 0:
+        httpServer = dscHttp.HttpServer(httpPort, httpAddress)
+        addRoutes(engine, httpServer)
+        httpServer.start()
+        host.log(1, "Serving the engine's endpoints on port %u" % httpPort)
+
+    thread = threading.Thread(target=takeCommands, args=(engine, commands),
+                              name='dsc-split-commands')
+    thread.daemon = True
+    thread.start()
+    thread = threading.Thread(target=watchGateway,
+                              args=(engine, host, gatewayPid),
+                              name='dsc-split-watch')
+    thread.daemon = True
+    thread.start()
+
+    engine.run()
+
+    if httpServer is not None:
+        httpServer.stop()
+    if os.getppid() != gatewayPid:
+        events.close(unlink=True)
+        commands.close(unlink=True)
+        return
+    host.sendMetrics(engine.metrics)
+    # Give the gateway process the last events before going
+    deadline = time.time() + SPLIT_DRAIN_SECONDS
+    while (len(host.pending) > 0 or events.used() > 0) and \
+            time.time() < deadline:
+        host.sleep(SPLIT_POLL_SECONDS)
+
+
+###############################################################################
+# Gateway Process
+###############################################################################
+
+# Stands in for a panel's engine in the gateway process: starts the
+# serial process, hands its events to the host and passes commands on
+class SplitEngine(object):
+
+    # host takes mapDevice calls, panelHost everything else. setup and
+    # addRoutes are run by the serial process, see serialMain. Has to be
+    # created before the gateway process starts any threads, as the
+    # serial process is forked off here.
+    def __init__(self, prefs, host, panelHost, setup, splitConfig,
+                 addRoutes=None):
+        self.host = panelHost
+        self.mainHost = host
+        self.events = ShmRing(int(splitConfig.get('ringKB', 1024)) * 1024)
+        self.commands = ShmRing(int(splitConfig.get('ringKB', 1024)) * 1024)
+        self.closed = False
+        # Also when the gateway stops before run() or without ending it
+        atexit.register(self.close)
+        self.threadId = None
+        self.handled = dscMetrics.Counter(
+            'dsc_split_events_total',
+            'Events from the serial process handled')
+        self.metrics = dscMetrics.Registry()
+        self.metrics.add(self.handled)
+        self.metrics.add(dscMetrics.Gauge(
+            'dsc_split_backlog_bytes',
+            'Events from the serial process not yet handled',
+            function=self.events.used))
+        if addRoutes is None:
+            def addRoutes(engine, server):
+                engine.addHttpRoutes(server)
+        context = multiprocessing.get_context('fork')
+        self.process = context.Process(
+            target=serialMain, name='dsc-serial',
+            args=(prefs, self.events, self.commands, setup, addRoutes,
+                  int(splitConfig.get('httpPort', 0)),
+                  splitConfig.get('httpAddress', '127.0.0.1'), os.getpid()))
+        # Terminated rather than waited for if the gateway exits early
+        self.process.daemon = True
+        self.process.start()
+
+    # Handles events until the serial process has exited and everything
+    # it sent is handled
+    def run(self):
+        self.threadId = threading.get_ident()
+        try:
+            self.handleEvents()
+        finally:
+            self.close()
+
+    def handleEvents(self):
+        while True:
+            data = self.events.get()
+            if data is None:
+                if not self.process.is_alive():
+                    # It may have written more before exiting
+                    if self.events.used() == 0:
+                        break
+                    continue
+                time.sleep(SPLIT_POLL_SECONDS)
+                continue
+            self.handled.inc()
+            (method, args) = pickle.loads(data)
+            if method == 'forwardMetrics':
+                target = self
+            elif method == 'mapDevice':
+                target = self.mainHost
+            else:
+                target = self.host
+            try:
+                getattr(target, method)(*args)
+            except Exception as err:
+                self.host.logError('Error handling %s from the serial '
+                                   'process: %s' % (method, str(err)))
+        self.process.join()
+
+    # Stops the serial process if it's still running and removes the
+    # rings. Safe to call more than once.
+    def close(self):
+        if self.closed is True:
+            return
+        self.closed = True
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(SPLIT_DRAIN_SECONDS)
+        self.events.close(unlink=True)
+        self.commands.close(unlink=True)
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+
+    # Returns (batch, errors) like DscEngine.queueBatch, but the batch is
+    # only checked once the serial process takes it, errors are logged
+    def queueBatch(self, specs, timeout=dscBatch.BATCH_TIMEOUT):
+        if self.commands.put(pickle.dumps(('batch', (specs, timeout)))) \
+                is False:
+            return (None, ['the command ring is full'])
+        return (specs, [])
+
+    def reloadConfiguration(self, prefs):
+        if self.commands.put(pickle.dumps(('reload', prefs))) is False:
+            self.host.logError('Could not pass the new configuration to the '
+                               'serial process, the command ring is full.')
+
+    # Replaces the serial process's metrics with the samples it sent
+    def forwardMetrics(self, metrics):
+        self.metrics.metrics = [
+            metric for metric in self.metrics.metrics
+            if not isinstance(metric, ForwardedMetric)] + [
+            ForwardedMetric(*metric) for metric in metrics]
+
+    def httpMetrics(self, request):
+        return (200, 'text/plain; version=0.0.4', self.metrics.render())
@@ -0,0 +1,110 @@
+#######################################################################
+# In-memory host for the DSC Alarm engine
+#
+# A HostAdapter that keeps every state pushed to it in plain
+# dictionaries and records events, emails and speech, so tools like
+# dscReplay.py and dscBenchmark.py can drive the decoder and event
+# engine directly without a home automation system.
+#######################################################################
+
+import dscCore
+import dscHost
+
+DEFAULT_PREFS = {'serialPort': '', 'code': '1234',
+                 'variableState': None, 'syncTime': False,
+                 'speakingEnabled': False, 'emailUrgent': ''}
+
+
+class StubHost(dscHost.HostAdapter):
+
+    def __init__(self, logLevel=1):
+        self.level = logLevel
+        self.errors = 0
+        self.states = {}
+        self.stateUpdates = 0
+        self.variables = {}
+        self.events = []
+        self.emails = []
+        self.spoken = []
+        self.scenes = []
+
+    def log(self, level, msg):
+        if level <= self.level:
+            print(msg)
+
+    def logError(self, msg):
+        self.errors += 1
+        if self.level > 0:
+            print("Error: %s" % msg)
+
+    def updateStates(self, hostRef, states):
+        self.stateUpdates += len(states)
+        self.states.setdefault(hostRef, {}).update(states)
+
+    def zoneChanged(self, zone, states):
+        self.updateStates(zone.hostRef, states)
+
+    def zoneGroupChanged(self, group, states):
+        self.updateStates(group.hostRef, states)
+
+    def keypadChanged(self, keypad, states):
+        self.updateStates(keypad.hostRef, states)
+
+    def tempSensorChanged(self, sensor, states):
+        self.updateStates(sensor.hostRef, states)
+
+    def occupancyChanged(self, area, states):
+        self.updateStates(area.hostRef, states)
+
+    def panelChanged(self, states, panel=None):
+        self.updateStates(panel or 'panel', states)
+
+    def updateVariable(self, varId, value):
+        self.variables[varId] = value
+
+    def fireEvent(self, eventId):
+        self.events.append((eventId, None))
+
+    def fireUserEvent(self, eventId, userCode):
+        self.events.append((eventId, userCode))
+
+    def sendEmail(self, address, subject, body):
+        self.emails.append((address, subject, body))
+
+    def speak(self, text):
+        self.spoken.append(text)
+
+    def runScene(self, sceneId):
+        self.scenes.append(sceneId)
+
+
+# Creates an engine on a stub host. Returns (host, engine).
+def newEngine(prefs=None, logLevel=0):
+    host = StubHost(logLevel)
+    enginePrefs = dict(DEFAULT_PREFS)
+    if prefs is not None:
+        enginePrefs.update(prefs)
+    engine = dscCore.DscEngine(host, enginePrefs)
+    engine.configRead = engine.readConfiguration(enginePrefs)
+    return (host, engine)
+
+
+# Registers a typical installation with the engine.
+# Zones are spread evenly over the zone groups.
+def buildSite(engine, zones=64, groups=0, keypads=1, sensors=0):
+    for zone in range(1, zones + 1):
+        engine.addZone(zone, 'Alarm_Zone %d' % zone, 'zone%d' % zone)
+
+    for group in range(groups):
+        members = range(group + 1, zones + 1, groups)
+        engine.addZoneGroup('Alarm_Group %d' % (group + 1),
+                            'group%d' % (group + 1), members)
+
+    for partition in range(1, keypads + 1):
+        engine.addKeypad(partition, 'Alarm_Keypad %d' % partition,
+                         'keypad%d' % partition,
+                         {'state': dscCore.ALARM_STATE_DISARMED})
+
+    for sensor in range(1, sensors + 1):
+        engine.addTempSensor(sensor, 'Alarm_Temp %d' % sensor,
+                             'temp%d' % sensor)
@@ -0,0 +1,239 @@
+#######################################################################
+# DSC Alarm temperature history
+#
+# Keeps the readings of each temperature sensor (561 inside, 562
+# outside, 563 cool and heat set points) for graphs and HVAC rules.
+# Every series is kept at three resolutions:
+#
+#   raw     the last TEMP_RAW_SAMPLES readings as they came
+#   5 min   min, max and mean per 5 minutes, for a week
+#   hour    min, max and mean per hour, for a bit over a year
+#
+# Each is a fixed size ring of array columns, seconds since the epoch
+# and temperatures in a byte, so a series takes about 170 KB however
+# long it runs. A query bisects the time column and slices the columns,
+# and is answered from the finest resolution that reaches back far
+# enough.
+#
+# With a file set the history is saved there every TEMP_SAVE_MINUTES
+# and on shutdown, as JSON holding the raw bytes of the columns.
+#######################################################################
+
+import array
+import base64
+import bisect
+import json
+import os
+import threading
+
+TEMP_RAW_SAMPLES = 2048
+# (seconds per bucket, buckets kept) of the downsampled resolutions
+TEMP_TIERS = ((300, 7 * 288), (3600, 400 * 24))
+TEMP_SAVE_MINUTES = 15
+TEMP_HISTORY_VERSION = 1
+
+RAW_COLUMNS = 'Ib'  # time, temperature
+TIER_COLUMNS = 'IbbiI'  # bucket start, min, max, sum, count
+
+
+# A fixed number of rows kept in columns, one array each, overwriting
+# the oldest once full. The first column is the time, which only grows.
+class Ring(object):
+
+    def __init__(self, size, typecodes):
+        self.size = size
+        self.typecodes = typecodes
+        self.columns = [array.array(typecode, [0]) * size
+                        for typecode in typecodes]
+        self.head = 0  # Where the next row goes
+        self.count = 0
+
+    def append(self, row):
+        for (column, value) in zip(self.columns, row):
+            column[self.head] = value
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    # True if the rows go back to t, or nothing was ever overwritten
+    def reaches(self, t):
+        return self.count < self.size or self.columns[0][self.head] <= t
+
+    # The rows from the oldest to the newest as (start, end) indices
+    def segments(self):
+        if self.count < self.size:
+            return [(0, self.count)]
+        return [(self.head, self.size), (0, self.head)]
+
+    # The rows with start <= time <= end, as one array per column
+    def rows(self, start=0, end=2 ** 32):
+        times = self.columns[0]
+        result = [array.array(typecode) for typecode in self.typecodes]
+        for (lo, hi) in self.segments():
+            first = bisect.bisect_left(times, start, lo, hi)
+            last = bisect.bisect_right(times, end, first, hi)
+            for (column, out) in zip(self.columns, result):
+                out.extend(column[first:last])
+        return result
+
+
+# One downsampled resolution, the bucket being filled is kept apart and
+# goes in the ring once a reading for a later bucket comes in
+class Tier(object):
+
+    def __init__(self, seconds, buckets):
+        self.seconds = seconds
+        self.ring = Ring(buckets, TIER_COLUMNS)
+        self.current = None  # [start, min, max, sum, count]
+
+    def add(self, t, temp):
+        start = t - t % self.seconds
+        current = self.current
+        if current is not None and current[0] == start:
+            current[1] = min(current[1], temp)
+            current[2] = max(current[2], temp)
+            current[3] += temp
+            current[4] += 1
+            return
+        if current is not None:
+            self.ring.append(current)
+        self.current = [start, temp, temp, temp, 1]
+
+    # [[start, min, max, mean], ...] of the buckets starting in the range
+    def points(self, start, end):
+        (starts, lows, highs, sums, counts) = self.ring.rows(start, end)
+        points = [[t, low, high, round(float(total) / count, 2)]
+                  for (t, low, high, total, count) in
+                  zip(starts, lows, highs, sums, counts)]
+        current = self.current
+        if current is not None and start <= current[0] <= end:
+            points.append(current[:3] +
+                          [round(float(current[3]) / current[4], 2)])
+        return points
+
+
+class TempSeries(object):
+
+    def __init__(self):
+        self.raw = Ring(TEMP_RAW_SAMPLES, RAW_COLUMNS)
+        self.tiers = [Tier(seconds, buckets)
+                      for (seconds, buckets) in TEMP_TIERS]
+        self.last = 0
+
+    def add(self, t, temp):
+        # Never step back, the clock being set back would break bisecting
+        t = max(int(t), self.last)
+        self.last = t
+        self.raw.append((t, temp))
+        for tier in self.tiers:
+            tier.add(t, temp)
+
+    # Returns (step, points) from start to end: step 0 and [[time, temp],
+    # ...] from the raw readings, or the bucket seconds and [[start, min,
+    # max, mean], ...] from the finest tier with at least step seconds
+    # that reaches back to start
+    def query(self, start, end, step=0):
+        if step <= 0 and self.raw.reaches(start):
+            (times, temps) = self.raw.rows(start, end)
+            return (0, [list(point) for point in zip(times, temps)])
+        for tier in self.tiers:
+            if tier.seconds >= step and tier.ring.reaches(start):
+                break
+        return (tier.seconds, tier.points(start, end))
+
+    def latest(self):
+        if self.raw.count == 0:
+            return None
+        index = (self.raw.head - 1) % self.raw.size
+        return [self.raw.columns[0][index], self.raw.columns[1][index]]
+
+    # A dict of the columns' bytes, for saving
+    def dump(self):
+        def columns(ring):
+            return [base64.b64encode(column.tobytes()).decode('ascii')
+                    for column in ring.rows()]
+        return {'raw': columns(self.raw),
+                'tiers': [{'seconds': tier.seconds,
+                           'rows': columns(tier.ring),
+                           'current': tier.current}
+                          for tier in self.tiers]}
+
+    # Puts back what dump() returned, skipping tiers no longer kept
+    def restore(self, d):
+        def restoreRing(ring, encoded):
+            columns = []
+            for (typecode, text) in zip(ring.typecodes, encoded):
+                column = array.array(typecode)
+                column.frombytes(base64.b64decode(text))
+                columns.append(column)
+            for row in zip(*columns):
+                ring.append(row)
+        restoreRing(self.raw, d['raw'])
+        if self.raw.count > 0:
+            self.last = self.latest()[0]
+        for saved in d['tiers']:
+            for tier in self.tiers:
+                if tier.seconds == saved['seconds']:
+                    restoreRing(tier.ring, saved['rows'])
+                    tier.current = saved['current']
+
+
+class TempHistory(object):
+
+    def __init__(self):
+        # (sensor number, key), key as in dscCore.TEMP_STATE_KEYS
+        self.series = {}
+        # Queries come from HTTP threads, readings from the engine's
+        self.lock = threading.Lock()
+
+    def add(self, sensorNum, key, temp, now):
+        with self.lock:
+            series = self.series.get((sensorNum, key))
+            if series is None:
+                series = TempSeries()
+                self.series[(sensorNum, key)] = series
+            series.add(now, temp)
+
+    # Returns {'step': ..., 'points': [...]} as TempSeries.query, None if
+    # the sensor never sent a reading for key
+    def query(self, sensorNum, key, start, end, step=0):
+        with self.lock:
+            series = self.series.get((sensorNum, key))
+            if series is None:
+                return None
+            (step, points) = series.query(int(start), int(end), step)
+        return {'sensor': sensorNum, 'key': key, 'step': step,
+                'points': points}
+
+    # Every series with its latest reading
+    def report(self):
+        with self.lock:
+            return [{'sensor': sensorNum, 'key': key,
+                     'latest': series.latest()}
+                    for ((sensorNum, key), series) in
+                    sorted(self.series.items())]
+
+    # Loads the history saved in fileName, if there is one
+    def load(self, fileName):
+        if not os.path.exists(fileName):
+            return 0
+        with open(fileName) as f:
+            saved = json.load(f)
+        if saved.get('version') != TEMP_HISTORY_VERSION:
+            raise ValueError('unknown temperature history version')
+        with self.lock:
+            self.series = {}
+            for entry in saved['series']:
+                series = TempSeries()
+                series.restore(entry)
+                self.series[(entry['sensor'], entry['key'])] = series
+            return len(self.series)
+
+    # Written to a temporary file first so a crash never leaves half a file
+    def save(self, fileName):
+        with self.lock:
+            series = [dict(series.dump(), sensor=sensorNum, key=key)
+                      for ((sensorNum, key), series) in self.series.items()]
+        tmpName = fileName + '.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump({'version': TEMP_HISTORY_VERSION, 'series': series}, f)
+        os.replace(tmpName, fileName)
@@ -0,0 +1,84 @@
+#######################################################################
+# DSC Alarm wire tracing
+#
+# Collects one record per frame sent or received and writes them out
+# from a background thread, so the serial thread only pays for a
+# deque append. Each record is written as one JSON line:
+#   {"t": 1700000000.123456, "dir": "RX", "cmd": "609", "data": "001",
+#    "latency": 0.000021}
+# For RX the latency is the time taken to decode and act on the frame,
+# for TX it's how long flow control held the frame back.
+#######################################################################
+
+import collections
+import json
+import threading
+import time
+
+TRACE_RX = 'RX'
+TRACE_TX = 'TX'
+TRACE_FLUSH_INTERVAL = 1.0
+TRACE_MAX_RECORDS = 10000
+
+
+class TraceSink(object):
+
+    # write is called with the formatted lines from the background thread,
+    # onClose once everything has been written
+    def __init__(self, write, onClose=None,
+                 flushInterval=TRACE_FLUSH_INTERVAL,
+                 maxRecords=TRACE_MAX_RECORDS):
+        self.write = write
+        self.onClose = onClose
+        self.flushInterval = flushInterval
+        # When the writer falls behind the oldest records are dropped
+        # rather than letting the serial thread block or memory grow
+        self.records = collections.deque(maxlen=maxRecords)
+        self.dropped = 0
+        self.running = True
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='dscTrace')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, direction, cmd, data, latency):
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append((time.time(), direction, cmd, data, latency))
+
+    def run(self):
+        while self.running is True:
+            self.wakeup.wait(self.flushInterval)
+            self.flush()
+
+    def flush(self):
+        lines = []
+        while len(self.records) > 0:
+            (t, direction, cmd, data, latency) = self.records.popleft()
+            lines.append(json.dumps({'t': round(t, 6), 'dir': direction,
+                                     'cmd': cmd, 'data': data,
+                                     'latency': round(latency, 6)}))
+        if self.dropped > 0:
+            lines.append(json.dumps({'t': round(time.time(), 6),
+                                     'dropped': self.dropped}))
+            self.dropped = 0
+        if len(lines) > 0:
+            self.write('\n'.join(lines))
+
+    def close(self):
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        if self.onClose is not None:
+            self.onClose()
+
+
+# Opens fileName for appending and returns a TraceSink writing to it
+def openTraceFile(fileName):
+    f = open(fileName, 'a')
+
+    def write(text):
+        f.write(text + '\n')
+        f.flush()
+    return TraceSink(write, f.close)
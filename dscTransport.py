@@ -0,0 +1,207 @@
+#######################################################################
+# DSC Alarm panel transports
+#
+# How the engine reaches the panel. The port setting picks one:
+#
+#   /dev/ttyUSB0              IT-100 on a local serial port
+#   tcp://192.168.1.20:4025   IP serial server or Envisalink TPI
+#
+# Both carry the same IT-100 frames (see dscCodec.py) and look the same
+# to the engine: readline() returns one line or b'' after the read
+# timeout, write() sends bytes, and both raise an exception once the
+# link is gone. With a password, the TCP transport logs in to an
+# Envisalink TPI before handing the connection over.
+#######################################################################
+
+import select
+import socket
+import time
+
+import dscCodec
+
+TRANSPORT_TIMEOUT = 1  # Seconds a read waits for a line
+TRANSPORT_WRITE_TIMEOUT = 1
+SERIAL_BAUD = 9600
+TCP_CONNECT_TIMEOUT = 10
+TCP_KEEPALIVE_IDLE = 30  # Seconds idle before the first keepalive probe
+TCP_KEEPALIVE_INTERVAL = 10
+TCP_KEEPALIVE_COUNT = 3  # Unanswered probes before the link is dead
+TPI_PORT = 4025
+TPI_LOGIN_TIMEOUT = 10
+
+
+class TransportError(IOError):
+    pass
+
+
+# Opens the transport for address, see above. Raises an exception if it
+# can't be opened.
+def openTransport(address, password='', timeout=TRANSPORT_TIMEOUT):
+    if address.startswith('tcp://'):
+        (host, sep, port) = address[len('tcp://'):].rstrip('/') \
+            .rpartition(':')
+        if len(sep) == 0:
+            (host, port) = (port, TPI_PORT)
+        transport = TcpTransport(host, int(port), password, timeout)
+    else:
+        transport = SerialTransport(address, timeout=timeout)
+    transport.open()
+    return transport
+
+
+class SerialTransport(object):
+
+    def __init__(self, portName, baud=SERIAL_BAUD,
+                 timeout=TRANSPORT_TIMEOUT):
+        self.portName = portName
+        self.baud = baud
+        self.timeout = timeout
+        self.port = None
+
+    def open(self):
+        # Imported here so tools that never open a port don't need it
+        import serial  # installed with sudo apt-get install python3-serial
+        self.port = serial.Serial(self.portName, self.baud,
+                                  writeTimeout=TRANSPORT_WRITE_TIMEOUT)
+        self.port.flushInput()
+        self.port.timeout = self.timeout
+
+    def isOpen(self):
+        return self.port is not None and self.port.isOpen()
+
+    def close(self):
+        if self.port is not None:
+            self.port.close()
+            self.port = None
+
+    def readline(self):
+        return self.port.readline()
+
+    def write(self, data):
+        self.port.write(data)
+
+    def inWaiting(self):
+        return self.port.inWaiting()
+
+
+# A non-blocking socket with its own line buffer, so a line split over
+# several segments is only returned once it's complete.
+class TcpTransport(object):
+
+    def __init__(self, host, port=TPI_PORT, password='',
+                 timeout=TRANSPORT_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = b''
+
+    def open(self):
+        self.sock = socket.create_connection((self.host, self.port),
+                                             TCP_CONNECT_TIMEOUT)
+        self.sock.setblocking(False)
+        # Frames are tiny and acks are waited for, don't let Nagle hold
+        # them back
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.setKeepalive()
+        self.buffer = b''
+        if len(self.password) > 0:
+            try:
+                self.login()
+            except Exception:
+                self.close()
+                raise
+
+    # Makes a link that died without a FIN (the bridge lost power, a
+    # cable was pulled) fail reads within about a minute and a half
+    def setKeepalive(self):
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for (option, value) in (('TCP_KEEPIDLE', TCP_KEEPALIVE_IDLE),
+                                ('TCP_KEEPINTVL', TCP_KEEPALIVE_INTERVAL),
+                                ('TCP_KEEPCNT', TCP_KEEPALIVE_COUNT)):
+            if hasattr(socket, option):
+                self.sock.setsockopt(socket.IPPROTO_TCP,
+                                     getattr(socket, option), value)
+
+    # The TPI asks for the password with 505 3 and answers 505 1 if it
+    # was right, 505 0 if not and 505 2 if we took too long
+    def login(self):
+        endTime = time.time() + TPI_LOGIN_TIMEOUT
+        while time.time() < endTime:
+            try:
+                frame = dscCodec.decodeFrame(
+                    self.readline().decode('ascii', 'replace'))
+            except dscCodec.FrameError:
+                continue
+            if frame is None or frame[0] != '505':
+                continue
+            if frame[1] == '3':
+                self.write(dscCodec.encodeFrame(
+                    '005' + self.password).encode('ascii'))
+            elif frame[1] == '1':
+                return
+            elif frame[1] == '0':
+                raise TransportError('TPI login failed, check the password')
+            else:
+                raise TransportError('TPI login timed out')
+        raise TransportError('No TPI login request from %s' % self.host)
+
+    def isOpen(self):
+        return self.sock is not None
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    # Reads whatever has arrived into the buffer, waiting up to timeout
+    # seconds for something to. Raises TransportError if the other end
+    # closed the connection.
+    def receive(self, timeout):
+        (readable, w, x) = select.select([self.sock], [], [], timeout)
+        if len(readable) == 0:
+            return
+        try:
+            data = self.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        if len(data) == 0:
+            raise TransportError('Connection closed by %s' % self.host)
+        self.buffer += data
+
+    def readline(self):
+        endTime = time.time() + self.timeout
+        while b'\n' not in self.buffer:
+            remaining = endTime - time.time()
+            if remaining <= 0:
+                return b''
+            self.receive(remaining)
+        (line, sep, self.buffer) = self.buffer.partition(b'\n')
+        return line + sep
+
+    def write(self, data):
+        view = memoryview(data)
+        endTime = time.time() + TRANSPORT_WRITE_TIMEOUT
+        while len(view) > 0:
+            remaining = endTime - time.time()
+            (r, writable, x) = select.select([], [self.sock], [],
+                                             max(0, remaining))
+            if len(writable) == 0:
+                raise TransportError('Write to %s timed out' % self.host)
+            try:
+                view = view[self.sock.send(view):]
+            except (BlockingIOError, InterruptedError):
+                pass
+
+    # Bytes of complete lines waiting to be read. A closed connection
+    # counts as something to read, so the reader gets to see the error.
+    def inWaiting(self):
+        if b'\n' not in self.buffer:
+            try:
+                self.receive(0)
+            except TransportError:
+                return 1
+        if b'\n' not in self.buffer:
+            return 0
+        return len(self.buffer)
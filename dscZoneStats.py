@@ -0,0 +1,215 @@
+#######################################################################
+# DSC Alarm zone open-duration statistics
+#
+# Keeps running figures on how long each zone is open, updated on every
+# open and close, so dashboards and HVAC rules don't need the history:
+#
+#   per day (the last STATS_DAYS)  seconds open, times opened, longest
+#   since start                    times opened, longest
+#   per window (1 h, 24 h, 7 d)    count, mean and percentiles of the
+#                                  open stretches that ended in it
+#
+# Every window is STATS_SLOTS slots of a histogram of durations in
+# power of two bins, so a zone takes the same memory however often it
+# opens. Percentiles are interpolated within a bin, which is plenty for
+# telling a window aired for minutes from one left open for hours.
+#######################################################################
+
+import bisect
+import collections
+from datetime import datetime, timedelta
+import threading
+
+STATS_WINDOWS = (3600, 86400, 7 * 86400)  # Seconds
+STATS_SLOTS = 12
+STATS_DAYS = 7
+STATS_PERCENTILES = (50, 90, 99)
+# Upper bounds of the duration bins, 1 second to 12 days
+DURATION_BOUNDS = [2 ** k for k in range(21)]
+
+
+# Returns the windows in seconds of a comma separated list of minutes,
+# like "60,1440,10080". Raises ValueError if one isn't a positive number.
+def parseWindows(text):
+    if len(text.strip()) == 0:
+        return STATS_WINDOWS
+    windows = tuple(60 * float(minutes) for minutes in text.split(','))
+    if any(window <= 0 for window in windows):
+        raise ValueError('zone statistics windows must be above 0')
+    return windows
+
+
+# Open stretches that ended within the last seconds
+class DurationWindow(object):
+
+    def __init__(self, seconds, slots=STATS_SLOTS):
+        self.seconds = seconds
+        self.slotSeconds = float(seconds) / slots
+        # [slot number, bin counts, total seconds, count, longest]
+        self.slots = [None] * slots
+
+    def add(self, duration, now):
+        slotNum = int(now // self.slotSeconds)
+        index = slotNum % len(self.slots)
+        slot = self.slots[index]
+        if slot is None or slot[0] != slotNum:
+            slot = [slotNum, [0] * (len(DURATION_BOUNDS) + 1), 0.0, 0, 0.0]
+            self.slots[index] = slot
+        slot[1][bisect.bisect_left(DURATION_BOUNDS, duration)] += 1
+        slot[2] += duration
+        slot[3] += 1
+        slot[4] = max(slot[4], duration)
+
+    def summary(self, now):
+        oldest = int(now // self.slotSeconds) - len(self.slots) + 1
+        counts = [0] * (len(DURATION_BOUNDS) + 1)
+        total = 0.0
+        count = 0
+        longest = 0.0
+        for slot in self.slots:
+            if slot is None or slot[0] < oldest:
+                continue
+            for (index, n) in enumerate(slot[1]):
+                counts[index] += n
+            total += slot[2]
+            count += slot[3]
+            longest = max(longest, slot[4])
+        d = {'window': self.seconds, 'count': count}
+        if count > 0:
+            d['mean'] = round(total / count, 1)
+            for p in STATS_PERCENTILES:
+                d['p%d' % p] = round(percentile(counts, count, p,
+                                                longest), 1)
+        return d
+
+
+# Estimates the pth percentile from bin counts, assuming durations are
+# spread evenly within their bin, and none is above longest
+def percentile(counts, count, p, longest):
+    rank = count * p / 100.0
+    seen = 0
+    for (index, n) in enumerate(counts):
+        if n > 0 and seen + n >= rank:
+            low = DURATION_BOUNDS[index - 1] if index > 0 else 0
+            high = DURATION_BOUNDS[index] if index < len(DURATION_BOUNDS) \
+                else longest
+            high = max(low, min(high, longest))
+            return low + (high - low) * (rank - seen) / n
+        seen += n
+    return longest
+
+
+class ZoneStats(object):
+
+    def __init__(self, windows):
+        self.openedAt = None
+        self.opens = 0
+        self.longest = 0.0
+        # [day, seconds open, times opened, longest], oldest first
+        self.days = collections.deque(maxlen=STATS_DAYS)
+        self.windows = [DurationWindow(seconds) for seconds in windows]
+
+    def day(self, day):
+        if len(self.days) == 0 or self.days[-1][0] != day:
+            self.days.append([day, 0.0, 0, 0.0])
+        return self.days[-1]
+
+
+class ZoneStatsTracker(object):
+
+    def __init__(self, windows=STATS_WINDOWS):
+        self.windows = tuple(windows)
+        self.zones = {}
+        self.dayStart = 0
+        self.dayEnd = 0
+        self.today = None
+        # Reports come from HTTP threads, changes from the engine's
+        self.lock = threading.Lock()
+
+    # Starts over with other windows, the daily figures are kept
+    def setWindows(self, windows):
+        with self.lock:
+            if tuple(windows) == self.windows:
+                return
+            self.windows = tuple(windows)
+            for stats in self.zones.values():
+                stats.windows = [DurationWindow(seconds)
+                                 for seconds in self.windows]
+
+    # Returns (day, start of the next day) for timestamp t, in local time.
+    # The last day looked up is cached, almost every lookup is for today.
+    def dayOf(self, t):
+        if not self.dayStart <= t < self.dayEnd:
+            date = datetime.fromtimestamp(t).date()
+            self.dayStart = datetime(date.year, date.month,
+                                     date.day).timestamp()
+            nextDate = date + timedelta(days=1)
+            self.dayEnd = datetime(nextDate.year, nextDate.month,
+                                   nextDate.day).timestamp()
+            self.today = date.isoformat()
+        return (self.today, self.dayEnd)
+
+    # Splits the time from start to end into (day, seconds) of each day
+    # it fell on
+    def splitByDay(self, start, end):
+        while start < end:
+            (day, nextDay) = self.dayOf(start)
+            stretch = min(end, nextDay) - start
+            yield (day, stretch)
+            start += stretch
+
+    def zoneChanged(self, zoneNum, isOpen, now):
+        with self.lock:
+            stats = self.zones.get(zoneNum)
+            if stats is None:
+                # A close we saw no open for, like the first after startup
+                if isOpen is not True:
+                    return
+                stats = ZoneStats(self.windows)
+                self.zones[zoneNum] = stats
+
+            if isOpen is True:
+                if stats.openedAt is None:
+                    stats.openedAt = now
+                    stats.opens += 1
+                    stats.day(self.dayOf(now)[0])[2] += 1
+                return
+
+            if stats.openedAt is None:
+                return
+            duration = now - stats.openedAt
+            for (day, seconds) in self.splitByDay(stats.openedAt, now):
+                stats.day(day)[1] += seconds
+            stats.openedAt = None
+            stats.longest = max(stats.longest, duration)
+            today = stats.day(self.dayOf(now)[0])
+            today[3] = max(today[3], duration)
+            for window in stats.windows:
+                window.add(duration, now)
+
+    def zoneDict(self, stats, now):
+        days = collections.OrderedDict(
+            (day, {'day': day, 'openSeconds': seconds, 'opens': opens,
+                   'longest': round(longest, 1)})
+            for (day, seconds, opens, longest) in stats.days)
+        d = {'opens': stats.opens, 'longest': round(stats.longest, 1),
+             'windows': [window.summary(now) for window in stats.windows]}
+        if stats.openedAt is not None:
+            # Count the stretch still going on, without recording it
+            openFor = now - stats.openedAt
+            d['openFor'] = round(openFor, 1)
+            d['longest'] = round(max(stats.longest, openFor), 1)
+            for (day, seconds) in self.splitByDay(stats.openedAt, now):
+                entry = days.setdefault(day, {'day': day, 'openSeconds': 0,
+                                              'opens': 0, 'longest': 0})
+                entry['openSeconds'] += seconds
+        for entry in days.values():
+            entry['openSeconds'] = round(entry['openSeconds'], 1)
+        d['days'] = list(days.values())[-STATS_DAYS:]
+        return d
+
+    # The statistics of every zone that has been opened, by zone number
+    def report(self, now):
+        with self.lock:
+            return dict((zoneNum, self.zoneDict(stats, now))
+                        for (zoneNum, stats) in self.zones.items())
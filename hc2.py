@@ -1 +1,520 @@
-# REST interface to Fibaro Home Center 2
+#######################################################################
+# DSC Alarm host adapter for the standalone Home Center 2 gateway
+#
+# Keeps the state of every zone, zone group, keypad and temperature
+# sensor in a dscFeed.StateFeed, keyed by the id it was configured with,
+# logs to stderr and forwards changes to HC2 through Hc2Client.
+#
+# Hc2Client keeps a few persistent HTTP/1.1 connections to HC2 open and
+# sends updates from background threads, so the engine never waits on
+# the network. Updates to the same device or variable made within the
+# batch window are merged into a single request, and one still waiting
+# to be sent is simply overwritten by a newer one, so a zone storm turns
+# into one request per device that changed.
+#
+# The same queue is what carries us through HC2 outages. When a request
+# fails after its retries the client stops sending, keeps collecting
+# (and collapsing) updates, and tries one request every probe interval.
+# While HC2 is away the queue is saved to the store file so a gateway
+# restart doesn't lose it. Once HC2 answers again the backlog is sent
+# at the drain rate rather than all at once.
+#
+# Scene starts are the exception. They are sent once, ahead of any
+# backlog, and dropped with an error when HC2 can't be reached: a rule's
+# scene started after the outage would act on a condition that has
+# likely cleared by then.
+#######################################################################
+
+import base64
+import collections
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+
+import dscFeed
+import dscHost
+import dscMetrics
+
+HC2_BATCH_WINDOW = 0.05  # Seconds to collect updates before sending them
+HC2_CONNECTIONS = 2  # Requests in flight at once, one connection each
+HC2_RETRIES = 3
+HC2_RETRY_DELAY = 0.5  # Doubled after every failed attempt
+HC2_TIMEOUT = 5
+HC2_MAX_PENDING = 1000  # Devices and variables held, oldest dropped beyond
+HC2_PROBE_INTERVAL = 10  # Seconds between attempts while HC2 is down
+HC2_DRAIN_RATE = 10  # Requests per second while sending a backlog
+HC2_STORE_INTERVAL = 1.0  # Seconds between saves of the queue
+HC2_DEVICE = 'device'
+HC2_VARIABLE = 'variable'
+HC2_SCENE = 'scene'
+
+
+class Hc2Error(Exception):
+    pass
+
+
+# Saves and loads the pending updates as a JSON list of
+# [kind, id, time first queued, values], oldest first
+class UpdateStore(object):
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+
+    def load(self):
+        if not os.path.exists(self.fileName):
+            return []
+        with open(self.fileName) as f:
+            return [((kind, ident), [queuedAt, values]) for
+                    (kind, ident, queuedAt, values) in json.load(f)]
+
+    # Written to a temporary file first so a crash never leaves half a file
+    def save(self, entries):
+        tmpName = self.fileName + '.tmp'
+        with open(tmpName, 'w') as f:
+            json.dump([[kind, ident, queuedAt, values] for
+                       ((kind, ident), (queuedAt, values)) in entries], f)
+        os.replace(tmpName, self.fileName)
+
+    def remove(self):
+        if os.path.exists(self.fileName):
+            os.remove(self.fileName)
+
+
+class Hc2Client(object):
+
+    def __init__(self, address, port=80, user='', password='',
+                 batchWindow=HC2_BATCH_WINDOW, connections=HC2_CONNECTIONS,
+                 retries=HC2_RETRIES, timeout=HC2_TIMEOUT, logger=None,
+                 storeFile=None, maxPending=HC2_MAX_PENDING,
+                 probeInterval=HC2_PROBE_INTERVAL,
+                 drainRate=HC2_DRAIN_RATE):
+        self.address = address
+        self.port = port
+        self.headers = {'Content-Type': 'application/json'}
+        if len(user) > 0:
+            token = base64.b64encode(('%s:%s' % (user, password)).
+                                     encode('utf-8')).decode('ascii')
+            self.headers['Authorization'] = 'Basic ' + token
+        self.batchWindow = batchWindow
+        self.connections = connections
+        self.retries = retries
+        self.timeout = timeout
+        # Anything with the HostAdapter log and logError methods
+        self.logger = logger or dscHost.HostAdapter()
+        self.store = UpdateStore(storeFile) if storeFile else None
+        self.maxPending = maxPending
+        self.probeInterval = probeInterval
+        self.drainRate = drainRate
+        # (kind, id) -> [time first queued, merged values], oldest first
+        self.pending = collections.OrderedDict()
+        # Keys being sent right now, held back so updates stay in order
+        self.sending = set()
+        self.cond = threading.Condition()
+        self.running = False
+        self.workers = []
+        # While HC2 is down or we're draining a backlog, nothing is sent
+        # before nextAttempt
+        self.online = True
+        self.draining = False
+        self.nextAttempt = 0
+        self.changes = 0
+        self.requests = dscMetrics.Counter(
+            'dsc_hc2_requests_total', 'Requests sent to HC2', ('kind',))
+        self.updates = dscMetrics.Counter(
+            'dsc_hc2_updates_total', 'State updates handed to the HC2 client')
+        self.failures = dscMetrics.Counter(
+            'dsc_hc2_failures_total', 'Requests given up on after retries')
+        self.retried = dscMetrics.Counter(
+            'dsc_hc2_retries_total', 'Requests that had to be resent')
+        self.dropped = dscMetrics.Counter(
+            'dsc_hc2_dropped_total',
+            'Updates dropped because too many were pending')
+        self.outages = dscMetrics.Counter(
+            'dsc_hc2_outages_total', 'Times HC2 stopped answering')
+        self.latency = dscMetrics.Histogram(
+            'dsc_hc2_request_seconds', 'Time taken by HC2 requests')
+        self.pendingGauge = dscMetrics.Gauge(
+            'dsc_hc2_pending_updates', 'Devices and variables waiting to be '
+            'sent to HC2', function=lambda: len(self.pending))
+        self.onlineGauge = dscMetrics.Gauge(
+            'dsc_hc2_up', '1 while HC2 is answering requests',
+            function=lambda: 1 if self.online is True else 0)
+
+    def metricList(self):
+        return [self.requests, self.updates, self.failures, self.retried,
+                self.dropped, self.outages, self.latency, self.pendingGauge,
+                self.onlineGauge]
+
+    def start(self):
+        self.running = True
+        if self.store is not None:
+            self.loadStore()
+        for i in range(self.connections):
+            worker = threading.Thread(target=self.run, name='dscHc2-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        if self.store is not None:
+            worker = threading.Thread(target=self.runStore,
+                                      name='dscHc2Store')
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    # Sends what's still pending, waiting at most timeout seconds
+    def stop(self, timeout=HC2_TIMEOUT):
+        self.flush(timeout)
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for worker in self.workers:
+            worker.join(timeout)
+        self.workers = []
+        if self.store is not None:
+            self.saveStore()
+
+    # Waits until everything queued so far has been sent.
+    # Returns False if that took longer than timeout seconds.
+    def flush(self, timeout=HC2_TIMEOUT):
+        endTime = time.time() + timeout
+        with self.cond:
+            while len(self.pending) > 0 or len(self.sending) > 0:
+                remaining = endTime - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+    ###########################################################################
+    # Updates
+    ###########################################################################
+    def updateDevice(self, deviceId, properties):
+        self.queue((HC2_DEVICE, deviceId), properties)
+
+    def setVariable(self, name, value):
+        self.queue((HC2_VARIABLE, name), {'value': value})
+
+    # Starts of the same scene within the batch window become one
+    def startScene(self, sceneId):
+        self.queue((HC2_SCENE, sceneId), {})
+
+    def queue(self, key, values):
+        self.updates.inc()
+        with self.cond:
+            if key[0] == HC2_SCENE and self.online is False:
+                self.logger.logError("HC2 is not answering, scene %s not "
+                                     "started." % key[1])
+                return
+            self.changes += 1
+            entry = self.pending.get(key)
+            if entry is None:
+                if len(self.pending) >= self.maxPending:
+                    self.pending.popitem(last=False)
+                    self.dropped.inc()
+                self.pending[key] = [time.time(), dict(values)]
+                if key[0] == HC2_SCENE and self.draining is True:
+                    self.pending.move_to_end(key, last=False)
+                self.cond.notify()
+            else:
+                entry[1].update(values)
+
+    # Puts back an update that couldn't be sent, in front of the queue.
+    # Anything queued for the same key since then is newer and wins.
+    def requeue(self, key, values):
+        self.changes += 1
+        entry = self.pending.get(key)
+        if entry is None:
+            self.pending[key] = [time.time(), values]
+        else:
+            values.update(entry[1])
+            entry[1] = values
+        self.pending.move_to_end(key, last=False)
+
+    ###########################################################################
+    # Sending
+    ###########################################################################
+
+    # Takes the oldest pending update that isn't already being sent, once
+    # its batch window has passed and we're allowed to send. Returns None
+    # when stopped.
+    def nextUpdate(self):
+        with self.cond:
+            while self.running is True:
+                now = time.time()
+                if self.draining is True and len(self.pending) == 0:
+                    self.draining = False
+                    self.logger.log(1, "HC2 backlog sent.")
+                wait = None
+                if self.online is False or self.draining is True:
+                    wait = self.nextAttempt - now
+                if wait is None or wait <= 0:
+                    wait = None
+                    for (key, (queuedAt, values)) in self.pending.items():
+                        if key in self.sending:
+                            continue
+                        wait = queuedAt + self.batchWindow - now
+                        if wait <= 0 or self.draining is True or \
+                                self.online is False:
+                            del self.pending[key]
+                            self.sending.add(key)
+                            self.changes += 1
+                            if self.online is False:
+                                self.nextAttempt = now + self.probeInterval
+                            elif self.draining is True:
+                                self.nextAttempt = now + 1.0 / self.drainRate
+                            return (key, values)
+                        break
+                self.cond.wait(wait)
+        return None
+
+    def run(self):
+        conn = None
+        while True:
+            update = self.nextUpdate()
+            if update is None:
+                break
+            (key, values) = update
+            sent = None
+            try:
+                (conn, sent) = self.send(conn, key, values)
+            finally:
+                with self.cond:
+                    self.sending.discard(key)
+                    if sent is False:
+                        if key[0] == HC2_SCENE:
+                            self.logger.logError("HC2 did not answer, scene "
+                                                 "%s not started." % key[1])
+                        else:
+                            self.requeue(key, values)
+                        self.wentOffline()
+                    elif self.online is False:
+                        self.cameOnline()
+                    self.cond.notify_all()
+        if conn is not None:
+            conn.close()
+
+    # Called with cond held
+    def wentOffline(self):
+        if self.online is True:
+            self.online = False
+            self.outages.inc()
+            self.nextAttempt = time.time() + self.probeInterval
+            self.logger.logError("HC2 is not answering, holding updates and "
+                                 "retrying every %g seconds." %
+                                 self.probeInterval)
+            for key in [key for key in self.pending if key[0] == HC2_SCENE]:
+                del self.pending[key]
+                self.logger.logError("Scene %s not started." % key[1])
+
+    # Called with cond held
+    def cameOnline(self):
+        self.online = True
+        self.draining = True
+        self.nextAttempt = time.time() + 1.0 / self.drainRate
+        self.logger.log(1, "HC2 is answering again, sending %u held "
+                        "updates." % len(self.pending))
+
+    # Returns (method, path, body) of the request for an update
+    def request(self, kind, ident, values):
+        if kind == HC2_DEVICE:
+            return ('PUT', '/api/devices/%s' % ident,
+                    {'properties': dict((name, str(value)) for
+                                        (name, value) in values.items())})
+        if kind == HC2_SCENE:
+            return ('POST', '/api/scenes/%s/action/start' % ident, {})
+        return ('PUT', '/api/globalVariables/%s' % ident,
+                {'name': ident, 'value': str(values['value'])})
+
+    # Sends one merged update, retrying on connection errors and server
+    # errors, just once while HC2 is down. Returns the connection to use for
+    # the next request and True if sent, False if HC2 couldn't be reached
+    # or None if HC2 refused the update.
+    def send(self, conn, key, values):
+        (kind, ident) = key
+        (method, path, body) = self.request(kind, ident, values)
+        body = json.dumps(body)
+        attempts = self.retries if self.online is True else 1
+        delay = HC2_RETRY_DELAY
+        for attempt in range(attempts):
+            if attempt > 0:
+                self.retried.inc()
+                time.sleep(delay)
+                delay *= 2
+            if conn is None:
+                conn = http.client.HTTPConnection(self.address, self.port,
+                                                  timeout=self.timeout)
+            startTime = time.time()
+            try:
+                conn.request(method, path, body, self.headers)
+                response = conn.getresponse()
+                # Read it all, or the connection can't be used again
+                response.read()
+                if response.will_close:
+                    conn.close()
+                    conn = None
+                self.requests.inc(kind)
+                self.latency.observe(time.time() - startTime)
+                if response.status < 300:
+                    return (conn, True)
+                if response.status < 500:
+                    raise Hc2Error('HC2 refused %s: %u %s' %
+                                   (path, response.status, response.reason))
+                err = '%u %s' % (response.status, response.reason)
+            except (IOError, OSError, http.client.HTTPException) as e:
+                if conn is not None:
+                    conn.close()
+                    conn = None
+                err = str(e)
+            except Hc2Error as e:
+                self.logger.logError(str(e))
+                self.failures.inc()
+                return (conn, None)
+            self.logger.log(2, "HC2 request for %s failed: %s" % (path, err))
+        self.failures.inc()
+        return (conn, False)
+
+    ###########################################################################
+    # Store
+    ###########################################################################
+    def loadStore(self):
+        try:
+            entries = self.store.load()
+        except (IOError, OSError, ValueError) as err:
+            self.logger.logError('Error reading HC2 queue %s: %s' %
+                                 (self.store.fileName, str(err)))
+            return
+        # Files saved before scenes were left out may still have some
+        entries = [(key, entry) for (key, entry) in entries
+                   if key[0] != HC2_SCENE]
+        if len(entries) == 0:
+            return
+        with self.cond:
+            for (key, entry) in reversed(entries):
+                self.requeue(key, entry[1])
+            # Send what was held back at the drain rate
+            self.draining = True
+        self.logger.log(1, "Loaded %u held HC2 updates from %s." %
+                        (len(entries), self.store.fileName))
+
+    # Saves the queue while HC2 is down, and removes the file once it's
+    # empty again. Saving happens here rather than when queueing so the
+    # engine thread never waits on the disk.
+    def saveStore(self):
+        with self.cond:
+            entries = [(key, entry) for (key, entry) in self.pending.items()
+                       if key[0] != HC2_SCENE]
+        try:
+            if len(entries) == 0:
+                self.store.remove()
+            else:
+                self.store.save(entries)
+        except (IOError, OSError) as err:
+            self.logger.logError('Error saving HC2 queue %s: %s' %
+                                 (self.store.fileName, str(err)))
+
+    def runStore(self):
+        savedChanges = 0
+        while self.running is True:
+            time.sleep(HC2_STORE_INTERVAL)
+            changes = self.changes
+            if changes == savedChanges:
+                continue
+            if self.online is False or self.draining is True or \
+                    len(self.pending) == 0:
+                self.saveStore()
+                savedChanges = changes
+
+
+class Hc2Host(dscHost.HostAdapter):
+
+    def __init__(self, logLevel=1, client=None, mqtt=None):
+        self.logLevel = logLevel
+        self.client = client
+        self.mqtt = mqtt
+        self.deviceIds = {}
+        self.feed = dscFeed.StateFeed()
+
+    # Forwards the states of the device registered as hostRef to HC2
+    # device hc2Id
+    def mapDevice(self, hostRef, hc2Id):
+        self.deviceIds[hostRef] = hc2Id
+
+    ###########################################################################
+    # Logging
+    ###########################################################################
+    def log(self, level, msg):
+        if level <= self.logLevel:
+            sys.stderr.write("%s %s\n" % (time.strftime('%Y-%m-%d %H:%M:%S'),
+                                          msg))
+
+    def logError(self, msg):
+        sys.stderr.write("%s Error: %s\n" %
+                         (time.strftime('%Y-%m-%d %H:%M:%S'), msg))
+
+    ###########################################################################
+    # Configuration
+    ###########################################################################
+    def readConfiguration(self, prefs):
+        self.logLevel = int(prefs.get('logLevel', 1))
+        return True
+
+    ###########################################################################
+    # State Updates
+    ###########################################################################
+    def updateStates(self, kind, hostRef, states, zone=None, partition=None):
+        self.feed.publish(kind, hostRef, states, zone, partition)
+        if self.client is not None and hostRef in self.deviceIds:
+            self.client.updateDevice(self.deviceIds[hostRef], states)
+        if self.mqtt is not None:
+            self.mqtt.publishStates(kind, hostRef, states)
+
+    def zoneChanged(self, zone, states):
+        self.updateStates('zone', zone.hostRef, states, zone=zone.number,
+                          partition=zone.partition)
+
+    def zoneGroupChanged(self, group, states):
+        self.updateStates('zoneGroup', group.hostRef, states)
+
+    def keypadChanged(self, keypad, states):
+        self.updateStates('keypad', keypad.hostRef, states,
+                          partition=keypad.partition)
+
+    def tempSensorChanged(self, sensor, states):
+        self.updateStates('tempSensor', sensor.hostRef, states)
+
+    def occupancyChanged(self, area, states):
+        self.updateStates('area', area.hostRef, states)
+
+    def panelChanged(self, states, panel=None):
+        self.updateStates('panel', panel or 'panel', states)
+
+    def updateVariable(self, varId, value):
+        self.feed.publish('variable', varId, {'value': value})
+        if self.client is not None:
+            self.client.setVariable(varId, value)
+        if self.mqtt is not None:
+            self.mqtt.publishStates('variable', varId, {'value': value})
+
+    ###########################################################################
+    # Events and Notifications
+    ###########################################################################
+    def fireEvent(self, eventId):
+        self.log(2, "Event: %s" % eventId)
+
+    def fireUserEvent(self, eventId, userCode):
+        self.log(2, "Event: %s by user %s" % (eventId, userCode))
+
+    def sendEmail(self, address, subject, body):
+        self.log(1, "No mail transport, not sending \"%s\" to %s." %
+                 (subject, address))
+
+    def speak(self, text):
+        self.log(1, "SAY: %s" % text)
+
+    def runScene(self, sceneId):
+        self.log(2, "Starting scene %s" % sceneId)
+        if self.client is not None:
+            self.client.startScene(sceneId)